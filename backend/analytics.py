@@ -0,0 +1,284 @@
+import heapq
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+from metrics import timed
+from sheetUtil import SHEET_NAMES
+
+TARGETS_FILE = 'sheet_targets.csv'
+ANALYTICS_DIMENSIONS = ('month', 'card', 'category', 'sheet')
+# Rows the user ignored are left out of spending unless asked for by status
+DEFAULT_STATUSES = (0, 1, 2)
+COMPLETED = 1
+NO_SHEET = -1
+MONTH_PATTERN = re.compile(r'^(\d{4})-(\d{2})$')
+# Store numbers, reference codes and whatever follows '#', '*' or '/' vary between visits to one merchant
+MERCHANT_SUFFIX = re.compile(r'[#*/].*$')
+MERCHANT_CODES = re.compile(r'\S*\d\S*')
+WHITESPACE = re.compile(r'\s+')
+
+def parse_month(value):
+    """'YYYY-MM' to a month number (year * 12 + month - 1). Raises ValueError for anything else."""
+    match = MONTH_PATTERN.match(str(value))
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError(f"Month must be YYYY-MM, got '{value}'.")
+    return int(match.group(1)) * 12 + int(match.group(2)) - 1
+
+def format_month(month):
+    return f"{month // 12:04d}-{month % 12 + 1:02d}" if month >= 0 else None
+
+def month_numbers(dates) -> np.ndarray:
+    """Month numbers of parsed dates; -1 where the date is missing."""
+    dates = pd.Series(dates).reset_index(drop=True)
+    valid = dates.notna().to_numpy()
+    months = np.full(len(dates), -1, dtype=np.int32)
+    months[valid] = (dates[valid].dt.year * 12 + dates[valid].dt.month - 1).to_numpy(dtype=np.int32)
+    return months
+
+def merchant_names(descriptions) -> pd.Series:
+    """Descriptions reduced to the merchant: 'TIM HORTONS #1234' and 'Tim Hortons 0042' both become 'TIM HORTONS'."""
+    names = pd.Series(descriptions, dtype=object).fillna('').astype(str).str.upper()
+    names = names.str.replace(MERCHANT_SUFFIX, '', regex=True).str.replace(MERCHANT_CODES, '', regex=True)
+    names = names.str.replace(WHITESPACE, ' ', regex=True)
+    return names.str.strip(' -/.,')
+
+class SheetTargets:
+    """Which sheet each completed row was sent to.
+
+    The ledger only records that a row is completed, so the sheet is logged
+    here as 'hash,sheet' lines when the row is appended to Google Sheets. A
+    later line for the same hash (the row was sent again) replaces the earlier one.
+    """
+    def __init__(self, targets_file=TARGETS_FILE):
+        self.targets_file = targets_file
+        self.targets = {}
+        self.lock = threading.Lock()
+        if os.path.exists(targets_file):
+            with open(targets_file, 'r') as f:
+                for line in f:
+                    hash, _, sheet = line.strip().partition(',')
+                    if hash and sheet:
+                        self.targets[hash] = sheet
+
+    def __len__(self):
+        return len(self.targets)
+
+    def get(self, hash):
+        return self.targets.get(str(hash))
+
+    def record(self, pairs):
+        """Logs (hash, sheet name) pairs."""
+        pairs = [(str(hash), sheet) for hash, sheet in pairs if sheet]
+        if not pairs:
+            return
+        with self.lock:
+            with open(self.targets_file, 'a') as f:
+                f.writelines(f"{hash},{sheet}\n" for hash, sheet in pairs)
+            self.targets.update(pairs)
+
+class Codes:
+    """Small integer codes for the distinct values of a column, and back."""
+    def __init__(self, values=()):
+        self.codes = {}
+        self.values = []
+        for value in values:
+            self.code(value)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values) -> np.ndarray:
+        values = pd.Series(values, dtype=object).fillna('').astype(str)
+        uniques = values.unique()
+        mapping = {value: self.code(value) for value in uniques}
+        return values.map(mapping).to_numpy(dtype=np.int32)
+
+class SpendingAnalytics:
+    """Spending totals kept up to date from the ledger's change feed instead of recomputed per request.
+
+    Every row adds its amount (in cents) and a count to one cell per
+    (status, month, card, category, sheet), and to one merchant cell per
+    (status, card, merchant). A query adds up the cells it needs, so its cost
+    depends on how many months, cards and categories there are, not on ledger size.
+
+    refresh() runs before every query. It folds in rows appended since the last
+    call, and for rows whose status changed it moves the row's amount from its
+    old cell to its new one. The row's current contribution is kept per row
+    for that. The first call, or one after the ledger was replaced, builds everything.
+    """
+    def __init__(self, ledger, targets):
+        self.ledger = ledger
+        self.targets = targets
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.token = None
+        self.rows = 0
+        self.cards = Codes()
+        self.categories = Codes()
+        self.merchants = Codes()
+        self.sheets = Codes(SHEET_NAMES)
+        self.months = np.empty(0, dtype=np.int32)
+        self.card_codes = np.empty(0, dtype=np.int32)
+        self.category_codes = np.empty(0, dtype=np.int32)
+        self.merchant_codes = np.empty(0, dtype=np.int32)
+        self.cents = np.empty(0, dtype=np.int64)
+        self.statuses = np.empty(0, dtype=np.int8)
+        self.sheet_codes = np.empty(0, dtype=np.int8)
+        # (status, month, card, category, sheet) -> [cents, count]
+        self.cells = {}
+        # (status, card, merchant) -> [cents, count]
+        self.merchant_cells = {}
+
+    @timed('analytics.refresh')
+    def refresh(self):
+        """Applies ledger appends and status changes since the last refresh. Returns how many rows were applied."""
+        with self.lock:
+            # Changes first: rows appended after this read are picked up below and again by the next refresh
+            changes, token, reset = self.ledger.status_since(self.token)
+            if reset:
+                self.clear()
+            rows = self.ledger.index_columns(self.rows)
+            if not rows.empty:
+                self.add_rows(rows)
+            applied = self.apply_statuses(changes) if not changes.empty else 0
+            self.token = token
+            return len(rows) + applied
+
+    def add_rows(self, rows):
+        months = month_numbers(rows['date_key'])
+        cards = self.cards.encode(rows['Card Name'])
+        categories = self.categories.encode(rows['Category'])
+        merchants = self.merchants.encode(merchant_names(rows['Description']))
+        cents = (pd.to_numeric(rows['Amount'], errors='coerce').fillna(0) * 100).round().to_numpy(dtype=np.int64)
+        statuses = pd.to_numeric(rows['Completion'], errors='coerce').fillna(0).to_numpy(dtype=np.int8)
+        sheets = np.full(len(rows), NO_SHEET, dtype=np.int8)
+
+        self.months = np.concatenate([self.months, months])
+        self.card_codes = np.concatenate([self.card_codes, cards])
+        self.category_codes = np.concatenate([self.category_codes, categories])
+        self.merchant_codes = np.concatenate([self.merchant_codes, merchants])
+        self.cents = np.concatenate([self.cents, cents])
+        self.statuses = np.concatenate([self.statuses, statuses])
+        self.sheet_codes = np.concatenate([self.sheet_codes, sheets])
+        self.update_cells(np.arange(self.rows, self.rows + len(rows)), statuses, sheets, 1)
+        self.rows += len(rows)
+
+    def apply_statuses(self, changes):
+        """Moves rows to the cells for their new status (and, once completed, their sheet). Returns how many moved."""
+        positions = changes['position'].to_numpy(dtype=np.int64)
+        statuses = changes['Completion'].fillna(0).to_numpy(dtype=np.int8)
+        sheets = np.full(len(changes), NO_SHEET, dtype=np.int8)
+        completed = statuses == COMPLETED
+        if completed.any():
+            sheets[completed] = [
+                NO_SHEET if sheet is None else self.sheets.code(sheet)
+                for sheet in map(self.targets.get, changes['Hash'].to_numpy()[completed])
+            ]
+        moved = (self.statuses[positions] != statuses) | (self.sheet_codes[positions] != sheets)
+        positions, statuses, sheets = positions[moved], statuses[moved], sheets[moved]
+        if len(positions):
+            self.update_cells(positions, self.statuses[positions], self.sheet_codes[positions], -1)
+            self.statuses[positions] = statuses
+            self.sheet_codes[positions] = sheets
+            self.update_cells(positions, statuses, sheets, 1)
+        return len(positions)
+
+    def update_cells(self, positions, statuses, sheets, sign):
+        """Adds (sign=1) or removes (sign=-1) the rows at positions, counted with the given statuses and sheets."""
+        frame = pd.DataFrame({
+            'status': statuses, 'month': self.months[positions], 'card': self.card_codes[positions],
+            'category': self.category_codes[positions], 'sheet': sheets, 'merchant': self.merchant_codes[positions],
+            'cents': self.cents[positions],
+        })
+        for cells, keys in ((self.cells, ['status', 'month', 'card', 'category', 'sheet']),
+                            (self.merchant_cells, ['status', 'card', 'merchant'])):
+            sums = frame.groupby(keys, sort=False)['cents'].agg(['sum', 'count'])
+            for key, cents, count in zip(sums.index, sums['sum'].tolist(), sums['count'].tolist()):
+                cell = cells.setdefault(key, [0, 0])
+                cell[0] += sign * cents
+                cell[1] += sign * count
+                if cell[1] == 0:
+                    del cells[key]
+
+    def filters(self, statuses=None, card=None, category=None, sheet=None, month_from=None, month_to=None):
+        """A predicate over (status, month, card, category, sheet) cell keys for the given filters."""
+        statuses = set(DEFAULT_STATUSES if statuses is None else statuses)
+        card = self.cards.codes.get(card, -2) if card is not None else None
+        category = self.categories.codes.get(category, -2) if category is not None else None
+        sheet = self.sheets.codes.get(sheet, -2) if sheet is not None else None
+        month_from = parse_month(month_from) if month_from else None
+        month_to = parse_month(month_to) if month_to else None
+
+        def accepts(key):
+            key_status, key_month, key_card, key_category, key_sheet = key
+            return (key_status in statuses
+                    and (card is None or key_card == card)
+                    and (category is None or key_category == category)
+                    and (sheet is None or key_sheet == sheet)
+                    and (month_from is None or month_from <= key_month)
+                    and (month_to is None or 0 <= key_month <= month_to))
+        return accepts
+
+    def label(self, dimension, code):
+        if dimension == 'month':
+            return format_month(code)
+        if dimension == 'sheet':
+            return self.sheets.values[code] if code >= 0 else None
+        values = self.cards.values if dimension == 'card' else self.categories.values
+        return values[code] or None
+
+    def totals(self, by=(), **filters):
+        """Total and count per combination of the by dimensions (month, card, category, sheet), in key order."""
+        self.refresh()
+        dimensions = [ANALYTICS_DIMENSIONS.index(dimension) + 1 for dimension in by]
+        with self.lock:
+            accepts = self.filters(**filters)
+            groups = {}
+            for key, (cents, count) in self.cells.items():
+                if not accepts(key):
+                    continue
+                group = groups.setdefault(tuple(key[dimension] for dimension in dimensions), [0, 0])
+                group[0] += cents
+                group[1] += count
+            results = []
+            for group, (cents, count) in groups.items():
+                row = {dimension: self.label(dimension, code) for dimension, code in zip(by, group)}
+                row.update(total=cents / 100, count=count)
+                results.append(row)
+        return sorted(results, key=lambda row: tuple('' if row[dimension] is None else row[dimension] for dimension in by))
+
+    def balances(self, by=None, **filters):
+        """Net total per month and the running balance after it, per card, category or sheet if by is given."""
+        rows = self.totals((by, 'month') if by else ('month',), **filters)
+        balance = {}
+        for row in rows:
+            group = row.get(by) if by else None
+            balance[group] = balance.get(group, 0) + round(row['total'] * 100)
+            row['balance'] = balance[group] / 100
+        return rows
+
+    def top_merchants(self, limit=10, statuses=None, card=None):
+        """Merchants with the largest totals."""
+        self.refresh()
+        statuses = set(DEFAULT_STATUSES if statuses is None else statuses)
+        with self.lock:
+            card = self.cards.codes.get(card, -2) if card is not None else None
+            merchants = {}
+            for (status, key_card, merchant), (cents, count) in self.merchant_cells.items():
+                if status not in statuses or (card is not None and key_card != card):
+                    continue
+                total = merchants.setdefault(merchant, [0, 0])
+                total[0] += cents
+                total[1] += count
+            top = heapq.nlargest(limit, merchants.items(), key=lambda item: item[1][0])
+            return [{"merchant": self.merchants.values[merchant] or None, "total": cents / 100, "count": count}
+                    for merchant, (cents, count) in top]
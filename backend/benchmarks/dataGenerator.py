@@ -0,0 +1,125 @@
+"""Synthetic bank statements and master ledgers for benchmarks.
+
+Transactions are generated from a seed, so the same arguments always give
+the same bytes. Statements are cut from one transaction stream: two
+statements whose row ranges overlap share those rows line for line, the
+way re-downloaded statements do, which is what duplicate detection sees.
+
+    python benchmarks/dataGenerator.py --card TD --rows 10000 --date-format %m/%d/%Y > td.csv
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from masterUtil import MASTER_COLUMNS
+from transformer import OUTPUT_DATE_FORMAT
+
+MERCHANTS = [
+    "TIM HORTONS #{n}", "STARBUCKS {n}", "UBER *TRIP {code}", "UBER EATS {code}", "AMAZON.CA*{code}",
+    "NETFLIX.COM", "SPOTIFY P{code}", "SHOPPERS DRUG MART #{n}", "LOBLAWS {n}", "METRO {n}", "COSTCO WHOLESALE W{n}",
+    "PRESTO FARE/{code}", "LCBO/RAO #{n}", "ESSO {n}", "PETRO-CANADA {n}", "CANADIAN TIRE #{n}", "HOME DEPOT #{n}",
+    "BEST BUY #{n}", "IKEA {n}", "CINEPLEX {n}", "E-TRANSFER {name}", "PAYROLL DEPOSIT {code}", "HYDRO ONE {code}",
+    "ROGERS WIRELESS {code}", "BELL CANADA {code}", "DOORDASH*{name}", "SKIP THE DISHES {code}", "APPLE.COM/BILL",
+    "GOOGLE *YOUTUBE", "WALMART STORE {n}", "DOLLARAMA #{n}", "SOBEYS #{n}", "SUBWAY {n}", "MCDONALD'S #{n}",
+]
+NAMES = ["ALEX", "SAM", "JORDAN", "TAYLOR", "MORGAN", "CASEY", "RILEY", "JAMIE"]
+CATEGORIES = ["Food", "Transport", "Shopping", "Bills", "Entertainment", "Groceries", "Transfer", "Income"]
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%d %b %Y", "%b %d, %Y"]
+STREAM_BLOCK_ROWS = 1000
+TRANSACTIONS_PER_DAY = 15
+# Headers per master.csv field, used when a profile has a header row
+HEADER_NAMES = {"date": "Date", "amount": "Amount", "description": "Description", "category": "Category"}
+
+def make_transactions(count, seed=0, start='2022-01-01'):
+    """The first count transactions of the stream for seed: date, amount, description and category.
+
+    Generated in fixed blocks, so a longer stream starts with the same rows as a shorter one.
+    """
+    blocks = []
+    for block in range(-(-count // STREAM_BLOCK_ROWS)):
+        rng = np.random.default_rng([seed, block])
+        merchants = rng.integers(0, len(MERCHANTS), STREAM_BLOCK_ROWS)
+        numbers = rng.integers(100, 9999, STREAM_BLOCK_ROWS)
+        names = rng.integers(0, len(NAMES), STREAM_BLOCK_ROWS)
+        amounts = np.round(rng.lognormal(3.2, 1.0, STREAM_BLOCK_ROWS), 2)
+        # Refunds, payments and deposits are negative
+        amounts[rng.random(STREAM_BLOCK_ROWS) < 0.05] *= -1
+        blocks.append((merchants, numbers, names, amounts))
+    merchants, numbers, names, amounts = (np.concatenate(parts)[:count] for parts in zip(*blocks)) if blocks else ([], [], [], [])
+
+    descriptions = [
+        MERCHANTS[merchant].format(n=number, code=f"{number:04d}{merchant:02d}", name=NAMES[name])
+        for merchant, number, name in zip(merchants, numbers, names)
+    ]
+    return pd.DataFrame({
+        "date": pd.Timestamp(start) + pd.to_timedelta(np.arange(count) // TRANSACTIONS_PER_DAY, unit='D'),
+        "amount": np.asarray(amounts, dtype=float),
+        "description": descriptions,
+        "category": [CATEGORIES[merchant % len(CATEGORIES)] for merchant in merchants],
+    })
+
+def render_statement(profile, transactions, date_format=None) -> bytes:
+    """CSV bytes laid out as a config.json profile describes: preamble, optional header, then one line per transaction."""
+    date_format = profile.get('date_format') or date_format or DATE_FORMATS[0]
+    columns = {profile['date_col']: 'date', profile['amount_col']: 'amount', profile['description_col']: 'description'}
+    if profile.get('category_col') is not None:
+        columns[profile['category_col']] = 'category'
+    width = max(columns) + 1
+
+    fields = {
+        'date': transactions['date'].dt.strftime(date_format),
+        'amount': transactions['amount'].map('{:.2f}'.format),
+        'description': transactions['description'],
+        'category': transactions['category'],
+    }
+    table = pd.DataFrame({
+        # Columns the profile doesn't read hold account-style filler
+        col: fields[columns[col]] if col in columns else f"X{col}" for col in range(width)
+    })
+    lines = [f"Statement export,{len(transactions)} transactions" for _ in range(profile.get('skip_rows', 0))]
+    text = '\n'.join(lines) + '\n' if lines else ''
+    if profile.get('header', False):
+        text += ','.join(HEADER_NAMES[columns[col]] if col in columns else f"Column {col}" for col in range(width)) + '\n'
+    return (text + table.to_csv(header=False, index=False)).encode('utf-8')
+
+def make_statement(profile, rows, start=0, date_format=None, seed=0) -> bytes:
+    """Transactions start..start+rows of the stream for seed as a statement in profile's layout.
+
+    A statement from start=0 and another from start=rows * (1 - d) have a fraction d of their rows in common.
+    """
+    return render_statement(profile, make_transactions(start + rows, seed).iloc[start:], date_format)
+
+def make_master_csv(path, rows, pending=0, seed=0, card_names=("TD Bank",)):
+    """Writes a master.csv of rows transactions; the last pending ones are pending and the rest completed."""
+    transactions = make_transactions(rows, seed)
+    lines = (transactions['date'].dt.strftime('%Y-%m-%d') + ',' + transactions['amount'].astype(str) + ',' + transactions['description'])
+    master = pd.DataFrame({
+        'Transaction Date': transactions['date'].dt.strftime(OUTPUT_DATE_FORMAT),
+        'Amount': transactions['amount'],
+        'Description': transactions['description'],
+        'Category': transactions['category'],
+        'Card Name': [card_names[i % len(card_names)] for i in range(rows)],
+        # Same key format as Transformer.hash_lines: the md5 of a raw line as a decimal string
+        'Hash': [str(int(hashlib.md5(line.encode('utf-8')).hexdigest(), 16)) for line in lines],
+        'Completion': np.where(np.arange(rows) < rows - pending, 1, 0),
+    }, columns=MASTER_COLUMNS)
+    master.to_csv(path, index=False)
+    return master
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Writes a synthetic bank statement CSV to stdout.")
+    arg_parser.add_argument('--config', default='config.json')
+    arg_parser.add_argument('--card', required=True, help="card key in config.json")
+    arg_parser.add_argument('--rows', type=int, default=1000)
+    arg_parser.add_argument('--start', type=int, default=0, help="first transaction of the stream (overlapping ranges give duplicates)")
+    arg_parser.add_argument('--date-format', default=None)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    with open(args.config, 'r') as f:
+        profile = json.load(f)[args.card]
+    sys.stdout.buffer.write(make_statement(profile, args.rows, args.start, args.date_format, args.seed))
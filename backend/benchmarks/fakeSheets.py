@@ -0,0 +1,160 @@
+"""A local stand-in for the Google Sheets API, for benchmarks and manual testing.
+
+Serves the calls SheetSync makes (values.append, values.batchGet,
+spreadsheets.get and deleteDimension batch updates) from memory, with an
+optional per-request latency and injected errors. Point the backend at it
+with SHEETS_API_URL:
+
+    python benchmarks/fakeSheets.py --port 8085 --latency 0.1
+    SHEETS_API_URL=http://127.0.0.1:8085/ uvicorn main:app
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+# A1 ranges as the backend sends them: 'Eth!A:A', 'Eth!A12:E'
+RANGE = re.compile(r"^([^!]+)!A(\d*)(?::[A-Z]+)?$")
+
+class FakeSheets:
+    """Spreadsheets kept in memory as {spreadsheet id: {tab: [rows]}}, served over HTTP.
+
+    latency seconds are added to every request. Every error_every-th request
+    fails with error_status (429 by default, like the Sheets write quota).
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_every=0, error_status=429):
+        self.latency = latency
+        self.error_every = error_every
+        self.error_status = error_status
+        self.lock = threading.Lock()
+        self.spreadsheets = {}
+        self.requests = 0
+        self.calls = {}
+        self.rows_appended = 0
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.spreadsheets = {}
+            self.requests = 0
+            self.calls = {}
+            self.rows_appended = 0
+
+    def tab(self, spreadsheet_id, title):
+        return self.spreadsheets.setdefault(spreadsheet_id, {}).setdefault(title, [])
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "calls": dict(self.calls), "rows_appended": self.rows_appended}
+
+    def handle(self, method, path, query, body):
+        """Returns (status, response) for one API request."""
+        with self.lock:
+            self.requests += 1
+            if self.error_every and self.requests % self.error_every == 0:
+                return self.error_status, {"error": {"code": self.error_status, "message": "Injected error"}}
+
+            parts = path.strip('/').split('/')
+            # v4/spreadsheets/{id}[...]
+            spreadsheet_id, _, action = parts[2].partition(':')
+            if method == 'GET' and len(parts) == 4 and parts[3] == 'values:batchGet':
+                self.calls['batchGet'] = self.calls.get('batchGet', 0) + 1
+                value_ranges = []
+                for range_name in query.get('ranges', []):
+                    match = RANGE.match(range_name)
+                    rows = self.tab(spreadsheet_id, match.group(1))[int(match.group(2) or 1) - 1:]
+                    while rows and not any(cell != '' for cell in rows[-1]):
+                        rows = rows[:-1]
+                    value_ranges.append({"range": range_name, "values": [list(row) for row in rows]} if rows else {"range": range_name})
+                return 200, {"spreadsheetId": spreadsheet_id, "valueRanges": value_ranges}
+
+            if method == 'GET' and len(parts) == 3:
+                self.calls['get'] = self.calls.get('get', 0) + 1
+                titles = list(self.spreadsheets.get(spreadsheet_id, {}))
+                return 200, {"sheets": [{"properties": {"sheetId": index, "title": title}} for index, title in enumerate(titles)]}
+
+            if method == 'POST' and len(parts) == 5 and parts[4].endswith(':append'):
+                self.calls['append'] = self.calls.get('append', 0) + 1
+                match = RANGE.match(unquote(parts[4][:-len(':append')]))
+                values = [['' if cell is None else cell for cell in row] for row in body.get('values', [])]
+                rows = self.tab(spreadsheet_id, match.group(1))
+                start = len(rows) + 1
+                rows.extend(values)
+                self.rows_appended += len(values)
+                return 200, {"spreadsheetId": spreadsheet_id, "updates": {
+                    "updatedRange": f"{match.group(1)}!A{start}:E{start + len(values) - 1}", "updatedRows": len(values)}}
+
+            if method == 'POST' and action == 'batchUpdate':
+                self.calls['batchUpdate'] = self.calls.get('batchUpdate', 0) + 1
+                titles = list(self.spreadsheets.get(spreadsheet_id, {}))
+                for request in body.get('requests', []):
+                    dimension = request['deleteDimension']['range']
+                    del self.tab(spreadsheet_id, titles[dimension['sheetId']])[dimension['startIndex']:dimension['endIndex']]
+                return 200, {"spreadsheetId": spreadsheet_id, "replies": [{} for _ in body.get('requests', [])]}
+
+        return 404, {"error": {"code": 404, "message": f"Unsupported request {method} {path}"}}
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def respond(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, response = fake.handle(method, url.path, parse_qs(url.query), body)
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Runs a fake Google Sheets API server.")
+    arg_parser.add_argument('--port', type=int, default=8085)
+    arg_parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    arg_parser.add_argument('--error-every', type=int, default=0, help="fail every Nth request (0: never)")
+    arg_parser.add_argument('--error-status', type=int, default=429)
+    args = arg_parser.parse_args()
+    fake = FakeSheets(port=args.port, latency=args.latency, error_every=args.error_every, error_status=args.error_status)
+    print(f"Fake Google Sheets API at {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,1216 @@
+"""Benchmarks for the import, dedupe, ledger and Google Sheets sync paths.
+
+Every scenario runs in a scratch directory against generated data (see
+dataGenerator.py), and Sheets calls go to a local fake server (see
+fakeSheets.py), so results depend only on the code and the machine.
+Results are written as JSON and can be compared with an earlier run:
+
+    python benchmarks/runBenchmarks.py --size small --output before.json
+    python benchmarks/runBenchmarks.py --size small --compare before.json
+
+Run from the backend directory. Timings are the fastest of --repeat runs.
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from dataGenerator import DATE_FORMATS, make_master_csv, make_statement, make_transactions
+from fakeSheets import FakeSheets
+
+SIZES = {
+    "small": dict(master_rows=50_000, statement_rows=5_000, batch_files=4, backlogs=(1_000, 10_000), burst=200,
+                  rule_rows=20_000, search_rows=50_000, date_rows=20_000, ledger_updates=2_000,
+                  ledger_sizes=(1_000, 10_000, 100_000), hash_rows=100_000, index_hashes=250_000, tenants=200, tenant_rows=1_000, tenant_requests=2_000),
+    "medium": dict(master_rows=250_000, statement_rows=25_000, batch_files=8, backlogs=(1_000, 10_000, 50_000), burst=1_000,
+                   rule_rows=100_000, search_rows=250_000, date_rows=100_000, ledger_updates=10_000,
+                   ledger_sizes=(1_000, 10_000, 100_000, 250_000), hash_rows=250_000, index_hashes=1_000_000, tenants=500, tenant_rows=2_000, tenant_requests=5_000),
+    "large": dict(master_rows=1_000_000, statement_rows=100_000, batch_files=8, backlogs=(1_000, 10_000, 100_000), burst=5_000,
+                  rule_rows=200_000, search_rows=1_000_000, date_rows=200_000, ledger_updates=20_000,
+                  ledger_sizes=(1_000, 10_000, 100_000, 1_000_000), hash_rows=1_000_000, index_hashes=1_000_000,
+                  tenants=1_000, tenant_rows=5_000, tenant_requests=10_000),
+}
+SHEET_IDS = {"PRIMARY_SHEETID": "bench-primary", "BUSINESS_SHEETID": "bench-business",
+             "SECONDARY_SHEETID": "bench-secondary", "JOINT_SHEETID": "bench-joint"}
+MASTER_HEADER = 'Transaction Date,Amount,Description,Category,Card Name,Hash,Completion\n'
+# A change smaller than this share of the baseline is noise
+DEFAULT_THRESHOLD = 0.10
+# The old per-row hashing path is timed on at most this many rows; it takes about half a minute per 100k
+LEGACY_HASH_ROWS = 100_000
+# Workload sizes and counts reported with the results, not timings
+COUNT_METRICS = {'rows', 'files', 'rules', 'updates', 'matched', 'flagged', 'duplicate_ratio', 'sheets_latency_ms', 'tenants',
+                 'max_resident', 'requests'}
+
+SCENARIOS = {}
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+class Context:
+    """Settings shared by every scenario: the size preset, repeat count and the fake Sheets server."""
+    def __init__(self, size, repeat, duplicate_ratio, fake_sheets):
+        self.size = SIZES[size]
+        self.repeat = repeat
+        self.duplicate_ratio = duplicate_ratio
+        self.fake_sheets = fake_sheets
+        with open(os.path.join(BACKEND_DIR, 'config.json'), 'r') as f:
+            self.card_config = json.load(f)
+
+    def __getattr__(self, name):
+        try:
+            return self.size[name]
+        except KeyError:
+            raise AttributeError(name)
+
+@contextlib.contextmanager
+def workdir():
+    """A scratch directory with config.json, made the working directory; the backend uses relative paths."""
+    previous = os.getcwd()
+    path = tempfile.mkdtemp(prefix='sheetsync-bench-')
+    shutil.copy(os.path.join(BACKEND_DIR, 'config.json'), path)
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(path, ignore_errors=True)
+
+@contextlib.contextmanager
+def quiet():
+    """Hides the backend's print() progress messages."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def clear_ledger_files():
+    for file_name in ('master.csv', 'master.csv.changes', 'master.parquet', 'master.hashidx', 'master.db', 'master.db-wal', 'master.db-shm',
+                      'sync_outbox.jsonl', 'format_profiles.json', 'rules.json', 'sheet_snapshot.json', 'sheet_targets.csv'):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    # Cached parses would let a repeated import skip the work being measured
+    for directory in ('upload_cache', 'uploads'):
+        shutil.rmtree(directory, ignore_errors=True)
+
+def empty_master():
+    clear_ledger_files()
+    with open('master.csv', 'w') as f:
+        f.write(MASTER_HEADER)
+
+def best_of(repeat, func, setup=None):
+    """Runs setup() (untimed) then func() repeat times. Returns (fastest seconds, last result)."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return min(times), result
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+def ledger_memory_mb(snapshot):
+    """Resident memory a freshly loaded masterUtil adds, measured in a new interpreter."""
+    code = (
+        "import gc, sys\n"
+        f"sys.path.insert(0, {BACKEND_DIR!r})\n"
+        "def rss():\n"
+        "    gc.collect()\n"
+        "    return next(int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmRSS'))\n"
+        "from masterUtil import masterUtil\n"
+        "before = rss()\n"
+        f"ledger = masterUtil(snapshot={snapshot})\n"
+        "print((rss() - before) / 1024)\n"
+    )
+    if not os.path.exists('/proc/self/status'):
+        return None
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+def tenant_memory_mb(tenant_ids, max_resident):
+    """Resident memory the first request of every tenant in ./tenants adds with max_resident loaded, in a new interpreter."""
+    code = (
+        "import asyncio, contextlib, gc, io, sys\n"
+        f"sys.path.insert(0, {BACKEND_DIR!r})\n"
+        "import httpx, main\n"
+        "def rss():\n"
+        "    gc.collect()\n"
+        "    return next(int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmRSS'))\n"
+        f"main.TENANTS_DIR, main.MAX_RESIDENT_TENANTS = 'tenants', {max_resident}\n"
+        "async def run():\n"
+        "    async with main.lifespan(main.app):\n"
+        "        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://bench') as client:\n"
+        "            before = rss()\n"
+        f"            for tenant_id in {tenant_ids!r}:\n"
+        "                response = await client.get('/getMaster?limit=100', headers={'X-Tenant': tenant_id})\n"
+        "                assert response.status_code == 200, response.text\n"
+        "            return (rss() - before) / 1024\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        "    growth = asyncio.run(run())\n"
+        "print(growth)\n"
+    )
+    if not os.path.exists('/proc/self/status'):
+        return None
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+def startup_cost(load, check):
+    """Seconds and resident MB a new interpreter spends running load, then check, in the working directory."""
+    code = (
+        "import gc, sys, time\n"
+        f"sys.path.insert(0, {BACKEND_DIR!r})\n"
+        "def rss():\n"
+        "    gc.collect()\n"
+        "    return next(int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmRSS'))\n"
+        "import numpy, pandas, hashIndex\n"
+        "before = rss()\n"
+        "started = time.perf_counter()\n"
+        f"{load}\n"
+        f"assert {check}\n"
+        "print(time.perf_counter() - started, (rss() - before) / 1024)\n"
+    )
+    if not os.path.exists('/proc/self/status'):
+        return None, None
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    seconds, memory = output.strip().splitlines()[-1].split()
+    return float(seconds), float(memory)
+
+def transformer_for(card_config, card, rules=None):
+    from transformer import Transformer
+    profile = card_config[card]
+    return Transformer(card_name=profile.get('display_name', card), date_col=profile['date_col'], amount_col=profile['amount_col'],
+                       description_col=profile['description_col'], category_col=profile.get('category_col'),
+                       header=profile.get('header', False), skip_rows=profile.get('skip_rows', 0),
+                       date_format=profile.get('date_format'), rules=rules)
+
+def legacy_append_hash(transformer, inputCSV, df, hash_dict):
+    """append_hash as it was before hashing was vectorized: per line, an md5, a hex parse and DataFrame writes.
+
+    hash_dict maps known Hash keys to row dicts, as the old module-level hash_dict did.
+    Returns (new rows, number of duplicates).
+    """
+    lines_to_skip = transformer.skip_rows + (1 if transformer.header else 0)
+    rows_to_drop = []
+    current = 0
+    for line_index, line in enumerate(inputCSV.getvalue().decode("utf-8").splitlines()):
+        if line_index < lines_to_skip or not line.strip():
+            continue
+        if current >= len(df):
+            break
+        hash_key = str(int(hashlib.md5(bytes(line, "UTF-8")).hexdigest(), base=16))
+        if hash_key in hash_dict:
+            rows_to_drop.append(df.index[current])
+        else:
+            df.loc[df.index[current], 'Hash'] = hash_key
+            hash_dict[hash_key] = df.loc[df.index[current]].drop('Hash').to_dict()
+        current += 1
+    return df.drop(index=rows_to_drop).reset_index(drop=True), len(rows_to_drop)
+
+@contextlib.asynccontextmanager
+async def app_client(fast_sync=True):
+    """Runs the FastAPI app's startup in the working directory and yields an HTTP client for it.
+
+    With fast_sync, the sync worker's Sheets write quota is lifted so bursts measure the pipeline, not the quota.
+    """
+    try:
+        import httpx
+    except ImportError:
+        raise SystemExit("The API scenarios need httpx: pip install httpx")
+    import main
+    with quiet():
+        async with main.lifespan(main.app):
+            if fast_sync:
+                # Shared by every tenant's sync worker, so lifted in place
+                main.sync_bucket.rate = main.sync_bucket.capacity = main.sync_bucket.tokens = 10_000
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://bench', timeout=600) as client:
+                yield client, main
+
+async def warm_import_pool(main, card, statement):
+    """Starts the import process pool's workers (and their imports) before anything is timed."""
+    from transformer import prepare_upload
+    loop = asyncio.get_running_loop()
+    kwargs = main.transformer_kwargs(main.default_tenant, card)
+    await asyncio.gather(*(loop.run_in_executor(main.import_pool, prepare_upload, kwargs, 'warmup.csv', statement)
+                           for _ in range(main.IMPORT_PROCESSES)))
+
+async def wait_for_sync(main, timeout=300):
+    started = time.perf_counter()
+    while main.default_tenant.sync_worker.status()['queue_depth'] and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.01)
+
+
+@scenario('cold_start')
+def cold_start(ctx):
+    """Loading a large master.csv: ledger (from CSV and from its snapshot), dedupe index, SQLite import and app startup."""
+    import transformer
+    from masterUtil import masterUtil
+    from sqliteUtil import SqliteLedger, import_master_csv
+    results = {"rows": ctx.master_rows}
+    with workdir(), quiet():
+        make_master_csv('master.csv', ctx.master_rows, pending=min(1_000, ctx.master_rows))
+        results["ledger_csv_load_seconds"], _ = best_of(ctx.repeat, lambda: masterUtil(snapshot=False))
+        results["ledger_csv_memory_mb"] = ledger_memory_mb(snapshot=False)
+        # The first load writes the snapshot that later loads read
+        masterUtil()
+        results["ledger_load_seconds"], ledger = best_of(ctx.repeat, masterUtil)
+        results["ledger_memory_mb"] = ledger_memory_mb(snapshot=True)
+        results["snapshot_write_seconds"], _ = best_of(ctx.repeat, ledger.save_snapshot)
+        results["snapshot_bytes_per_row"] = os.path.getsize('master.parquet') / ctx.master_rows
+        results["csv_bytes_per_row"] = os.path.getsize('master.csv') / ctx.master_rows
+
+        def remove_index():
+            if os.path.exists(transformer.HASH_INDEX_FILE):
+                os.remove(transformer.HASH_INDEX_FILE)
+        results["hash_index_build_seconds"], _ = best_of(ctx.repeat, lambda: transformer.precheck_hash_dupe(ledger), remove_index)
+        results["hash_index_load_seconds"], _ = best_of(ctx.repeat, lambda: transformer.precheck_hash_dupe(ledger))
+        results["hash_index_bytes_per_row"] = os.path.getsize(transformer.HASH_INDEX_FILE) / ctx.master_rows
+
+        def remove_db():
+            for file_name in ('master.db', 'master.db-wal', 'master.db-shm'):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+        results["sqlite_import_seconds"], db = best_of(1, lambda: import_master_csv('master.csv', 'master.db'), remove_db)
+        db.close()
+        results["sqlite_open_seconds"], db = best_of(ctx.repeat, lambda: SqliteLedger('master.db'))
+        db.close()
+
+        async def startup():
+            started = time.perf_counter()
+            async with app_client():
+                return time.perf_counter() - started
+        os.remove(transformer.HASH_INDEX_FILE)
+        results["app_startup_seconds"] = min(asyncio.run(startup()) for _ in range(ctx.repeat))
+    return results
+
+@scenario('import_single')
+def import_single(ctx):
+    """One statement per card into an empty ledger, again with duplicate_ratio of it already imported, and streamed."""
+    import transformer
+    from masterUtil import masterUtil
+    rows = ctx.statement_rows
+    results = {"rows": rows, "duplicate_ratio": ctx.duplicate_ratio}
+    with workdir(), quiet():
+        state = {}
+
+        def fresh():
+            empty_master()
+            state['ledger'] = masterUtil()
+            transformer.precheck_hash_dupe(state['ledger'])
+
+        for card, profile in ctx.card_config.items():
+            statement = make_statement(profile, rows)
+            seconds, _ = best_of(ctx.repeat, lambda: transformer_for(ctx.card_config, card).reformat_csv(io.BytesIO(statement), state['ledger']), fresh)
+            results[f"{card}_rows_per_second"] = rows / seconds
+
+            # The second statement starts with the last duplicate_ratio of the first
+            overlapping = make_statement(profile, rows, start=round(rows * (1 - ctx.duplicate_ratio)))
+
+            def import_first():
+                fresh()
+                transformer_for(ctx.card_config, card).reformat_csv(io.BytesIO(statement), state['ledger'])
+            seconds, _ = best_of(ctx.repeat, lambda: transformer_for(ctx.card_config, card).reformat_csv(io.BytesIO(overlapping), state['ledger']), import_first)
+            results[f"{card}_with_duplicates_rows_per_second"] = rows / seconds
+
+        card = next(iter(ctx.card_config))
+        statement = make_statement(ctx.card_config[card], rows)
+        seconds, _ = best_of(ctx.repeat, lambda: transformer_for(ctx.card_config, card).reformat_csv_stream(
+            io.BytesIO(statement), state['ledger'], chunk_rows=max(1, rows // 10)), fresh)
+        results["streamed_rows_per_second"] = rows / seconds
+    return results
+
+@scenario('hashing')
+def hashing(ctx):
+    """Hashing a large statement's lines and dropping the duplicate_ratio of them already known, against the old per-row path."""
+    from transformer import DedupeIndex
+    rows, card = ctx.hash_rows, 'TD'
+    known = round(rows * ctx.duplicate_ratio)
+    statement = make_statement(ctx.card_config[card], rows)
+    results = {"rows": rows, "duplicate_ratio": ctx.duplicate_ratio}
+    with workdir(), quiet():
+        transformer = transformer_for(ctx.card_config, card)
+        parsed, _, _ = transformer.read_rows(io.BytesIO(statement))
+        seconds, (hashed, digests, _) = best_of(ctx.repeat, lambda: transformer.hash_rows(io.BytesIO(statement), parsed))
+        results["hash_rows_per_second"] = rows / seconds
+
+        def known_hashes():
+            transformer.hashes = DedupeIndex()
+            transformer.hashes.index.add(digests[:known])
+        seconds, (new_rows, _, duplicate_rows) = best_of(ctx.repeat, lambda: transformer.dedupe(hashed, digests), known_hashes)
+        results["dedupe_rows_per_second"] = rows / seconds
+        assert len(duplicate_rows) == known and len(new_rows) == rows - known
+        results["rows_per_second"] = rows / (rows / results["hash_rows_per_second"] + rows / results["dedupe_rows_per_second"])
+
+        legacy_rows = min(rows, LEGACY_HASH_ROWS)
+        legacy_statement = make_statement(ctx.card_config[card], legacy_rows)
+        legacy_known = round(legacy_rows * ctx.duplicate_ratio)
+        hash_dict = {key: {} for key in hashed['Hash'].iloc[:legacy_known]}
+        legacy_parsed, _, _ = transformer.read_rows(io.BytesIO(legacy_statement))
+        started = time.perf_counter()
+        legacy_new, legacy_duplicates = legacy_append_hash(transformer, io.BytesIO(legacy_statement), legacy_parsed, hash_dict)
+        results["legacy_rows_per_second"] = legacy_rows / (time.perf_counter() - started)
+        # Same keys and duplicates as the vectorized path
+        assert legacy_duplicates == legacy_known
+        assert legacy_new['Hash'].tolist() == hashed['Hash'].iloc[legacy_known:legacy_rows].tolist()
+        results["speedup"] = results["rows_per_second"] / results["legacy_rows_per_second"]
+    return results
+
+@scenario('hash_index')
+def hash_index(ctx):
+    """Dedupe index startup and memory against the old hash_dict of full row dicts, each measured in a new interpreter."""
+    from masterUtil import masterUtil
+    from transformer import DedupeIndex
+    rows = ctx.index_hashes
+    results = {"rows": rows}
+    with workdir(), quiet():
+        make_master_csv('master.csv', rows)
+        ledger = masterUtil(snapshot=False)
+        index = DedupeIndex('master.hashidx')
+
+        def remove_index():
+            if os.path.exists('master.hashidx'):
+                os.remove('master.hashidx')
+        results["build_seconds"], _ = best_of(ctx.repeat, lambda: index.load(ledger), remove_index)
+        results["load_seconds"], _ = best_of(ctx.repeat, lambda: index.load(ledger))
+        results["bytes_per_row"] = os.path.getsize('master.hashidx') / rows
+        known = next(iter(ledger.hashes()))
+
+        results["startup_seconds"], results["memory_mb"] = startup_cost(
+            f"index = hashIndex.HashIndex.load('master.hashidx', {len(ledger)})",
+            f"hashIndex.key_to_digest({known!r}) in index")
+        # The old startup: every ledger row as a dict keyed by its hash
+        results["legacy_startup_seconds"], results["legacy_memory_mb"] = startup_cost(
+            "df = pandas.read_csv('master.csv'); df['Hash'] = df['Hash'].astype(str); "
+            "hash_dict = df.drop_duplicates('Hash').set_index('Hash').to_dict('index')",
+            f"{known!r} in hash_dict")
+        if results["memory_mb"] is not None:
+            results["startup_speedup"] = results["legacy_startup_seconds"] / results["startup_seconds"]
+            results["memory_ratio"] = results["legacy_memory_mb"] / max(results["memory_mb"], 0.01)
+    return results
+
+@scenario('date_parsing')
+def date_parsing(ctx):
+    """Standardizing a date column in each supported format, and in a mix that needs per-value parsing."""
+    import pandas as pd
+    dates = make_transactions(ctx.date_rows)['date']
+    results = {"rows": ctx.date_rows}
+    card = next(iter(ctx.card_config))
+    with quiet():
+        for date_format in DATE_FORMATS:
+            values = dates.dt.strftime(date_format)
+            seconds, _ = best_of(ctx.repeat, lambda: transformer_for(ctx.card_config, card).standardize_dates(values))
+            label = date_format.replace('%', '').replace('/', '').replace(' ', '').replace(',', '').replace('-', '')
+            results[f"{label}_rows_per_second"] = ctx.date_rows / seconds
+        mixed = pd.concat([dates.iloc[::2].dt.strftime('%Y-%m-%d'), dates.iloc[1::2].dt.strftime('%b %d, %Y')]).sort_index()
+        seconds, _ = best_of(ctx.repeat, lambda: transformer_for(ctx.card_config, card).standardize_dates(mixed))
+        results["mixed_rows_per_second"] = ctx.date_rows / seconds
+        # Day-first, with every day 12 or less at the top: the format has to come from all the values, not the first rows
+        from transformer import OUTPUT_DATE_FORMAT
+        dayfirst = dates.iloc[dates.dt.day.gt(12).argsort(kind='stable')].reset_index(drop=True)
+        seconds, standardized = best_of(ctx.repeat, lambda: transformer_for(ctx.card_config, card).standardize_dates(dayfirst.dt.strftime('%d/%m/%Y')))
+        assert standardized.equals(dayfirst.dt.strftime(OUTPUT_DATE_FORMAT)), "day-first dates read month-first"
+        results["dayfirst_small_days_first_rows_per_second"] = ctx.date_rows / seconds
+        # The old path: dateutil on every row of a month-first column
+        transformer = transformer_for(ctx.card_config, card)
+        values = dates.dt.strftime('%m/%d/%Y')
+        seconds, legacy = best_of(ctx.repeat, lambda: values.apply(transformer.standardize_date))
+        results["legacy_rows_per_second"] = ctx.date_rows / seconds
+        assert transformer_for(ctx.card_config, card).standardize_dates(values).equals(legacy), "bulk parsing changed month-first output"
+        results["speedup"] = results["mdY_rows_per_second"] / results["legacy_rows_per_second"]
+    return results
+
+@scenario('import_batch')
+def import_batch(ctx):
+    """Several statements through /addMaster/batch versus one /addMaster call each."""
+    files = ctx.batch_files
+    rows = ctx.statement_rows // files
+    cards = list(ctx.card_config)
+    statements = [(f"statement{i}.csv", cards[i % len(cards)], make_statement(ctx.card_config[cards[i % len(cards)]], rows, seed=i + 1))
+                  for i in range(files)]
+
+    async def batch():
+        async with app_client() as (client, main):
+            await warm_import_pool(main, cards[0], statements[0][2])
+            started = time.perf_counter()
+            response = await client.post('/addMaster/batch', files=[('files', (name, data)) for name, _, data in statements],
+                                         data={'cards': [card for _, card, _ in statements]})
+            assert response.status_code == 200, response.text
+            return time.perf_counter() - started
+
+    async def sequential():
+        async with app_client() as (client, main):
+            await warm_import_pool(main, cards[0], statements[0][2])
+            started = time.perf_counter()
+            for name, card, data in statements:
+                response = await client.post('/addMaster', files={'file': (name, data)}, data={'card': card})
+                assert response.status_code == 200, response.text
+            return time.perf_counter() - started
+
+    results = {"files": files, "rows": rows * files}
+    with workdir():
+        batch_times, sequential_times = [], []
+        for _ in range(ctx.repeat):
+            empty_master()
+            batch_times.append(asyncio.run(batch()))
+            empty_master()
+            sequential_times.append(asyncio.run(sequential()))
+    results["batch_seconds"] = min(batch_times)
+    results["sequential_seconds"] = min(sequential_times)
+    results["batch_speedup"] = results["sequential_seconds"] / results["batch_seconds"]
+    return results
+
+@scenario('get_master')
+def get_master(ctx):
+    """/getMaster first page, full pagination and the change feed at each backlog size, for both ledgers."""
+    results = {}
+    calls = max(5, ctx.repeat * 5)
+
+    async def measure(backlog, prefix):
+        async with app_client() as (client, main):
+            latencies = []
+            for _ in range(calls):
+                started = time.perf_counter()
+                page = (await client.get('/getMaster?limit=1000')).json()
+                latencies.append(time.perf_counter() - started)
+            results[f"{prefix}_first_page_p50_ms"] = statistics.median(latencies) * 1000
+
+            started = time.perf_counter()
+            cursor, loaded = None, 0
+            while True:
+                page = (await client.get('/getMaster', params={'limit': 1000, **({'cursor': cursor} if cursor else {})})).json()
+                loaded += len(page['rows'])
+                cursor = page['next_cursor']
+                if not cursor:
+                    break
+            results[f"{prefix}_full_load_seconds"] = time.perf_counter() - started
+            assert loaded == backlog, (loaded, backlog)
+
+            # 100 rows change, then the client polls for just those
+            version = page['version']
+            hashes = [row['Hash'] for row in page['rows'][:100]]
+            await asyncio.get_running_loop().run_in_executor(None, main.default_tenant.ledger.record_changes, [(hash, -1) for hash in hashes])
+            latencies = []
+            for _ in range(calls):
+                started = time.perf_counter()
+                changes = (await client.get('/getMaster', params={'since': version})).json()
+                latencies.append(time.perf_counter() - started)
+            assert len(changes['rows']) == len(hashes)
+            results[f"{prefix}_changes_p50_ms"] = statistics.median(latencies) * 1000
+
+    with workdir(), quiet():
+        for backlog in ctx.backlogs:
+            for storage in ('csv', 'sqlite'):
+                clear_ledger_files()
+                # A completed history as large as the backlog sits in front of it
+                make_master_csv('master.csv', backlog * 2, pending=backlog)
+                os.environ['MASTER_STORAGE'] = storage
+                try:
+                    asyncio.run(measure(backlog, f"{storage}_{backlog}"))
+                finally:
+                    os.environ.pop('MASTER_STORAGE', None)
+    return results
+
+@scenario('concurrent_reads')
+def concurrent_reads(ctx):
+    """/getMaster latency while a large import runs, compared with an idle server."""
+    card = next(iter(ctx.card_config))
+    statement = make_statement(ctx.card_config[card], ctx.statement_rows * 4, seed=7)
+    results = {}
+
+    async def measure():
+        async with app_client() as (client, _):
+            async def read_latencies(count):
+                latencies = []
+                for _ in range(count):
+                    started = time.perf_counter()
+                    await client.get('/getMaster?limit=100')
+                    latencies.append(time.perf_counter() - started)
+                return latencies
+            idle = await read_latencies(50)
+            upload = asyncio.ensure_future(client.post('/addMaster', files={'file': ('big.csv', statement)}, data={'card': card}))
+            busy = []
+            while not upload.done():
+                busy.extend(await read_latencies(5))
+            await upload
+            results["idle_p95_ms"] = percentile(idle, 0.95) * 1000
+            results["during_import_p95_ms"] = percentile(busy, 0.95) * 1000 if busy else None
+            results["reads_during_import"] = len(busy)
+
+    with workdir(), quiet():
+        clear_ledger_files()
+        make_master_csv('master.csv', 20_000, pending=10_000)
+        asyncio.run(measure())
+    return results
+
+@scenario('concurrent_writes')
+def concurrent_writes(ctx):
+    """Uploads, single and batch completions and ignores sent all at once, on both ledgers; none may be lost.
+
+    Afterwards the ledger must hold every uploaded row once, every clicked row must have
+    its new status, both in memory and after a restart, and every completed row must
+    have reached the fake sheets exactly once.
+    """
+    from masterUtil import open_ledger
+    from sheetUtil import SHEET_NAMES
+    files, rows, clicks = ctx.batch_files * 2, ctx.statement_rows // ctx.batch_files, ctx.burst * 3
+    cards = list(ctx.card_config)
+    statements = [(f"statement{i}.csv", cards[i % len(cards)], make_statement(ctx.card_config[cards[i % len(cards)]], rows, seed=20 + i))
+                  for i in range(files)]
+    # Sent twice: whichever copy lands second is all duplicates
+    statements.append(("again.csv",) + statements[0][1:])
+    uploaded = set()
+    for _, card, data in statements:
+        uploaded.update(transformer_for(ctx.card_config, card).hash_lines(io.BytesIO(data))[0])
+    results = {"files": len(statements), "rows": rows * files, "updates": clicks}
+
+    async def measure(storage):
+        async with app_client() as (client, main):
+            ledger = main.default_tenant.ledger
+            expected_rows = len(ledger) + len(uploaded - set(ledger.hashes()))
+            pending = (await client.get('/getMaster', params={'limit': clicks})).json()['rows']
+            items = [{"hash": row['Hash'], "transactionDate": row['Transaction Date'], "amount": row['Amount'],
+                      "description": row['Description'], "category": row['Category'], "sheetName": SHEET_NAMES[i % len(SHEET_NAMES)]}
+                     for i, row in enumerate(pending)]
+            single, ignored, batched = items[0::3], items[1::3], items[2::3]
+            requests = [('upload', client.post('/addMaster', files={'file': (name, data)}, data={'card': card}))
+                        for name, card, data in statements]
+            requests += [('click', client.post(f"/updateCompletion/{item['sheetName']}", json={k: v for k, v in item.items() if k != 'sheetName'}))
+                         for item in single]
+            requests += [('click', client.post(f"/updateIgnore/{item['hash']}")) for item in ignored]
+            requests += [('click', client.post('/updateCompletion/batch', json={"items": batched[start:start + 20]}))
+                         for start in range(0, len(batched), 20)]
+            # Clicks land while uploads are being parsed and appended
+            random.Random(0).shuffle(requests)
+            latencies = {'upload': [], 'click': []}
+
+            async def send(kind, request):
+                started = time.perf_counter()
+                response = await request
+                latencies[kind].append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+
+            ctx.fake_sheets.reset()
+            started = time.perf_counter()
+            await asyncio.gather(*(send(kind, request) for kind, request in requests))
+            main.default_tenant.sync_worker.notify()
+            await wait_for_sync(main)
+            results[f"{storage}_seconds"] = time.perf_counter() - started
+            results[f"{storage}_click_p95_ms"] = percentile(latencies['click'], 0.95) * 1000
+            results[f"{storage}_upload_p95_ms"] = percentile(latencies['upload'], 0.95) * 1000
+            assert ctx.fake_sheets.stats()['rows_appended'] == len(single) + len(batched), ctx.fake_sheets.stats()
+            check(ledger, expected_rows, single + batched, ignored)
+        # Closing the app wrote the ledger out; what it reads back must be the same
+        ledger = open_ledger()
+        try:
+            check(ledger, expected_rows, single + batched, ignored)
+        finally:
+            ledger.close()
+
+    def check(ledger, expected_rows, completed, ignored):
+        assert len(ledger) == expected_rows, (len(ledger), expected_rows)
+        statuses = {row['Hash']: row['Completion'] for row in ledger.query_rows(status=None)[0]}
+        assert uploaded <= set(statuses)
+        lost = [item['hash'] for item in completed if statuses[item['hash']] != 1]
+        lost += [item['hash'] for item in ignored if statuses[item['hash']] != -1]
+        assert not lost, f"{len(lost)} status changes lost"
+
+    with workdir(), quiet():
+        for storage in ('csv', 'sqlite'):
+            clear_ledger_files()
+            make_master_csv('master.csv', clicks * 2, pending=clicks)
+            os.environ['MASTER_STORAGE'] = storage
+            try:
+                asyncio.run(measure(storage))
+            finally:
+                os.environ.pop('MASTER_STORAGE', None)
+    return results
+
+@scenario('completion_burst')
+def completion_burst(ctx):
+    """Completing a burst of rows against the fake Sheets server: one batch request, then single-row requests."""
+    from sheetUtil import SHEET_NAMES, append_row_to_sheet
+    burst = ctx.burst
+    results = {"rows": burst, "sheets_latency_ms": ctx.fake_sheets.latency * 1000}
+
+    def items(rows):
+        return [{"hash": row['Hash'], "transactionDate": row['Transaction Date'], "amount": row['Amount'],
+                 "description": row['Description'], "category": row['Category'], "sheetName": SHEET_NAMES[i % len(SHEET_NAMES)]}
+                for i, row in enumerate(rows)]
+
+    async def measure():
+        async with app_client() as (client, main):
+            rows = (await client.get('/getMaster', params={'limit': burst * 2})).json()['rows']
+            batch, single = items(rows[:burst]), items(rows[burst:])
+
+            ctx.fake_sheets.reset()
+            started = time.perf_counter()
+            # A row clicked twice in one batch is appended once
+            response = await client.post('/updateCompletion/batch', json={"items": batch + batch[:1]})
+            results["batch_seconds"] = time.perf_counter() - started
+            assert response.json()['completed'] == burst, response.text
+            assert ctx.fake_sheets.stats()['rows_appended'] == burst, ctx.fake_sheets.stats()
+            results["batch_sheets_calls"] = ctx.fake_sheets.stats()['calls'].get('append', 0)
+            # Rows already completed, and unknown ones, are reported failed rather than appended again
+            response = await client.post('/updateCompletion/batch', json={"items": batch[:2] + [dict(batch[0], hash='0')]})
+            assert [result['error'] for result in response.json()['results']] == \
+                ["Transaction is no longer pending."] * 2 + ["Transaction not found."], response.text
+            assert ctx.fake_sheets.stats()['rows_appended'] == burst, ctx.fake_sheets.stats()
+
+            ctx.fake_sheets.reset()
+            latencies = []
+
+            async def complete(item):
+                started = time.perf_counter()
+                response = await client.post(f"/updateCompletion/{item['sheetName']}", json={k: v for k, v in item.items() if k != 'sheetName'})
+                latencies.append(time.perf_counter() - started)
+                return response
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(complete(item) for item in single))
+            assert all(response.status_code == 200 for response in responses)
+            results["single_enqueue_p50_ms"] = statistics.median(latencies) * 1000
+            results["single_enqueue_p95_ms"] = percentile(latencies, 0.95) * 1000
+            main.default_tenant.sync_worker.notify()
+            await wait_for_sync(main)
+            results["single_drain_seconds"] = time.perf_counter() - started
+            results["single_sheets_calls"] = ctx.fake_sheets.stats()['calls'].get('append', 0)
+            results["single_rows_per_second"] = burst / results["single_drain_seconds"]
+            # A repeated click, or one from a stale page, doesn't send the row again
+            assert (await complete(single[0])).status_code == 409
+            assert (await complete(dict(single[0], hash='0'))).status_code == 404
+            assert (await client.post('/updateIgnore/0')).status_code == 404
+            main.default_tenant.sync_worker.notify()
+            await wait_for_sync(main)
+            assert ctx.fake_sheets.stats()['rows_appended'] == burst, ctx.fake_sheets.stats()
+
+            # The old path: every click appended its own row with one Sheets call before the request returned
+            ctx.fake_sheets.reset()
+            service, routes = main.default_tenant.sync_worker.service, main.default_tenant.routes
+
+            def legacy():
+                return [append_row_to_sheet(service, item['sheetName'], item['transactionDate'], item['amount'],
+                                            item['description'], item['category'], routes) for item in batch]
+            started = time.perf_counter()
+            assert all(await asyncio.to_thread(legacy))
+            results["legacy_seconds"] = time.perf_counter() - started
+            results["legacy_sheets_calls"] = ctx.fake_sheets.stats()['calls'].get('append', 0)
+            results["batch_speedup"] = results["legacy_seconds"] / results["batch_seconds"]
+
+    with workdir(), quiet():
+        clear_ledger_files()
+        make_master_csv('master.csv', burst * 2, pending=burst * 2)
+        asyncio.run(measure())
+    return results
+
+@scenario('ledger_updates')
+def ledger_updates(ctx):
+    """Single-row status changes (each logged durably) against ledger size, on both ledgers and on the old path.
+
+    The old path is what a completion click did before the ledger was kept in memory:
+    read all of master.csv, set the row, and write all of it back.
+    """
+    import pandas as pd
+    from masterUtil import masterUtil
+    from sqliteUtil import import_master_csv
+    count = ctx.ledger_updates
+    # The old path takes seconds per click on a large ledger, so it gets a few clicks only
+    legacy_clicks = max(5, ctx.repeat)
+    results = {"updates": count}
+
+    def legacy_update(hash):
+        df = pd.read_csv('master.csv', dtype={'Hash': str})
+        df.loc[df['Hash'] == hash, 'Completion'] = 1
+        df.to_csv('master.csv', index=False)
+
+    def click_latencies(update, hashes):
+        latencies = []
+        for hash in hashes:
+            started = time.perf_counter()
+            update(hash)
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    with workdir(), quiet():
+        for rows in ctx.ledger_sizes:
+            clear_ledger_files()
+            make_master_csv('master.csv', rows, pending=min(rows, count))
+            hashes = masterUtil(snapshot=False).hashes_with_status(0)
+            for storage, open_ledger in (('csv', masterUtil), ('sqlite', lambda: import_master_csv('master.csv', 'master.db'))):
+                ledger = open_ledger()
+                latencies = click_latencies(ledger.update_completion, hashes)
+                results[f"{storage}_{rows}_update_p50_ms"] = statistics.median(latencies) * 1000
+                # Includes the CSV ledger's compaction every COMPACT_EVERY changes
+                results[f"{storage}_{rows}_updates_per_second"] = len(hashes) / sum(latencies)
+                if storage == 'sqlite':
+                    ledger.close()
+                else:
+                    # Leave master.csv as generated for the SQLite import
+                    ledger.record_changes([(hash, 0) for hash in hashes])
+                    ledger.close()
+            latencies = click_latencies(legacy_update, hashes[:legacy_clicks])
+            results[f"legacy_{rows}_update_p50_ms"] = statistics.median(latencies) * 1000
+        largest = ctx.ledger_sizes[-1]
+        results[f"csv_{largest}_speedup"] = results[f"legacy_{largest}_update_p50_ms"] / results[f"csv_{largest}_update_p50_ms"]
+    return results
+
+@scenario('rules')
+def rules(ctx):
+    """Matching rows against 1000 keyword rules and 50 regular expression rules."""
+    import pandas as pd
+    from rulesEngine import RulesEngine
+    transactions = make_transactions(ctx.rule_rows)
+    rows = pd.DataFrame({'Transaction Date': '', 'Amount': transactions['amount'], 'Description': transactions['description'],
+                         'Category': transactions['category'], 'Card Name': 'TD Bank', 'Hash': '', 'Completion': 0})
+    targets = ['Primary', 'Business', 'Secondary', 'Joint', 'ignore']
+    definitions = [{"keywords": [f"STARBUCKS {number}"], "target": targets[number % len(targets)]} for number in range(100, 1100)]
+    definitions += [{"pattern": rf"^UBER \*TRIP {number:04d}", "amount_min": 10, "target": "Joint"} for number in range(1000, 1050)]
+    results = {"rows": ctx.rule_rows, "rules": len(definitions)}
+    results["compile_seconds"], engine = best_of(ctx.repeat, lambda: RulesEngine(definitions, ctx.card_config))
+    seconds, positions = best_of(ctx.repeat, lambda: engine.match(rows))
+    results["rows_per_second"] = ctx.rule_rows / seconds
+    results["matched"] = int((positions >= 0).sum())
+    return results
+
+@scenario('search')
+def search(ctx):
+    """Building the search index over a large ledger and query latency by query type."""
+    from masterUtil import masterUtil
+    from searchIndex import SearchIndex
+    queries = {
+        "word": dict(text="starbucks"),
+        "prefix": dict(text="tim hor"),
+        "date_range": dict(date_from="2022-03-01", date_to="2022-03-31"),
+        "text_and_amount": dict(text="uber", amount_min=20, amount_max=80),
+        "unfiltered": dict(),
+    }
+    results = {"rows": ctx.search_rows}
+    with workdir(), quiet():
+        make_master_csv('master.csv', ctx.search_rows)
+        ledger = masterUtil()
+        index = None
+
+        def build():
+            nonlocal index
+            index = SearchIndex(ledger)
+            index.refresh()
+        results["build_seconds"], _ = best_of(ctx.repeat, build)
+        for name, query in queries.items():
+            latencies = []
+            for _ in range(max(5, ctx.repeat * 5)):
+                started = time.perf_counter()
+                index.search(**query, limit=100)
+                latencies.append(time.perf_counter() - started)
+            results[f"{name}_p50_ms"] = statistics.median(latencies) * 1000
+    return results
+
+@scenario('reconcile')
+def reconcile(ctx):
+    """Reconciling a ledger whose completed rows are all in the fake sheets: a full read, then an incremental one."""
+    import sheetUtil
+    from masterUtil import masterUtil
+    from sheetReconciler import SheetReconciler
+    rows = ctx.master_rows // 5
+    results = {"rows": rows}
+    with workdir(), quiet():
+        master = make_master_csv('master.csv', rows)
+        ledger = masterUtil()
+        ctx.fake_sheets.reset()
+        for i, row in enumerate(master.itertuples(index=False)):
+            row_data, range_name, sheetID = sheetUtil.get_row(sheetUtil.SHEET_NAMES[i % 4], row[0], row[1], row[2], row[3])
+            ctx.fake_sheets.tab(sheetID, range_name.split('!')[0]).append(['' if cell is None else cell for cell in row_data])
+        client = sheetUtil.SheetsClient(base_url=ctx.fake_sheets.url)
+        reconciler = SheetReconciler(ledger, client)
+        results["full_seconds"], report = best_of(ctx.repeat, lambda: reconciler.reconcile(full=True))
+        assert report['missing'] == 0 and report['extra'] == 0, report
+        results["incremental_seconds"], report = best_of(ctx.repeat, lambda: reconciler.reconcile())
+        results["incremental_rows_read"] = report['fetched_rows']
+        # A second copy of a completed row may be a repeat purchase typed in by hand: reported, deleted only when listed
+        row = next(master.itertuples(index=False))
+        row_data, range_name, sheetID = sheetUtil.get_row(sheetUtil.SHEET_NAMES[0], row[0], row[1], row[2], row[3])
+        ctx.fake_sheets.tab(sheetID, range_name.split('!')[0]).append(['' if cell is None else cell for cell in row_data])
+        report = reconciler.reconcile(repair=True)
+        assert report['extra'] == report['duplicates'] == 1 and report['deleted'] == 0, report
+        extra, matched = report['extra_rows'][0], {"sheet": report['extra_rows'][0]['sheet'], "row": 1}
+        report = reconciler.reconcile(delete_rows=[extra, matched])
+        assert report['deleted'] == 1 and report['not_deleted'] == [matched], report
+        assert reconciler.reconcile()['extra'] == 0
+        client.close()
+    return results
+
+@scenario('analytics')
+def analytics(ctx):
+    """Building the spending aggregates, query latency, catching up after ledger changes, against a pandas recompute."""
+    import pandas as pd
+    from analytics import SheetTargets, SpendingAnalytics
+    from masterUtil import masterUtil
+    from transformer import OUTPUT_DATE_FORMAT
+    queries = {
+        "totals_month_card": dict(by=('month', 'card')),
+        "totals_category_filtered": dict(by=('category',), card='TD Bank', month_from='2022-03', month_to='2022-06'),
+        "totals_all_dimensions": dict(by=('month', 'card', 'category', 'sheet')),
+    }
+    updates = ctx.ledger_updates
+    results = {"rows": ctx.search_rows, "updates": updates}
+    with workdir(), quiet():
+        make_master_csv('master.csv', ctx.search_rows, pending=updates * 2, card_names=("TD Bank", "Rogers", "Amex"))
+        ledger = masterUtil()
+        targets = SheetTargets()
+        spending = None
+
+        def build():
+            nonlocal spending
+            spending = SpendingAnalytics(ledger, targets)
+            spending.refresh()
+        results["build_seconds"], _ = best_of(ctx.repeat, build)
+
+        for name, query in queries.items():
+            latencies = []
+            for _ in range(max(5, ctx.repeat * 5)):
+                started = time.perf_counter()
+                spending.totals(**query)
+                latencies.append(time.perf_counter() - started)
+            results[f"{name}_p50_ms"] = statistics.median(latencies) * 1000
+        seconds, _ = best_of(max(5, ctx.repeat * 5), lambda: spending.balances('card'))
+        results["balances_ms"] = seconds * 1000
+        seconds, _ = best_of(max(5, ctx.repeat * 5), lambda: spending.top_merchants(10))
+        results["top_merchants_ms"] = seconds * 1000
+
+        # What an endpoint without the aggregates would do per request
+        def recompute():
+            with ledger.lock:
+                df = ledger.master_df[ledger.master_df['Completion'].isin([0, 1, 2])]
+            months = pd.to_datetime(df['Transaction Date'], format=OUTPUT_DATE_FORMAT).dt.to_period('M')
+            return df.groupby([months, df['Card Name']])['Amount'].agg(['sum', 'count'])
+        seconds, _ = best_of(ctx.repeat, recompute)
+        results["recompute_ms"] = seconds * 1000
+        results["query_speedup"] = results["recompute_ms"] / results["totals_month_card_p50_ms"]
+
+        # Half the pending rows are sent to sheets, and a statement's worth of rows is appended
+        pending = ledger.hashes_with_status(0)[:updates]
+        targets.record((hash, 'Primary') for hash in pending)
+        ledger.update_completion_bulk(pending)
+        appended = make_master_csv('appended.csv', updates, seed=1)
+        ledger.append_rows(appended.assign(Completion=0))
+        started = time.perf_counter()
+        spending.refresh()
+        results["refresh_after_updates_ms"] = (time.perf_counter() - started) * 1000
+        seconds, _ = best_of(max(5, ctx.repeat * 5), spending.refresh)
+        results["idle_refresh_ms"] = seconds * 1000
+    return results
+
+
+@scenario('near_duplicates')
+def near_duplicates(ctx):
+    """Probable-duplicate matching of a statement where duplicate_ratio of the rows repeat ledger rows in altered form.
+
+    Repeats cycle through a re-export (same card and date, description spacing and case
+    changed), the same purchase on another card one to three days later, and a pending
+    charge that settled 15% higher. The other rows are new transactions over the same dates.
+    """
+    import numpy as np
+    import pandas as pd
+    from duplicateMatcher import NearDuplicateIndex
+    from masterUtil import MASTER_COLUMNS, masterUtil
+    from transformer import OUTPUT_DATE_FORMAT
+    rows = ctx.statement_rows
+    repeats = round(rows * ctx.duplicate_ratio)
+    results = {"rows": rows, "duplicate_ratio": ctx.duplicate_ratio}
+    with workdir(), quiet():
+        master = make_master_csv('master.csv', ctx.master_rows)
+        ledger = masterUtil()
+        rng = np.random.default_rng(0)
+        positions = rng.choice(len(master), repeats, replace=False)
+        altered = master.iloc[positions].reset_index(drop=True)
+        kinds = np.arange(repeats) % 3
+        dates = pd.to_datetime(altered['Transaction Date'], format=OUTPUT_DATE_FORMAT)
+        other_card = kinds == 1
+        dates[other_card] += pd.to_timedelta(rng.integers(1, 4, int(other_card.sum())), unit='D')
+        altered['Transaction Date'] = dates.dt.strftime(OUTPUT_DATE_FORMAT)
+        altered.loc[kinds == 0, 'Description'] = '  ' + altered.loc[kinds == 0, 'Description'].str.title().str.replace(' ', '  ')
+        altered.loc[other_card, 'Card Name'] = 'Joint'
+        altered.loc[kinds == 2, 'Amount'] = (altered.loc[kinds == 2, 'Amount'] * 1.15).round(2)
+
+        fresh = make_transactions(rows - repeats, seed=1)
+        fresh = pd.DataFrame({
+            'Transaction Date': fresh['date'].dt.strftime(OUTPUT_DATE_FORMAT), 'Amount': fresh['amount'],
+            'Description': fresh['description'], 'Category': fresh['category'], 'Card Name': 'TD Bank', 'Hash': '', 'Completion': 0,
+        }, columns=MASTER_COLUMNS)
+        upload = pd.concat([altered, fresh], ignore_index=True)
+        # The matcher ignores Category, so it carries each row's number through to the matches
+        upload['Category'] = np.arange(rows)
+        truth = dict(enumerate(positions.tolist()))
+
+        index = None
+
+        def build():
+            nonlocal index
+            index = NearDuplicateIndex(ledger)
+            index.refresh()
+        results["build_seconds"], _ = best_of(ctx.repeat, build)
+        seconds, matches = best_of(ctx.repeat, lambda: index.match(upload))
+        results["match_rows_per_second"] = rows / seconds
+
+        found = {match['row']['Category']: match['match']['index'] for match in matches}
+        correct = {row for row, position in found.items() if truth.get(row) == position}
+        results["flagged"] = len(matches)
+        results["precision"] = len(correct) / len(matches) if matches else 1.0
+        results["recall"] = len(correct) / repeats if repeats else 1.0
+        for kind, name in enumerate(('reexport', 'other_card', 'settled')):
+            expected = {row for row in truth if kinds[row] == kind}
+            results[f"{name}_recall"] = len(expected & correct) / len(expected) if expected else 1.0
+    return results
+
+@scenario('repeat_upload')
+def repeat_upload(ctx):
+    """One statement through /addMaster, then again from the upload cache, and sent as a chunked upload."""
+    rows = ctx.statement_rows * 4
+    statement = make_statement(ctx.card_config['TD'], rows)
+    chunked = make_statement(ctx.card_config['TD'], rows, seed=1)
+    chunk_bytes = 256 * 1024
+
+    async def upload(client, timings, name):
+        """Times one upload; processing_seconds leaves out sending the file and the response (duplicate_rows)."""
+        started = time.perf_counter()
+        response = await client.post('/addMaster', files={'file': ('statement.csv', statement)}, data={'card': 'TD', 'profile': 'true'})
+        assert response.status_code == 200, response.text
+        timings[f"{name}_seconds"] = time.perf_counter() - started
+        timings[f"{name}_processing_seconds"] = response.json()['profile']['total_seconds']
+
+    async def measure():
+        timings = {}
+        async with app_client() as (client, main):
+            await upload(client, timings, "first_upload")
+            await upload(client, timings, "repeat_upload")
+            # The same repeat without the cache: parsed and hashed again, only to find every row a duplicate
+            shutil.rmtree('upload_cache')
+            main.default_tenant.upload_cache.entries.clear()
+            main.default_tenant.upload_cache.rows = 0
+            await upload(client, timings, "uncached_repeat")
+
+            started = time.perf_counter()
+            session = (await client.post('/addMaster/uploads', json={'file_name': 'chunked.csv', 'size': len(chunked), 'card': 'TD'})).json()
+            for offset in range(0, len(chunked), chunk_bytes):
+                response = await client.put(f"/addMaster/uploads/{session['upload_id']}", params={'offset': offset},
+                                            content=chunked[offset:offset + chunk_bytes])
+                assert response.status_code == 200, response.text
+            response = await client.post(f"/addMaster/uploads/{session['upload_id']}/complete")
+            assert response.status_code == 200, response.text
+            timings["chunked_upload_seconds"] = time.perf_counter() - started
+        # A restart keeps only the cache files on disk
+        async with app_client() as (client, main):
+            # The indexes built in the background at startup would otherwise compete for the CPU
+            tenant = main.default_tenant
+            for index in (tenant.search_index, tenant.spending_analytics, tenant.near_duplicate_index):
+                await main.run_blocking(index.refresh)
+            await upload(client, timings, "repeat_after_restart")
+        return timings
+
+    results = {"rows": rows}
+    with workdir():
+        runs = []
+        for _ in range(ctx.repeat):
+            empty_master()
+            runs.append(asyncio.run(measure()))
+    for metric in runs[0]:
+        results[metric] = min(run[metric] for run in runs)
+    results["repeat_speedup"] = results["uncached_repeat_seconds"] / results["repeat_upload_seconds"]
+    results["repeat_processing_speedup"] = results["uncached_repeat_processing_seconds"] / results["repeat_upload_processing_seconds"]
+    return results
+
+@scenario('tenants')
+def tenants(ctx):
+    """Hundreds of tenants on one server with at most 32 loaded: first requests, a skewed mixed workload and memory.
+
+    Memory is also measured with every tenant kept loaded, for comparison.
+    """
+    import numpy as np
+    import main
+    from metrics import TENANT_EVICTIONS, TENANT_LOADS
+    count, requests, max_resident = ctx.tenants, ctx.tenant_requests, 32
+    tenant_ids = [f"household-{i:04d}" for i in range(count)]
+    statement = make_statement(ctx.card_config['TD'], 200, seed=3)
+    results = {"tenants": count, "rows": ctx.tenant_rows, "max_resident": max_resident, "requests": requests}
+
+    rng = np.random.default_rng(0)
+    # A few households are busy and most are rarely used
+    popularity = 1 / np.arange(1, count + 1) ** 1.1
+    workload = list(zip(rng.choice(count, size=requests, p=popularity / popularity.sum()),
+                        rng.choice(['page', 'totals', 'search', 'upload'], size=requests, p=[0.7, 0.15, 0.1, 0.05])))
+
+    def call(client, tenant_id, kind='page'):
+        headers = {'X-Tenant': tenant_id}
+        if kind == 'upload':
+            return client.post('/addMaster', files={'file': ('statement.csv', statement)}, data={'card': 'TD'}, headers=headers)
+        path = {'page': '/getMaster?limit=100', 'totals': '/analytics/totals?by=month', 'search': '/search?q=coffee'}[kind]
+        return client.get(path, headers=headers)
+
+    async def timed_call(client, tenant_id, kind='page'):
+        started = time.perf_counter()
+        response = await call(client, tenant_id, kind)
+        assert response.status_code == 200, response.text
+        return time.perf_counter() - started, response
+
+    async def measure():
+        loads, evictions = TENANT_LOADS.values.get((), 0), TENANT_EVICTIONS.values.get((), 0)
+        async with app_client() as (client, main_module):
+            assert (await client.get('/getMaster')).status_code == 400
+            assert (await call(client, 'no-such-household')).status_code == 404
+            # Households don't share a dedupe index, and an evicted one keeps its own
+            _, first = await timed_call(client, tenant_ids[0], 'upload')
+            _, other = await timed_call(client, tenant_ids[1], 'upload')
+            assert not first.json()['duplicate_rows'] and not other.json()['duplicate_rows']
+
+            latencies = [(await timed_call(client, tenant_id))[0] for tenant_id in tenant_ids]
+            results["first_request_p50_ms"] = statistics.median(latencies) * 1000
+            results["first_request_p95_ms"] = percentile(latencies, 0.95) * 1000
+            assert len(main_module.tenants.resident) <= max_resident
+            # One Sheets write quota however many households are loaded
+            assert all(tenant.sync_worker.bucket is main_module.sync_bucket for tenant in main_module.tenants.resident.values())
+            _, again = await timed_call(client, tenant_ids[0], 'upload')
+            assert len(again.json()['duplicate_rows']) == 200, again.json()['details']
+
+            mixed_loads = TENANT_LOADS.values.get((), 0)
+            semaphore = asyncio.Semaphore(16)
+            latencies = []
+
+            async def worker(position, kind):
+                async with semaphore:
+                    latencies.append((await timed_call(client, tenant_ids[position], kind))[0])
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(position, kind) for position, kind in workload))
+            results["mixed_requests_per_second"] = requests / (time.perf_counter() - started)
+            results["mixed_p50_ms"] = statistics.median(latencies) * 1000
+            results["mixed_p95_ms"] = percentile(latencies, 0.95) * 1000
+            results["mixed_tenant_loads"] = TENANT_LOADS.values.get((), 0) - mixed_loads
+            results["mixed_resident_hit_ratio"] = 1 - results["mixed_tenant_loads"] / requests
+        results["tenant_loads"] = TENANT_LOADS.values.get((), 0) - loads
+        results["tenant_evictions"] = TENANT_EVICTIONS.values.get((), 0) - evictions
+
+    with workdir(), quiet():
+        make_master_csv('master.csv', ctx.tenant_rows, pending=ctx.tenant_rows // 2)
+        for tenant_id in tenant_ids:
+            os.makedirs(os.path.join('tenants', tenant_id))
+            shutil.copy('master.csv', os.path.join('tenants', tenant_id, 'master.csv'))
+            sheets = {name: {"spreadsheet_id": f"{tenant_id}-{name.lower()}", "range": "Eth!A:A"} for name in ('Primary', 'Joint')}
+            with open(os.path.join('tenants', tenant_id, 'sheets.json'), 'w') as f:
+                json.dump(sheets, f)
+        main.TENANTS_DIR, main.MAX_RESIDENT_TENANTS = 'tenants', max_resident
+        try:
+            asyncio.run(measure())
+        finally:
+            main.TENANTS_DIR = None
+        results["memory_mb"] = tenant_memory_mb(tenant_ids, max_resident)
+        results["all_loaded_memory_mb"] = tenant_memory_mb(tenant_ids, count)
+    return results
+
+def higher_is_better(metric):
+    return (metric.endswith('per_second') or metric.endswith('speedup') or metric.endswith('precision') or metric.endswith('recall')
+            or metric.endswith('hit_ratio'))
+
+def compare(baseline, current, threshold):
+    """Prints each metric against the baseline. Returns the regressions beyond threshold."""
+    regressions = []
+    for name, metrics in current['results'].items():
+        old_metrics = baseline.get('results', {}).get(name)
+        if not old_metrics:
+            continue
+        print(f"\n{name}")
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            worse = -change if higher_is_better(metric) else change
+            flag = '  REGRESSION' if worse > threshold and metric not in COUNT_METRICS else ''
+            print(f"  {metric:45} {old:14.4f} -> {value:14.4f}  {change:+7.1%}{flag}")
+            if flag:
+                regressions.append(f"{name}.{metric}")
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Runs the SheetSync benchmarks and writes JSON results.")
+    arg_parser.add_argument('--size', choices=SIZES, default='medium')
+    arg_parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--duplicate-ratio', type=float, default=0.5, help="share of a re-imported statement already in the ledger")
+    arg_parser.add_argument('--sheets-latency', type=float, default=0.05, help="seconds the fake Sheets server adds per request")
+    arg_parser.add_argument('--output', default='benchmark_results.json')
+    arg_parser.add_argument('--compare', help="earlier results file to compare against")
+    arg_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = arg_parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        arg_parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    # Set before the backend's Sheets client reads them
+    fake_sheets = FakeSheets(latency=args.sheets_latency).start()
+    os.environ['SHEETS_API_URL'] = fake_sheets.url
+    os.environ.update(SHEET_IDS)
+    ctx = Context(args.size, args.repeat, args.duplicate_ratio, fake_sheets)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "size": args.size,
+            "repeat": args.repeat,
+            "duplicate_ratio": args.duplicate_ratio,
+            "sheets_latency": args.sheets_latency,
+        },
+        "results": {},
+    }
+    try:
+        for name in names:
+            print(f"Running {name}...", flush=True)
+            started = time.perf_counter()
+            report["results"][name] = SCENARIOS[name](ctx)
+            print(f"  done in {time.perf_counter() - started:.1f}s: {json.dumps(report['results'][name])}", flush=True)
+    finally:
+        fake_sheets.stop()
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+    if baseline is not None:
+        regressions = compare(baseline, report, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
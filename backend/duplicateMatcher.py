@@ -0,0 +1,208 @@
+import difflib
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+from analytics import Codes, WHITESPACE, merchant_names
+from masterUtil import to_date_keys, to_records
+from metrics import timed
+
+# How far apart the same transaction's dates can be on two statements (posting delays, time zones)
+NEAR_DUPLICATE_DAYS = int(os.getenv('NEAR_DUPLICATE_DAYS', 3))
+# Descriptions at least this similar (0-1) are taken to name the same purchase
+NEAR_DUPLICATE_SIMILARITY = 0.85
+# A pending amount can settle up to this share higher or lower (tips, currency conversion)
+NEAR_DUPLICATE_AMOUNT_SHARE = 0.25
+# Keys are value << DAY_BITS | day, so one block's rows are sorted by date
+DAY_BITS = 20
+DAY_LIMIT = 1 << DAY_BITS
+NO_MERCHANT = -1
+
+def normalize_descriptions(descriptions) -> pd.Series:
+    """Descriptions compared case-insensitively, with runs of whitespace collapsed."""
+    descriptions = pd.Series(descriptions, dtype=object).fillna('').astype(str)
+    return descriptions.str.casefold().str.replace(WHITESPACE, ' ', regex=True).str.strip()
+
+def day_numbers(dates) -> np.ndarray:
+    """Days since 1970 of parsed dates; -1 where the date is missing."""
+    dates = pd.Series(dates).reset_index(drop=True)
+    valid = dates.notna().to_numpy()
+    days = np.full(len(dates), -1, dtype=np.int64)
+    days[valid] = dates[valid].to_numpy().astype('datetime64[D]').astype(np.int64)
+    return days
+
+def cents(amounts) -> np.ndarray:
+    return (pd.to_numeric(pd.Series(amounts), errors='coerce') * 100).round().fillna(0).to_numpy(dtype=np.int64)
+
+class NearDuplicateIndex:
+    """Finds ledger rows that are probably the same transaction as an upload's rows.
+
+    The dedupe index only catches an exact repeat of a raw statement line. The same
+    purchase re-exported with different spacing or columns, seen again once its
+    pending amount settled, or on both a card and the joint account hashes
+    differently. Those rows are imported and reported with their likely match,
+    since two real purchases can look the same.
+
+    Two blocking indexes keep the lookup sub-linear: ledger rows sorted by
+    (amount in cents, day) and by (merchant, day). A row's candidates are the
+    rows with its exact amount, or its merchant, within NEAR_DUPLICATE_DAYS,
+    found with a binary search per block. Only those are scored:
+
+    - Same amount: the descriptions must be similar, or name the same merchant.
+    - Different amount: same card, same sign, within NEAR_DUPLICATE_AMOUNT_SHARE,
+      and the same description (a settled pending charge). Similar descriptions
+      aren't enough here: they are usually two visits to one merchant.
+
+    Like SearchIndex, refresh() indexes rows appended since the last call; the
+    sorted keys are rebuilt on the next match after rows were added.
+    """
+    def __init__(self, ledger, days=NEAR_DUPLICATE_DAYS):
+        self.ledger = ledger
+        self.days = days
+        self.lock = threading.Lock()
+        self.indexed_rows = 0
+        self.merchants = Codes()
+        self.cards = Codes()
+        self.day_keys = np.empty(0, dtype=np.int64)
+        self.cents = np.empty(0, dtype=np.int64)
+        self.merchant_codes = np.empty(0, dtype=np.int64)
+        self.card_codes = np.empty(0, dtype=np.int32)
+        self.descriptions = Codes()
+        self.description_codes = np.empty(0, dtype=np.int64)
+        self.amount_order = None
+        self.merchant_order = None
+
+    def refresh(self):
+        """Indexes ledger rows appended since the last refresh. Returns how many were added."""
+        with self.lock:
+            rows = self.ledger.index_columns(self.indexed_rows)
+            if rows.empty:
+                return 0
+            self.day_keys = np.concatenate([self.day_keys, day_numbers(rows['date_key'])])
+            self.cents = np.concatenate([self.cents, cents(rows['Amount'])])
+            self.merchant_codes = np.concatenate([self.merchant_codes, self.merchant_codes_for(rows['Description'])])
+            self.card_codes = np.concatenate([self.card_codes, self.cards.encode(rows['Card Name'])])
+            self.description_codes = np.concatenate([self.description_codes, self.descriptions.encode(normalize_descriptions(rows['Description']))])
+            self.amount_order = None
+            self.merchant_order = None
+            self.indexed_rows += len(rows)
+            return len(rows)
+
+    def merchant_codes_for(self, descriptions) -> np.ndarray:
+        names = merchant_names(descriptions)
+        codes = self.merchants.encode(names).astype(np.int64)
+        # A description that is all reference numbers names no merchant
+        codes[(names == '').to_numpy()] = NO_MERCHANT
+        return codes
+
+    def sorted_keys(self, block):
+        """(sorted keys, row positions) for the 'amount' or 'merchant' blocking index, built on first use after a refresh."""
+        if block == 'amount':
+            if self.amount_order is None:
+                self.amount_order = self.build_order(self.cents)
+            return self.amount_order
+        if self.merchant_order is None:
+            self.merchant_order = self.build_order(self.merchant_codes)
+        return self.merchant_order
+
+    def build_order(self, values):
+        dated = np.flatnonzero((self.day_keys >= 0) & (self.day_keys < DAY_LIMIT))
+        keys = (values[dated] << DAY_BITS) | self.day_keys[dated]
+        order = np.argsort(keys, kind='stable')
+        return keys[order], dated[order]
+
+    def candidates(self, block, values, days):
+        """For each (value, day), the positions in the block with that value within self.days, as (row numbers, positions)."""
+        keys, positions = self.sorted_keys(block)
+        starts = np.searchsorted(keys, (values << DAY_BITS) | np.maximum(days - self.days, 0), side='left')
+        ends = np.searchsorted(keys, (values << DAY_BITS) | np.minimum(days + self.days, DAY_LIMIT - 1), side='right')
+        counts = ends - starts
+        rows = np.repeat(np.arange(len(values)), counts)
+        # Positions of every range, concatenated: each range's start plus an offset within it
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, positions[np.repeat(starts, counts) + offsets]
+
+    @timed('duplicates.match')
+    def match(self, rows, before=None):
+        """Probable duplicates of rows (a standardized upload, in master.csv column order) among ledger rows before position before.
+
+        Each ledger row is matched to at most one upload row, best score first. Returns
+        dicts with the upload row, the ledger row, a 0-1 score, how many days apart they
+        are and whether the amount differs.
+        """
+        if rows.empty or before == 0:
+            return []
+        # Rows appended from before on can't match, so indexing them is left to a later refresh
+        if before is None or before > self.indexed_rows:
+            self.refresh()
+        with self.lock:
+            limit = self.indexed_rows if before is None else min(before, self.indexed_rows)
+            days = day_numbers(to_date_keys(rows.iloc[:, 0]))
+            dated = np.flatnonzero((days >= 0) & (days < DAY_LIMIT))
+            if not len(dated) or not limit:
+                return []
+            amounts = cents(rows.iloc[:, 1])
+            descriptions = normalize_descriptions(rows.iloc[:, 2]).tolist()
+            names = merchant_names(rows.iloc[:, 2])
+            merchant_codes = np.array([self.merchants.codes.get(name, NO_MERCHANT) if name else NO_MERCHANT for name in names], dtype=np.int64)
+            card_codes = np.array([self.cards.codes.get(card, -1) for card in rows.iloc[:, 4].fillna('').astype(str)], dtype=np.int32)
+
+            amount_rows, amount_positions = self.candidates('amount', amounts[dated], days[dated])
+            with_merchant = dated[merchant_codes[dated] != NO_MERCHANT]
+            merchant_rows, merchant_positions = self.candidates('merchant', merchant_codes[with_merchant], days[with_merchant])
+            pairs = pd.DataFrame({
+                'row': np.concatenate([dated[amount_rows], with_merchant[merchant_rows]]),
+                'position': np.concatenate([amount_positions, merchant_positions]),
+            }).drop_duplicates()
+            pairs = pairs[pairs['position'].to_numpy() < limit]
+
+            scored = self.score(pairs['row'].to_numpy(), pairs['position'].to_numpy(), amounts, days, descriptions,
+                                merchant_codes, card_codes)
+
+        matches = []
+        matched_rows, matched_positions = set(), set()
+        for score, row, position in sorted(scored, key=lambda match: (-match[0], match[1], match[2])):
+            if row in matched_rows or position in matched_positions:
+                continue
+            matched_rows.add(row)
+            matched_positions.add(position)
+            matches.append((row, position, score))
+        if not matches:
+            return []
+
+        matches.sort()
+        upload_rows = rows.iloc[[row for row, _, _ in matches], :-2]
+        ledger_rows = self.ledger.rows_at([position for _, position, _ in matches])
+        return [
+            {"row": upload_row, "match": ledger_row, "score": round(score, 3),
+             "days_apart": int(abs(days[row] - self.day_keys[position])), "amount_changed": bool(amounts[row] != self.cents[position])}
+            for (row, position, score), upload_row, ledger_row in zip(matches, to_records(upload_rows), ledger_rows)
+        ]
+
+    def score(self, rows, positions, amounts, days, descriptions, merchant_codes, card_codes):
+        """(score, row, position) for the candidate pairs that are probably one transaction; scores are 0-1."""
+        amount, ledger_amount = amounts[rows], self.cents[positions]
+        same_amount = amount == ledger_amount
+        description_codes = np.array([self.descriptions.codes.get(description, -1) for description in descriptions], dtype=np.int64)
+        same_description = description_codes[rows] == self.description_codes[positions]
+        larger = np.maximum(np.abs(amount), np.abs(ledger_amount))
+        settled = (~same_amount & same_description & (card_codes[rows] == self.card_codes[positions])
+                   & ((amount < 0) == (ledger_amount < 0)) & (amount != 0)
+                   & (np.abs(amount - ledger_amount) <= NEAR_DUPLICATE_AMOUNT_SHARE * larger))
+
+        similarity = np.where(same_description, 1.0, 0.0)
+        # Only a same-amount pair with differing descriptions needs its descriptions compared
+        for i in np.flatnonzero(same_amount & ~same_description):
+            row, position = rows[i], positions[i]
+            matcher = difflib.SequenceMatcher(None, descriptions[row], self.descriptions.values[self.description_codes[position]], autojunk=False)
+            similarity[i] = matcher.ratio() if matcher.quick_ratio() >= NEAR_DUPLICATE_SIMILARITY else 0.0
+            if merchant_codes[row] != NO_MERCHANT and merchant_codes[row] == self.merchant_codes[position]:
+                similarity[i] = max(similarity[i], NEAR_DUPLICATE_SIMILARITY)
+        likely = (same_amount | settled) & (similarity >= NEAR_DUPLICATE_SIMILARITY)
+
+        # Closer dates and an unchanged amount make a duplicate more likely
+        day_penalty = 0.05 * np.abs(days[rows] - self.day_keys[positions]) / max(self.days, 1)
+        amount_penalty = np.where(same_amount, 0.0, 0.1 * np.abs(amount - ledger_amount) / np.maximum(larger, 1))
+        scores = np.maximum(0.0, similarity - day_penalty - amount_penalty)
+        return list(zip(scores[likely].tolist(), rows[likely].tolist(), positions[likely].tolist()))
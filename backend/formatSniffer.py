@@ -0,0 +1,264 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from dateutil import parser
+from typing import List, Optional
+
+from transformer import CANDIDATE_DATE_FORMATS
+
+SNIFF_BYTES = 8192
+SNIFF_MAX_ROWS = 50
+PROFILE_CACHE_FILE = 'format_profiles.json'
+# Share of sampled data rows a profile must read cleanly to count as a match
+MIN_FIT_RATIO = 0.9
+AMOUNT_KEYWORDS = ('amount', 'amt', 'debit', 'credit', 'value', 'total')
+DESCRIPTION_KEYWORDS = ('desc', 'payee', 'merchant', 'memo', 'detail', 'narrative', 'name')
+CATEGORY_KEYWORDS = ('categ',)
+AMOUNT_STRIP = re.compile(r'[\s$€£,()]')
+
+def read_sample(source, size=SNIFF_BYTES) -> bytes:
+    """First `size` bytes of an upload (bytes or a seekable file), leaving a file's position unchanged."""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[:size])
+    position = source.tell()
+    data = source.read(size)
+    source.seek(position)
+    return data
+
+def is_amount(value: str) -> bool:
+    value = AMOUNT_STRIP.sub('', value).lstrip('+-')
+    if not value:
+        return False
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+def is_date(value: str, date_format: Optional[str] = None) -> bool:
+    value = value.strip()
+    if not value:
+        return False
+    for candidate in ([date_format] if date_format else CANDIDATE_DATE_FORMATS):
+        try:
+            datetime.strptime(value, candidate)
+            return True
+        except ValueError:
+            continue
+    # Other textual dates still import through Transformer.standardize_date, but bare numbers aren't dates
+    if date_format or is_amount(value):
+        return False
+    try:
+        parser.parse(value)
+        return True
+    except (ValueError, OverflowError):
+        return False
+
+def cell_type(value: str) -> str:
+    """'E'mpty, 'D'ate, 'N'umber or 'T'ext."""
+    if not value.strip():
+        return 'E'
+    if is_date(value):
+        return 'D'
+    if is_amount(value):
+        return 'N'
+    return 'T'
+
+class FormatSample:
+    """The first few KB of an upload split into CSV rows, with its table layout worked out."""
+    def __init__(self, data: bytes):
+        text = data.decode('utf-8-sig', errors='ignore')
+        lines = text.splitlines()
+        # The last line of a truncated sample may be cut off mid-row
+        if len(data) >= SNIFF_BYTES and len(lines) > 1:
+            lines = lines[:-1]
+        self.rows = list(csv.reader(lines))
+
+        field_counts = Counter(len(row) for row in self.rows if any(cell.strip() for cell in row))
+        self.field_count = field_counts.most_common(1)[0][0] if field_counts else 0
+        # Lines before the first row with the table's field count are preamble (skip_rows)
+        self.skip_rows = next((i for i, row in enumerate(self.rows) if len(row) == self.field_count), 0)
+        table = [row for row in self.rows[self.skip_rows:] if any(cell.strip() for cell in row)]
+
+        self.header = False
+        if len(table) > 1:
+            first_types = {cell_type(cell) for cell in table[0]}
+            next_types = {cell_type(cell) for row in table[1:4] for cell in row}
+            self.header = not first_types & {'D', 'N'} and bool(next_types & {'D', 'N'})
+        self.header_cells = [cell.strip().lower() for cell in table[0]] if self.header else None
+        self.data_rows = table[1:] if self.header else table
+        self.data_rows = self.data_rows[:SNIFF_MAX_ROWS]
+
+    def column_types(self) -> List[str]:
+        """Most common non-empty cell type per column ('E' if a column is always empty)."""
+        types = []
+        for col in range(self.field_count):
+            counts = Counter(cell_type(row[col]) for row in self.data_rows if col < len(row))
+            counts.pop('E', None)
+            types.append(counts.most_common(1)[0][0] if counts else 'E')
+        return types
+
+    def fingerprint(self) -> str:
+        """Stable id for the file's layout: preamble length plus its header, or column types without one."""
+        shape = [self.skip_rows, self.field_count, self.header_cells if self.header else self.column_types()]
+        return hashlib.md5(json.dumps(shape).encode('utf-8')).hexdigest()
+
+    def fit(self, profile) -> float:
+        """Share of sampled data rows that a config.json profile reads with a valid date and amount.
+
+        A blank amount is allowed (split debit/credit columns) as long as some row has one.
+        """
+        skip_rows = profile.get('skip_rows', 0)
+        date_col, amount_col = profile['date_col'], profile['amount_col']
+        if profile.get('header', False):
+            # The row the profile takes as its header must not hold data, or the profile is misaligned
+            header_row = self.rows[skip_rows] if skip_rows < len(self.rows) else []
+            if any(col < len(header_row) and cell_type(header_row[col]) in ('D', 'N') for col in (date_col, amount_col)):
+                return 0.0
+            skip_rows += 1
+        rows = [row for row in self.rows[skip_rows:] if any(cell.strip() for cell in row)][:SNIFF_MAX_ROWS]
+        if not rows:
+            return 0.0
+        needed = max(col for col in (date_col, amount_col, profile['description_col'], profile.get('category_col')) if col is not None) + 1
+        wide_rows = [row for row in rows if len(row) >= needed]
+        if not any(is_amount(row[amount_col]) for row in wide_rows):
+            return 0.0
+        good = sum(
+            1 for row in wide_rows
+            if is_date(row[date_col], profile.get('date_format'))
+            and (is_amount(row[amount_col]) or not row[amount_col].strip())
+        )
+        return good / len(rows)
+
+    def infer_profile(self) -> Optional[dict]:
+        """Proposes a config.json profile from sample values, or None if no date and amount columns stand out."""
+        if not self.data_rows:
+            return None
+        types = self.column_types()
+        headers = self.header_cells or [''] * self.field_count
+
+        def values(col):
+            return [row[col] for row in self.data_rows if col < len(row) and row[col].strip()]
+
+        def share(col, check):
+            """Share of the column's non-empty values passing check, or 0 if it is mostly empty."""
+            col_values = values(col)
+            if len(col_values) < len(self.data_rows) / 2:
+                return 0.0
+            return sum(1 for value in col_values if check(value)) / len(col_values)
+
+        def keyword(col, words):
+            return any(word in headers[col] for word in words)
+
+        def distinct(col):
+            return len({row[col] for row in self.data_rows if col < len(row)})
+
+        date_scores = {col: share(col, is_date) for col in range(self.field_count) if types[col] == 'D'}
+        if not date_scores or max(date_scores.values()) < MIN_FIT_RATIO:
+            return None
+        date_col = max(date_scores, key=lambda col: (date_scores[col], -col))
+
+        # Prefer a column named like an amount, then one with cents, then the most varied
+        amount_cols = [col for col in range(self.field_count) if col != date_col and share(col, is_amount) >= MIN_FIT_RATIO]
+        if not amount_cols:
+            return None
+        amount_col = max(amount_cols, key=lambda col: (
+            keyword(col, AMOUNT_KEYWORDS), share(col, lambda value: '.' in value), distinct(col), -col
+        ))
+
+        text_cols = [col for col in range(self.field_count) if types[col] == 'T']
+        if not text_cols:
+            return None
+        description_col = max(text_cols, key=lambda col: (keyword(col, DESCRIPTION_KEYWORDS), distinct(col), -col))
+        category_col = next((col for col in text_cols if col != description_col and keyword(col, CATEGORY_KEYWORDS)), None)
+
+        date_values = values(date_col)
+        date_format = next(
+            (candidate for candidate in CANDIDATE_DATE_FORMATS if all(is_date(value, candidate) for value in date_values)),
+            None
+        )
+        profile = {
+            "date_col": date_col,
+            "amount_col": amount_col,
+            "description_col": description_col,
+            "category_col": category_col,
+            "header": self.header,
+            "skip_rows": self.skip_rows,
+        }
+        if date_format:
+            profile["date_format"] = date_format
+        return profile
+
+
+class FormatSniffer:
+    """Matches uploads to config.json card profiles from their first few KB.
+
+    Each confirmed match is cached by the sample's layout fingerprint, so the
+    next upload with that layout only re-checks the remembered profile. The
+    cache is saved to PROFILE_CACHE_FILE and dropped when config.json changes.
+    """
+    def __init__(self, card_config, cache_file=PROFILE_CACHE_FILE):
+        self.card_config = card_config
+        self.cache_file = cache_file
+        self.config_key = hashlib.md5(json.dumps(card_config, sort_keys=True).encode('utf-8')).hexdigest()
+        self.lock = threading.Lock()
+        self.profiles = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                if cached.get('config') == self.config_key:
+                    self.profiles = cached.get('profiles', {})
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Ignoring unreadable format cache {cache_file}: {e}")
+
+    def sniff(self, source) -> dict:
+        """Detects the card for an upload.
+
+        Returns a dict with 'card' (None when no profile fits, or several fit equally
+        well), 'fingerprint', the fitting 'candidates' best first, and a
+        'proposed_profile' for unknown layouts.
+        """
+        sample = FormatSample(read_sample(source))
+        fingerprint = sample.fingerprint()
+        result = {"card": None, "fingerprint": fingerprint, "cached": False, "candidates": [], "proposed_profile": None}
+
+        with self.lock:
+            cached_card = self.profiles.get(fingerprint)
+        if cached_card in self.card_config and sample.fit(self.card_config[cached_card]) >= MIN_FIT_RATIO:
+            result.update(card=cached_card, cached=True, candidates=[cached_card])
+            return result
+
+        scores = {card: sample.fit(profile) for card, profile in self.card_config.items()}
+        result["candidates"] = sorted((card for card, score in scores.items() if score >= MIN_FIT_RATIO), key=lambda card: -scores[card])
+        # A tie for the best fit is left to the user rather than decided by config.json order
+        best = [card for card in result["candidates"] if scores[card] == scores[result["candidates"][0]]]
+        if len(best) == 1:
+            result["card"] = best[0]
+            self.remember(fingerprint, result["card"])
+        elif not best:
+            result["proposed_profile"] = sample.infer_profile()
+        return result
+
+    def check(self, source, card) -> Optional[dict]:
+        """Returns None if the upload fits the chosen card, otherwise the sniff result for it."""
+        sample = FormatSample(read_sample(source))
+        if sample.fit(self.card_config[card]) >= MIN_FIT_RATIO:
+            self.remember(sample.fingerprint(), card)
+            return None
+        return self.sniff(source)
+
+    def remember(self, fingerprint, card):
+        with self.lock:
+            if self.profiles.get(fingerprint) == card:
+                return
+            self.profiles[fingerprint] = card
+            temp_file = self.cache_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump({"config": self.config_key, "profiles": self.profiles}, f, indent=2)
+            os.replace(temp_file, self.cache_file)
@@ -0,0 +1,86 @@
+import os
+import numpy as np
+
+DIGEST_DTYPE = 'S16'
+MERGE_THRESHOLD = 65536
+FILE_MAGIC = b'SSHIDX01'
+HEADER_SIZE = 16
+
+def key_to_digest(hash_key):
+    """Converts a master.csv Hash value (decimal md5) to its 16-byte digest, or None if it is not one."""
+    try:
+        return int(hash_key).to_bytes(16, 'big')
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+class HashIndex:
+    """Compact set of 16-byte md5 digests used for duplicate detection.
+
+    Digests live in a sorted fixed-width array, optionally memory-mapped from
+    disk, and are found by binary search. Newly added digests sit in a small
+    set until MERGE_THRESHOLD of them are merged into the array.
+    """
+    def __init__(self, digests=None):
+        if digests is None:
+            self.sorted_digests = np.empty(0, dtype=DIGEST_DTYPE)
+        else:
+            self.sorted_digests = np.unique(np.fromiter(digests, dtype=DIGEST_DTYPE))
+        self.recent = set()
+
+    def __len__(self):
+        return len(self.sorted_digests) + len(self.recent)
+
+    def __contains__(self, digest):
+        return bool(self.contains([digest])[0])
+
+    def contains(self, digests) -> np.ndarray:
+        """Returns a boolean mask of which digests are in the index."""
+        digests = np.asarray(digests, dtype=DIGEST_DTYPE)
+        found = np.zeros(len(digests), dtype=bool)
+        if len(self.sorted_digests):
+            positions = np.searchsorted(self.sorted_digests, digests)
+            in_range = positions < len(self.sorted_digests)
+            found[in_range] = self.sorted_digests[positions[in_range]] == digests[in_range]
+        if self.recent:
+            found |= np.fromiter((digest in self.recent for digest in digests.tolist()), dtype=bool, count=len(digests))
+        return found
+
+    def add(self, digests) -> int:
+        """Adds digests not already present. Returns how many were added."""
+        digests = np.asarray(digests, dtype=DIGEST_DTYPE)
+        new_digests = np.unique(digests[~self.contains(digests)])
+        self.recent.update(new_digests.tolist())
+        if len(self.recent) >= MERGE_THRESHOLD:
+            self.merge()
+        return len(new_digests)
+
+    def merge(self):
+        if self.recent:
+            recent = np.asarray(sorted(self.recent), dtype=DIGEST_DTYPE)
+            self.sorted_digests = np.union1d(self.sorted_digests, recent)
+            self.recent = set()
+
+    def save(self, path, ledger_rows):
+        """Writes the index with the ledger row count it was built from, so stale files can be detected."""
+        self.merge()
+        temp_file = path + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(FILE_MAGIC)
+            f.write(int(ledger_rows).to_bytes(8, 'little'))
+            f.write(self.sorted_digests.tobytes())
+        os.replace(temp_file, path)
+
+    @classmethod
+    def load(cls, path, ledger_rows):
+        """Memory-maps a saved index. Returns None if it is missing or was built for a different ledger size."""
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE:
+            return None
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if header[:8] != FILE_MAGIC or int.from_bytes(header[8:], 'little') != ledger_rows:
+            return None
+
+        index = cls()
+        if os.path.getsize(path) > HEADER_SIZE:
+            index.sorted_digests = np.memmap(path, dtype=DIGEST_DTYPE, mode='r', offset=HEADER_SIZE)
+        return index
@@ -1,34 +1,136 @@
-import json
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
+import asyncio
+import contextvars
+import multiprocessing
+import os
+import time
+import zipfile
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from datetime import date
+from fastapi import Depends, FastAPI, UploadFile, File, Form, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+from googleapiclient.errors import HttpError
 from io import BytesIO
 from pydantic import BaseModel
 from typing import List, Optional
 
-from transformer import Transformer, precheck_hash_dupe
-from masterUtil import masterUtil
-from sheetUtil import authenticate_google_sheets, append_row_to_sheet
+from transformer import Transformer, import_uploads, prepare_upload
+from masterUtil import MASTER_COLUMNS, SORT_FIELDS, SYNC_PENDING
+from formatSniffer import SNIFF_BYTES
+from searchIndex import SEARCH_SORT_FIELDS
+from rulesEngine import RULES_FILE, RulesEngine
+from sheetUtil import SheetsClient, authenticate_google_sheets, get_row, unique_items
+from metrics import registry, profiling, LEDGER_ROWS, RESIDENT_TENANTS, SYNC_QUEUE_DEPTH
+from analytics import ANALYTICS_DIMENSIONS, parse_month
+from uploadCache import REUSED_MESSAGE
+from tenants import MAX_RESIDENT_TENANTS, TENANTS_DIR, Tenant, Tenants
+from syncWorker import SYNC_BURST, SYNC_RATE_PER_SECOND, TokenBucket
 
 google_service = None
-card_config = {}
+executor = None
+import_pool = None
+# Sheets write rate limit shared by the sync workers of all tenants
+sync_bucket = None
+# Single-tenant mode: the ledger and configuration in the working directory
+default_tenant = None
+# Multi-tenant mode (TENANTS_DIR set): tenants loaded per request by their X-Tenant header
+tenants = None
+STREAM_THRESHOLD_BYTES = 20 * 1024 * 1024
+MAX_PAGE_SIZE = 5000
+STATUS_VALUES = {"pending": 0, "completed": 1, "ignored": -1, "syncing": SYNC_PENDING, "all": None}
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 8))
+IMPORT_PROCESSES = int(os.getenv('IMPORT_PROCESSES', os.cpu_count() or 1))
+
+async def run_blocking(func, *args):
+    """Runs blocking pandas, ledger or Sheets work on the bounded worker pool instead of the event loop."""
+    # A copy of the request's context carries its profiling state into the worker thread
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(contextvars.copy_context().run, func, *args))
+
+def transformer_kwargs(tenant, card):
+    """Transformer arguments for a card key from the tenant's config.json."""
+    config_for_card = tenant.card_config[card]
+    return dict(
+        card_name=config_for_card.get('display_name', card),
+        date_col=config_for_card['date_col'],
+        amount_col=config_for_card['amount_col'],
+        description_col=config_for_card['description_col'],
+        category_col=config_for_card.get('category_col'),
+        header=config_for_card.get('header', False),
+        skip_rows=config_for_card.get('skip_rows', 0),
+        date_format=config_for_card.get('date_format')
+    )
+
+def expand_upload(tenant, file_name, file_bytes, card):
+    """Returns (file name, bytes, card) for an upload, one per CSV member if it is a zip archive.
+
+    Archive members inside a folder named after a card key use that card; the rest use the archive's card
+    (None for auto-detection).
+    """
+    if not zipfile.is_zipfile(BytesIO(file_bytes)):
+        return [(file_name, file_bytes, card)]
+    files = []
+    with zipfile.ZipFile(BytesIO(file_bytes)) as archive:
+        for member in archive.infolist():
+            parts = member.filename.split('/')
+            if member.is_dir() or parts[0] == '__MACOSX' or not member.filename.lower().endswith('.csv'):
+                continue
+            member_card = parts[0] if len(parts) > 1 and parts[0] in tenant.card_config else card
+            files.append((f"{file_name}/{member.filename}", archive.read(member), member_card))
+    return files
+
+async def queue_routed(tenant, items):
+    """Queues rows routed by rules for the background Google Sheets sync, skipping rows no longer pending.
+
+    Returns how many were queued.
+    """
+    if not items:
+        return 0
+    if not tenant.sync_worker:
+        print(f"Google Sheets unavailable; {len(items)} rule-routed rows stay pending.")
+        return 0
+    queued = await run_blocking(tenant.sync_worker.enqueue_pending, items)
+    if queued:
+        tenant.sync_worker.notify()
+    return len(queued)
+
+def plan_pending_routes(tenant, engine):
+    """Matches every pending row against the rules. Returns (pending rows, matches, hashes to ignore, sync items)."""
+    rows, _, _ = tenant.ledger.query_rows(status=0)
+    pending = pd.DataFrame(rows, columns=["index"] + MASTER_COLUMNS).set_index("index")
+    positions = engine.match(pending)
+    ignore_mask, items = engine.route(pending, positions)
+    matched = [
+        {"hash": row["Hash"], "description": row["Description"], "rule": engine.rules[position].name,
+         "target": engine.rules[position].target}
+        for row, position in zip(rows, positions) if position >= 0
+    ]
+    return rows, matched, pending.loc[ignore_mask, "Hash"].tolist(), items
+
+def format_mismatch(tenant, file_name, sniffed, card=None):
+    """Error message for an upload that doesn't fit the chosen card (or any card, when card is None)."""
+    card_config = tenant.card_config
+    candidates = [card_config[candidate].get('display_name', candidate) for candidate in sniffed["candidates"]]
+    if card is None and candidates:
+        return f"'{file_name}' fits more than one card equally well: {', '.join(candidates)}. Pick one of them."
+    if card is None:
+        message = f"Could not detect the card format of '{file_name}'. Pick a card or add a profile to config.json."
+    else:
+        message = f"File '{file_name}' does not look like a {card_config[card].get('display_name', card)} statement."
+    if sniffed["card"]:
+        message += f" It matches {card_config[sniffed['card']].get('display_name', sniffed['card'])}."
+    elif candidates:
+        message += f" It matches {' or '.join(candidates)}."
+    return message
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global card_config, google_service
-    try:
-        with open('config.json', 'r') as f:
-            card_config = json.load(f)
-        print("Card configuration loaded successfully.")
-    except FileNotFoundError:
-        print("ERROR: config.json not found!")
-        card_config = {}
-    except json.JSONDecodeError:
-        print("ERROR: config.json is not valid JSON!")
-        card_config = {}
-
-    precheck_hash_dupe()
+    global google_service, executor, import_pool, sync_bucket, default_tenant, tenants
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix='sheetsync')
+    # spawn, not fork: the server already has threads running
+    import_pool = ProcessPoolExecutor(max_workers=IMPORT_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
     print("Authenticating Google Sheets...")
     google_service = authenticate_google_sheets()
     if google_service:
@@ -36,7 +138,44 @@ async def lifespan(app: FastAPI):
     else:
         print("ERROR: Failed to authenticate Google Sheets!")
         google_service = None
+    # The write quota belongs to the Google account, so every tenant's sync shares it
+    sync_bucket = TokenBucket(SYNC_RATE_PER_SECOND, SYNC_BURST)
+    # Cleared in case the app is started again in this process with the other mode
+    default_tenant, tenants = None, None
+    if TENANTS_DIR:
+        tenants = Tenants(TENANTS_DIR, executor, google_service, MAX_RESIDENT_TENANTS, sync_bucket=sync_bucket)
+        print(f"Serving the tenants in {TENANTS_DIR}, up to {tenants.max_resident} loaded at a time.")
+    else:
+        default_tenant = Tenant('default')
+        await default_tenant.open(executor, google_service, sync_bucket=sync_bucket)
     yield
+    if tenants is not None:
+        await tenants.close_all()
+    else:
+        await default_tenant.close(executor)
+    import_pool.shutdown(wait=True)
+    executor.shutdown(wait=True)
+    if isinstance(google_service, SheetsClient):
+        google_service.close()
+
+async def current_tenant(x_tenant: Optional[str] = Header(None)):
+    """The tenant named by the X-Tenant header in multi-tenant mode, otherwise the only one.
+
+    A tenant is loaded by its first request and can't be evicted until the request is done.
+    """
+    if tenants is None:
+        yield default_tenant
+        return
+    if not x_tenant:
+        raise HTTPException(status_code=400, detail="The X-Tenant header is required.")
+    try:
+        tenant = await tenants.acquire(x_tenant)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Tenant '{x_tenant}' not found.")
+    try:
+        yield tenant
+    finally:
+        tenants.release(tenant)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -53,42 +192,84 @@ def read_root():
     return {"message": "FastAPI is working!"}
 
 @app.get("/getCardOptions")
-async def get_card_options():
-    global card_config
-    if not card_config:
+async def get_card_options(tenant: Tenant = Depends(current_tenant)):
+    if not tenant.card_config:
          return []
     options = [
         {"value": key, "label": details.get("display_name", key)}
-        for key, details in card_config.items()
+        for key, details in tenant.card_config.items()
     ]
     return options
 
+@app.post("/sniffFormat")
+async def sniff_format(file: UploadFile = File(...), tenant: Tenant = Depends(current_tenant)):
+    """Detects which config.json card an upload belongs to from its first few KB.
+
+    Unknown layouts get a proposed profile (column mapping) that can be added to config.json.
+    """
+    sniffed = await run_blocking(tenant.format_sniffer.sniff, await file.read(SNIFF_BYTES))
+    if sniffed["card"]:
+        sniffed["display_name"] = tenant.card_config[sniffed["card"]].get("display_name", sniffed["card"])
+    return sniffed
+
 @app.post("/addMaster")
-async def upload_csv(file: UploadFile = File(...), card: str = Form(...)):
-    global card_config
-    if card not in card_config:
+async def upload_csv(file: UploadFile = File(...), card: Optional[str] = Form(None), stream: bool = Form(False),
+                     profile: bool = Form(False), tenant: Tenant = Depends(current_tenant)):
+    """Imports one statement. With profile, the response includes a per-stage timing breakdown.
+
+    New rows that probably repeat an existing transaction (the same purchase on another
+    card or statement export) are imported and listed in probable_duplicates. A file
+    uploaded before with the same card settings isn't parsed again.
+    """
+    return await profiled_import(tenant, file, card, stream, profile)
+
+async def profiled_import(tenant, file, card, stream, profile):
+    with profiling(profile) as upload_profile:
+        response = await import_upload(tenant, file, card, stream)
+    if upload_profile is not None:
+        response["profile"] = upload_profile.report(rows=response.pop("rows_read"))
+    else:
+        response.pop("rows_read")
+    return JSONResponse(content=response)
+
+async def import_upload(tenant, file, card, stream):
+    card_config = tenant.card_config
+    if card and card not in card_config:
         raise HTTPException(
             status_code=400,
             detail=f"Configuration for card type '{card}' not found."
         )
 
+    # Check the first few KB against the card's profile (or detect the card) before parsing the whole file
+    if card:
+        sniffed = await run_blocking(tenant.format_sniffer.check, file.file, card)
+        if sniffed is not None:
+            raise HTTPException(status_code=400, detail=format_mismatch(tenant, file.filename, sniffed, card))
+    else:
+        sniffed = await run_blocking(tenant.format_sniffer.sniff, file.file)
+        if not sniffed["card"]:
+            raise HTTPException(status_code=400, detail=format_mismatch(tenant, file.filename, sniffed))
+        card = sniffed["card"]
+
     config_for_card = card_config[card]
-    contents = await file.read()
-    file_bytes = BytesIO(contents)
+    # Large uploads are streamed in chunks instead of being read into memory whole
+    stream = stream or (file.size or 0) > STREAM_THRESHOLD_BYTES
 
     processing_messages = []
 
     try:
-        transformer = Transformer(
-            card_name=config_for_card.get('display_name', card),
-            date_col=config_for_card['date_col'],
-            amount_col=config_for_card['amount_col'],
-            description_col=config_for_card['description_col'],
-            category_col=config_for_card.get('category_col'),
-            header=config_for_card.get('header', False),
-            skip_rows=config_for_card.get('skip_rows', 0)
-        )
-        success, processing_messages, duplicate_rows = transformer.reformat_csv(file_bytes)
+        transformer = Transformer(**transformer_kwargs(tenant, card), rules=tenant.rules_engine, near_duplicates=tenant.near_duplicate_index,
+                                  hashes=tenant.hashes)
+        if stream:
+            success, processing_messages, duplicate_rows = await run_blocking(transformer.reformat_csv_stream, file.file, tenant.ledger)
+        else:
+            # Parsed and hashed once per distinct file and card settings; a repeat upload only runs the dedupe check
+            rows, digests, messages, _ = await run_blocking(tenant.upload_cache.prepare, transformer, await file.read(), transformer_kwargs(tenant, card))
+            success, processing_messages, duplicate_rows = await run_blocking(transformer.import_prepared, rows, digests, messages, tenant.ledger)
+        if success and transformer.routed:
+            if not tenant.sync_worker:
+                processing_messages.append("Google Sheets is unavailable, so rule-routed rows were left pending.")
+            await queue_routed(tenant, transformer.routed)
 
         main_message = f"File '{file.filename}' processed for {config_for_card.get('display_name', card)}."
         if not success:
@@ -97,13 +278,13 @@ async def upload_csv(file: UploadFile = File(...), card: str = Form(...)):
         if success and processing_messages and ("No new transactions found" in processing_messages[-1] or "Appended 0 new rows" in processing_messages[-1]):
              main_message = f"File '{file.filename}' processed. No new transactions were added."
 
-        return JSONResponse(
-            content={
-                "message": main_message,
-                "details": processing_messages,
-                "duplicate_rows": duplicate_rows
-            }
-        )
+        return {
+            "message": main_message,
+            "details": processing_messages,
+            "duplicate_rows": duplicate_rows,
+            "probable_duplicates": transformer.probable_duplicates,
+            "rows_read": transformer.rows_checked,
+        }
 
     except Exception as e:
         print(f"ERROR processing file {file.filename} for card {card}: {e}")
@@ -116,10 +297,368 @@ async def upload_csv(file: UploadFile = File(...), card: str = Form(...)):
             detail={"message": f"Failed to process file '{file.filename}'.", "details": processing_messages}
         )
 
+class UploadStart(BaseModel):
+    file_name: str
+    size: int
+    sha256: Optional[str] = None
+    card: Optional[str] = None
+
+@app.post("/addMaster/uploads")
+async def start_upload(request: UploadStart, tenant: Tenant = Depends(current_tenant)):
+    """Starts a chunked upload of a large statement.
+
+    Send the file's bytes with PUT /addMaster/uploads/{upload_id}?offset=N, chunk_bytes at
+    a time, then import it with POST /addMaster/uploads/{upload_id}/complete. With sha256,
+    starting the same file again returns the unfinished upload and its offset to resume from.
+    """
+    if request.card and request.card not in tenant.card_config:
+        raise HTTPException(status_code=400, detail=f"Configuration for card type '{request.card}' not found.")
+    if request.size <= 0:
+        raise HTTPException(status_code=400, detail="size must be the file's size in bytes.")
+    return await run_blocking(tenant.resumable_uploads.start, request.file_name, request.size, request.sha256, request.card)
+
+def upload_session(tenant, upload_id):
+    try:
+        return tenant.resumable_uploads.load(upload_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Upload '{upload_id}' not found.")
+
+@app.get("/addMaster/uploads/{upload_id}")
+async def upload_status(upload_id: str, tenant: Tenant = Depends(current_tenant)):
+    """The upload's size and offset: the next chunk starts at offset."""
+    return await run_blocking(upload_session, tenant, upload_id)
+
+@app.put("/addMaster/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int = Query(..., ge=0), tenant: Tenant = Depends(current_tenant)):
+    """Writes the request body at offset. A chunk for any other offset than the upload's current one gets 409."""
+    data = await request.body()
+    try:
+        offset = await run_blocking(tenant.resumable_uploads.write, upload_id, offset, data)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Upload '{upload_id}' not found.")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"upload_id": upload_id, "offset": offset}
+
+@app.post("/addMaster/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, stream: bool = Form(False), profile: bool = Form(False), tenant: Tenant = Depends(current_tenant)):
+    """Imports a fully sent upload like /addMaster, then deletes it. It is kept if the import fails."""
+    try:
+        session, path = await run_blocking(tenant.resumable_uploads.finish, upload_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Upload '{upload_id}' not found.")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    with open(path, 'rb') as f:
+        upload = UploadFile(f, size=session["size"], filename=session["file_name"])
+        response = await profiled_import(tenant, upload, session["card"], stream, profile)
+    await run_blocking(tenant.resumable_uploads.discard, upload_id)
+    return response
+
+@app.delete("/addMaster/uploads/{upload_id}")
+async def cancel_upload(upload_id: str, tenant: Tenant = Depends(current_tenant)):
+    await run_blocking(upload_session, tenant, upload_id)
+    await run_blocking(tenant.resumable_uploads.discard, upload_id)
+    return {"message": f"Upload '{upload_id}' deleted."}
+
+@app.post("/addMaster/batch")
+async def upload_csv_batch(files: List[UploadFile] = File(...), cards: List[str] = Form([]), tenant: Tenant = Depends(current_tenant)):
+    """Imports many statements at once, each tagged with a card key (cards[i] goes with files[i]).
+
+    Files without cards, or with an empty card, are matched to a card by format detection.
+    Zip archives are expanded. Files are parsed and hashed in parallel on the import
+    process pool, then deduplicated together and appended in a single write.
+    """
+    if not cards:
+        cards = [''] * len(files)
+    if len(cards) != len(files):
+        raise HTTPException(status_code=400, detail=f"Got {len(files)} files but {len(cards)} card keys.")
+    card_config = tenant.card_config
+    unknown = sorted(set(card for card in cards if card) - set(card_config))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Configuration for card type(s) {', '.join(unknown)} not found.")
+
+    started = time.perf_counter()
+    uploads = []
+    for file, card in zip(files, cards):
+        try:
+            uploads.extend(expand_upload(tenant, file.filename, await file.read(), card or None))
+        except zipfile.BadZipFile as e:
+            raise HTTPException(status_code=400, detail=f"Could not read archive '{file.filename}': {e}")
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No CSV files found in the upload.")
+
+    # Files that don't fit their card (or any card, when auto-detected) are reported without being parsed
+    loop = asyncio.get_running_loop()
+    prepared = [None] * len(uploads)
+    parsing = {}
+    cache_keys = {}
+    for position, (file_name, file_bytes, card) in enumerate(uploads):
+        sniffed = await run_blocking(tenant.format_sniffer.check, file_bytes, card) if card else await run_blocking(tenant.format_sniffer.sniff, file_bytes)
+        if card is None and sniffed["card"]:
+            card, sniffed = sniffed["card"], None
+        if sniffed is None:
+            cache_keys[position] = await run_blocking(tenant.upload_cache.key, file_bytes, transformer_kwargs(tenant, card))
+            cached = await run_blocking(tenant.upload_cache.get, cache_keys[position])
+            if cached is not None:
+                rows, digests, messages = cached
+                prepared[position] = {"file": file_name, "card": card_config[card].get('display_name', card), "rows": rows,
+                                      "digests": digests, "messages": messages + [REUSED_MESSAGE]}
+                continue
+            parsing[position] = loop.run_in_executor(import_pool, prepare_upload, transformer_kwargs(tenant, card), file_name, file_bytes)
+        else:
+            error = format_mismatch(tenant, file_name, sniffed, card)
+            prepared[position] = {"file": file_name, "card": card_config[card].get('display_name', card) if card else None,
+                                  "error": error, "messages": [error], "candidates": sniffed["candidates"],
+                                  "proposed_profile": sniffed["proposed_profile"]}
+    for position, upload in zip(parsing, await asyncio.gather(*parsing.values())):
+        prepared[position] = upload
+        if "error" not in upload:
+            await run_blocking(tenant.upload_cache.put, cache_keys[position], upload["rows"], upload["digests"], upload["messages"])
+    success, summaries, routed = await run_blocking(import_uploads, prepared, tenant.ledger, tenant.rules_engine, tenant.near_duplicate_index,
+                                                    tenant.hashes)
+    queued = await queue_routed(tenant, routed)
+    for summary, upload in zip(summaries, prepared):
+        if upload.get("candidates"):
+            summary["candidates"] = upload["candidates"]
+        if upload.get("proposed_profile"):
+            summary["proposed_profile"] = upload["proposed_profile"]
+
+    appended = sum(summary["appended"] for summary in summaries)
+    duplicates = sum(summary["duplicates"] for summary in summaries)
+    failed = sum(1 for summary in summaries if "error" in summary)
+    message = f"Processed {len(summaries)} files: {appended} new transactions, {duplicates} duplicates."
+    if failed:
+        message += f" {failed} files could not be read."
+    if not success and not failed:
+        message = "Batch import failed while writing to the master ledger. See details."
+    return {
+        "message": message,
+        "appended": appended,
+        "duplicates": duplicates,
+        "failed": failed,
+        "routed": queued,
+        "seconds": round(time.perf_counter() - started, 3),
+        "files": summaries,
+    }
+
 @app.get("/getMaster")
-async def get_master():
-    util = masterUtil()
-    return util.get_rows()
+async def get_master(
+    status: str = "pending",
+    card: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    amount_min: Optional[float] = None,
+    amount_max: Optional[float] = None,
+    sort: str = "index",
+    order: str = "asc",
+    limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Pending rows by default, with filters, sorting and cursor pagination.
+
+    With ?since=<version>, returns only rows added or changed since that version
+    (any status) so the client can patch its table; 'reset' tells it to reload.
+    """
+    if status not in STATUS_VALUES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(STATUS_VALUES)}.")
+    if sort not in SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(SORT_FIELDS)}.")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'.")
+
+    if since:
+        rows, version, reset = await run_blocking(tenant.ledger.changes_since, since)
+        if not reset:
+            return {"rows": rows, "next_cursor": None, "version": version, "reset": False}
+
+    version = await run_blocking(tenant.ledger.version_token)
+    try:
+        rows, next_cursor, total = await run_blocking(
+            partial(
+                tenant.ledger.query_rows,
+                status=STATUS_VALUES[status],
+                card=card,
+                date_from=date_from.isoformat() if date_from else None,
+                date_to=date_to.isoformat() if date_to else None,
+                amount_min=amount_min,
+                amount_max=amount_max,
+                sort=sort,
+                descending=order == "desc",
+                limit=limit,
+                cursor=cursor,
+            )
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return {"rows": rows, "next_cursor": next_cursor, "total": total, "version": version, "reset": bool(since)}
+
+@app.get("/search")
+async def search(
+    q: Optional[str] = None,
+    card: List[str] = Query([]),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    amount_min: Optional[float] = None,
+    amount_max: Optional[float] = None,
+    sort: str = "date",
+    order: str = "desc",
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Searches every transaction in the ledger, whatever its status.
+
+    Each word of q must match the start of a word in the description (case-insensitive).
+    card may be repeated and takes card keys or display names.
+    """
+    if sort not in SEARCH_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {', '.join(SEARCH_SORT_FIELDS)}.")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'.")
+
+    started = time.perf_counter()
+    cards = [tenant.card_config[name].get("display_name", name) if name in tenant.card_config else name for name in card]
+    rows, total = await run_blocking(
+        partial(
+            tenant.search_index.search,
+            text=q,
+            cards=cards,
+            date_from=date_from.isoformat() if date_from else None,
+            date_to=date_to.isoformat() if date_to else None,
+            amount_min=amount_min,
+            amount_max=amount_max,
+            sort=sort,
+            descending=order == "desc",
+            limit=limit,
+            offset=offset,
+        )
+    )
+    return {"rows": rows, "total": total, "took_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+def analytics_filters(tenant, status, card=None, category=None, sheet=None, month_from=None, month_to=None):
+    """Validated keyword arguments for SpendingAnalytics queries."""
+    if status is not None and status not in STATUS_VALUES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(STATUS_VALUES)}.")
+    for month in (month_from, month_to):
+        if month:
+            try:
+                parse_month(month)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+    filters = {"month_from": month_from, "month_to": month_to}
+    if status is not None:
+        filters["statuses"] = [value for value in STATUS_VALUES.values() if value is not None] if status == "all" else [STATUS_VALUES[status]]
+    if card is not None:
+        filters["card"] = tenant.card_config[card].get("display_name", card) if card in tenant.card_config else card
+    if category is not None:
+        filters["category"] = category
+    if sheet is not None:
+        filters["sheet"] = sheet
+    return filters
+
+@app.get("/analytics/totals")
+async def analytics_totals(
+    by: List[str] = Query([]),
+    status: Optional[str] = None,
+    card: Optional[str] = None,
+    category: Optional[str] = None,
+    sheet: Optional[str] = None,
+    month_from: Optional[str] = None,
+    month_to: Optional[str] = None,
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Total and count of transactions grouped by any of month, card, category and sheet (repeat by).
+
+    Pending, syncing and completed rows are counted unless status is given; ignored rows
+    only with status=ignored or status=all. sheet is where completed rows were sent.
+    Months are YYYY-MM.
+    """
+    unknown = [dimension for dimension in by if dimension not in ANALYTICS_DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"by must be from {', '.join(ANALYTICS_DIMENSIONS)}.")
+    filters = analytics_filters(tenant, status, card, category, sheet, month_from, month_to)
+    rows = await run_blocking(partial(tenant.spending_analytics.totals, by, **filters))
+    return {"rows": rows}
+
+@app.get("/analytics/balances")
+async def analytics_balances(
+    by: Optional[str] = None,
+    status: Optional[str] = None,
+    card: Optional[str] = None,
+    category: Optional[str] = None,
+    sheet: Optional[str] = None,
+    month_from: Optional[str] = None,
+    month_to: Optional[str] = None,
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Net total per month with the running balance after it, optionally per card, category or sheet."""
+    if by is not None and by not in ANALYTICS_DIMENSIONS[1:]:
+        raise HTTPException(status_code=400, detail=f"by must be one of {', '.join(ANALYTICS_DIMENSIONS[1:])}.")
+    filters = analytics_filters(tenant, status, card, category, sheet, month_from, month_to)
+    rows = await run_blocking(partial(tenant.spending_analytics.balances, by, **filters))
+    return {"rows": rows}
+
+@app.get("/analytics/merchants")
+async def analytics_merchants(limit: int = Query(10, ge=1, le=100), status: Optional[str] = None, card: Optional[str] = None,
+                              tenant: Tenant = Depends(current_tenant)):
+    """Merchants with the largest totals. Store numbers and reference codes are dropped from descriptions."""
+    filters = analytics_filters(tenant, status, card)
+    rows = await run_blocking(partial(tenant.spending_analytics.top_merchants, limit, statuses=filters.get("statuses"), card=filters.get("card")))
+    return {"rows": rows}
+
+class RoutingRule(BaseModel):
+    name: Optional[str] = None
+    keywords: List[str] = []
+    pattern: Optional[str] = None
+    card: Optional[str] = None
+    amount_min: Optional[float] = None
+    amount_max: Optional[float] = None
+    category: Optional[str] = None
+    target: str
+
+class RulesRequest(BaseModel):
+    rules: List[RoutingRule]
+
+@app.get("/rules")
+async def get_rules(tenant: Tenant = Depends(current_tenant)):
+    return {"rules": tenant.rules_engine.definitions}
+
+@app.put("/rules")
+async def put_rules(request: RulesRequest, tenant: Tenant = Depends(current_tenant)):
+    """Replaces the routing rules (first match wins) and saves them to rules.json."""
+    try:
+        engine = RulesEngine([rule.model_dump(exclude_defaults=True) for rule in request.rules], tenant.card_config, tenant.routes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await run_blocking(engine.save, tenant.path(RULES_FILE))
+    tenant.rules_engine = engine
+    return {"message": f"Saved {len(engine)} rules.", "rules": engine.definitions}
+
+@app.post("/rules/apply")
+async def apply_rules(dry_run: bool = False, tenant: Tenant = Depends(current_tenant)):
+    """Runs the routing rules over every pending row: ignore rules mark rows ignored, sheet rules queue them for sync.
+
+    With dry_run, returns what would happen without changing anything.
+    """
+    rules_engine = tenant.rules_engine
+    if not len(rules_engine):
+        return {"message": "No routing rules configured.", "ignored": 0, "routed": 0, "rows": []}
+
+    rows, matched, ignored_hashes, items = await run_blocking(plan_pending_routes, tenant, rules_engine)
+    if dry_run:
+        return {"message": f"{len(matched)} of {len(rows)} pending rows match a rule.",
+                "ignored": len(ignored_hashes), "routed": len(items), "rows": matched}
+
+    if items and not tenant.sync_worker:
+        raise HTTPException(status_code=503, detail="Google Sheets service unavailable.")
+    # Rows clicked or ignored since the plan was made keep their status
+    ignored = await run_blocking(tenant.ledger.record_pending_changes, [(hash, -1) for hash in ignored_hashes]) if ignored_hashes else []
+    routed = await queue_routed(tenant, items)
+    return {"message": f"Ignored {len(ignored)} rows and queued {routed} rows for Google Sheets.",
+            "ignored": len(ignored), "routed": routed, "rows": matched}
 
 class ItemDetail(BaseModel):
     hash: str
@@ -128,39 +667,126 @@ class ItemDetail(BaseModel):
     description: str
     category: Optional[str] = None
 
+class BatchItemDetail(ItemDetail):
+    sheetName: str
+
+class BatchCompletionRequest(BaseModel):
+    items: List[BatchItemDetail]
+
+@app.post("/updateCompletion/batch")
+async def update_completion_batch(request: BatchCompletionRequest, tenant: Tenant = Depends(current_tenant)):
+    sync_worker = tenant.sync_worker
+    if not google_service or not sync_worker:
+        raise HTTPException(status_code=503, detail="Google Sheets service unavailable.")
+
+    # An item sent twice is completed (and appended) once
+    items = unique_items([item.model_dump() for item in request.items])
+    # Claimed as the queue does, so completed, ignored, already queued and unknown rows aren't appended again
+    claimed = set(await run_blocking(tenant.ledger.record_pending_changes, [(item["hash"], SYNC_PENDING) for item in items]))
+    sheet_results = await sync_worker.append_now([item for item in items if item["hash"] in claimed])
+
+    succeeded = [hash for hash, ok in sheet_results.items() if ok]
+    if succeeded:
+        await run_blocking(tenant.sheet_targets.record, [(item["hash"], item["sheetName"]) for item in items if sheet_results.get(item["hash"])])
+        await run_blocking(tenant.ledger.update_completion_bulk, succeeded)
+        print(f"Updated completion for {len(succeeded)} hashes.")
+    unsent = [hash for hash, ok in sheet_results.items() if not ok]
+    if unsent:
+        await run_blocking(tenant.ledger.update_sync_failed, unsent)
+    known = await run_blocking(lambda: {item["hash"] for item in items if item["hash"] in claimed or tenant.ledger.has_hash(item["hash"])})
+
+    def error(hash):
+        if sheet_results.get(hash):
+            return None
+        if hash not in known:
+            return "Transaction not found."
+        return "Google Sheets append failed." if hash in claimed else "Transaction is no longer pending."
+
+    results = [
+        {"hash": item["hash"], "sheetName": item["sheetName"], "success": sheet_results.get(item["hash"], False), "error": error(item["hash"])}
+        for item in items
+    ]
+    failed = len(results) - sum(1 for result in results if result["success"])
+    return {
+        "message": f"Completed {len(results) - failed} of {len(results)} transactions.",
+        "completed": len(results) - failed,
+        "failed": failed,
+        "results": results
+    }
+
 @app.post("/updateCompletion/{sheetName}")
-async def update_completion(sheetName: str, request: ItemDetail):
-    global google_service
-    if not google_service:
+async def update_completion(sheetName: str, request: ItemDetail, tenant: Tenant = Depends(current_tenant)):
+    sync_worker = tenant.sync_worker
+    if not google_service or not sync_worker:
         raise HTTPException(status_code=503, detail="Google Sheets service unavailable.")
+    if not tenant.routes.names:
+        raise HTTPException(status_code=400, detail="No Google Sheets are configured; add a sheets.json for this tenant.")
+    if get_row(sheetName, request.transactionDate, request.amount, request.description, request.category, tenant.routes) is None:
+        raise HTTPException(status_code=400, detail=f"Unknown sheet '{sheetName}'.")
+
+    # The row is marked pending-sync now; the background worker appends it to the sheet
+    item = request.model_dump()
+    item['sheetName'] = sheetName
+    if not await run_blocking(sync_worker.enqueue, item):
+        if not await run_blocking(tenant.ledger.has_hash, request.hash):
+            raise HTTPException(status_code=404, detail=f"Transaction {request.hash} not found.")
+        raise HTTPException(status_code=409, detail=f"Transaction {request.hash} is no longer pending.")
+    sync_worker.notify()
+    print(f"Queued completion for hash: {request.hash}")
+    return {"message": "Completion queued for Google Sheets sync."}
+
+@app.get("/syncStatus")
+async def sync_status(tenant: Tenant = Depends(current_tenant)):
+    if not tenant.sync_worker:
+        raise HTTPException(status_code=503, detail="Google Sheets service unavailable.")
+    return tenant.sync_worker.status()
+
+@app.get("/metrics")
+async def metrics():
+    """Stage latency histograms and import/sync counters in the Prometheus text format.
+
+    In multi-tenant mode, ledger rows and the sync queue are summed over the loaded tenants.
+    """
+    resident = [default_tenant] if tenants is None else list(tenants.resident.values())
+    LEDGER_ROWS.set(sum(len(tenant.ledger) for tenant in resident))
+    SYNC_QUEUE_DEPTH.set(sum(len(tenant.sync_worker.outbox) for tenant in resident if tenant.sync_worker))
+    RESIDENT_TENANTS.set(len(resident))
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+class SheetRow(BaseModel):
+    sheet: str
+    row: int
+
+class ReconcileRequest(BaseModel):
+    delete_rows: List[SheetRow] = []
+
+@app.post("/reconcile")
+async def reconcile(repair: bool = False, full: bool = False, request: Optional[ReconcileRequest] = None,
+                    tenant: Tenant = Depends(current_tenant)):
+    """Checks completed rows against the Google Sheets and reports rows missing from or extra in them.
+
+    With repair, missing rows go back to pending. Extra rows are never deleted unless the body lists
+    them in delete_rows, and then only those still found extra. With full, every sheet is read from
+    the top instead of from the last run.
+    """
+    if not tenant.sheet_reconciler:
+        raise HTTPException(status_code=503, detail="Google Sheets service unavailable.")
+    delete_rows = [row.model_dump() for row in request.delete_rows] if request else None
+    try:
+        report = await run_blocking(tenant.sheet_reconciler.reconcile, repair, full, delete_rows)
+    except HttpError as err:
+        raise HTTPException(status_code=502, detail=f"Google Sheets error {err.resp.status} during reconciliation.")
+    print(f"Reconciled: {report['missing']} missing, {report['extra']} extra rows in Google Sheets.")
+    return report
 
-    data = append_row_to_sheet(
-        google_service,
-        sheetName,
-        request.transactionDate,
-        request.amount,
-        request.description,
-        request.category
-    )
-    if data:
-        util = masterUtil()
-        util.update_completion(request.hash)
-        print(f"Updated completion for hash: {request.hash}")
-        return {"message": "Completion updated successfully."}
-    else:
-        print(f"Google Sheet update failed for hash: {request.hash}")
-        raise HTTPException(
-            status_code=500,
-            detail="Failed to update Google Sheet. Completion status not updated."
-        )
-    
 @app.post("/updateIgnore/{hash}")
-async def update_ignore(hash: str):
-    util = masterUtil()
-    success = util.update_ignore(hash)
+async def update_ignore(hash: str, tenant: Tenant = Depends(current_tenant)):
+    success = await run_blocking(tenant.ledger.update_ignore, hash)
     if success:
         print(f"Successfully ignored {hash}")
         return {"message": "Ignored successfully."}
+    elif not await run_blocking(tenant.ledger.has_hash, hash):
+        raise HTTPException(status_code=404, detail=f"Transaction {hash} not found.")
     else:
         print(f"Failed to ignore {hash}")
         raise HTTPException(
@@ -1,11 +1,247 @@
+import base64
+import functools
+import json
+import os
+import threading
+import uuid
+import zlib
+import numpy as np
 import pandas as pd
 
+from metrics import timed
+from transformer import OUTPUT_DATE_FORMAT
+
+# Optional (it is in requirements.txt): without it the CSV ledger has no Parquet snapshot and parses all of master.csv
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+MASTER_COLUMNS = ['Transaction Date', 'Amount', 'Description', 'Category', 'Card Name', 'Hash', 'Completion']
+COMPACT_EVERY = 500
+SNAPSHOT_COMPRESSION = 'zstd'
+# Read and converted one row group at a time, so the whole Arrow table is never in memory next to the DataFrame
+SNAPSHOT_ROW_GROUP_ROWS = 100_000
+SNAPSHOT_METADATA_KEY = b'sheetsync'
+CRC_BLOCK_SIZE = 1024 * 1024
+# Completion value for rows queued for the background Google Sheets sync
+SYNC_PENDING = 2
+SORT_FIELDS = ('index', 'date', 'amount', 'description', 'card')
+
+def encode_cursor(value, index):
+    return base64.urlsafe_b64encode(json.dumps([value, index]).encode()).decode()
+
+def decode_cursor(cursor):
+    value, index = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, index
+
+def parse_version(token, epoch):
+    """Returns the change counter from a '<epoch>.<version>' token, or None if it belongs to another ledger instance."""
+    token_epoch, _, version = str(token).rpartition('.')
+    if token_epoch != epoch or not version.isdigit():
+        return None
+    return int(version)
+
+def to_date_keys(dates):
+    """Parses standardized 'Transaction Date' strings to datetime64 for date filters and sorting."""
+    return pd.to_datetime(pd.Series(dates, dtype=object), format=OUTPUT_DATE_FORMAT, errors='coerce').to_numpy()
+
+def to_records(df):
+    """Converts rows to JSON-safe dicts (missing values become None instead of NaN)."""
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+def snapshot_path(master_file):
+    return os.path.splitext(master_file)[0] + '.parquet'
+
+def file_crc(path, length):
+    """CRC32 of the first length bytes of path."""
+    crc = 0
+    with open(path, 'rb') as f:
+        while length > 0:
+            block = f.read(min(CRC_BLOCK_SIZE, length))
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            length -= len(block)
+    return crc
+
+def read_snapshot(master_file='master.csv', columns=None):
+    """Rows of master_file read from its Parquet snapshot, plus the CSV rows appended since it was written.
+
+    columns limits what is read (the snapshot also has a parsed 'date_key' column). Returns
+    (rows, number of them from the snapshot), or (None, 0) when there is no snapshot, pyarrow
+    is missing, or master_file changed other than by appends.
+    """
+    snapshot_file = snapshot_path(master_file)
+    if pq is None or not os.path.exists(snapshot_file) or not os.path.exists(master_file):
+        return None, 0
+    try:
+        with pq.ParquetFile(snapshot_file) as snapshot:
+            metadata = json.loads(snapshot.schema_arrow.metadata[SNAPSHOT_METADATA_KEY])
+            csv_bytes = metadata['csv_bytes']
+            if os.path.getsize(master_file) < csv_bytes or file_crc(master_file, csv_bytes) != metadata['csv_crc']:
+                print(f"{snapshot_file} is out of date with {master_file}; reading {master_file} in full")
+                return None, 0
+            parts = [snapshot.read_row_group(group, columns=columns).to_pandas() for group in range(snapshot.num_row_groups)]
+            if not parts:
+                parts = [snapshot.schema_arrow.empty_table().select(columns or snapshot.schema_arrow.names).to_pandas()]
+        df = pd.concat(parts, ignore_index=True)
+        # Arrow's allocator keeps freed buffers for reuse; the ledger is read once, so hand them back
+        pa.default_memory_pool().release_unused()
+    except (OSError, KeyError, TypeError, ValueError, pa.ArrowException) as e:
+        print(f"Ignoring unreadable ledger snapshot {snapshot_file}: {e}")
+        return None, 0
+
+    snapshot_rows = len(df)
+    if os.path.getsize(master_file) > csv_bytes:
+        csv_columns = metadata['csv_columns']
+        with open(master_file, 'rb') as f:
+            f.seek(csv_bytes)
+            tail = pd.read_csv(f, header=None, names=csv_columns, dtype={'Hash': str},
+                               usecols=[col for col in csv_columns if columns is None or col in columns])
+        if 'date_key' in df.columns:
+            tail['date_key'] = to_date_keys(tail['Transaction Date'])
+        df = pd.concat([df, tail[df.columns]], ignore_index=True)
+    return df, snapshot_rows
+
+def open_ledger(directory=''):
+    """Returns the master ledger for the storage backend selected by MASTER_STORAGE ('csv' or 'sqlite').
+
+    Its files are in directory (the working directory by default); MASTER_DB only names the default one's database.
+    """
+    storage = os.getenv('MASTER_STORAGE', 'csv').lower()
+    master_file = os.path.join(directory, 'master.csv')
+    if storage == 'sqlite':
+        from sqliteUtil import SqliteLedger, import_master_csv
+        db_file = os.path.join(directory, 'master.db') if directory else os.getenv('MASTER_DB', 'master.db')
+        if not os.path.exists(db_file) and os.path.exists(master_file) and os.path.getsize(master_file) > 0:
+            return import_master_csv(master_file, db_file)
+        return SqliteLedger(db_file)
+    snapshot = os.getenv('MASTER_SNAPSHOT', '1') != '0'
+    if snapshot and pq is None:
+        warn_no_snapshot()
+    return masterUtil(master_file, snapshot=snapshot)
+
+@functools.cache
+def warn_no_snapshot():
+    print("pyarrow is not installed, so the ledger has no Parquet snapshot and startup parses all of master.csv. "
+          "Run pip install -r requirements.txt, or set MASTER_SNAPSHOT=0 to silence this.")
+
 class masterUtil:
-    def __init__ (self):
-        self.master_df = pd.read_csv('master.csv') 
+    """Long-lived, in-memory view of master.csv.
+
+    Status changes are applied in memory through a hash -> row index and recorded
+    in an append-only change log; the log is folded back into master.csv by
+    compact() every COMPACT_EVERY changes, at startup and at shutdown.
+    All reads and writes hold self.lock, so a single writer mutates the ledger at a time.
+
+    Every append and status change bumps self.version and stamps the affected rows,
+    which powers the changes_since() feed. Versions live in memory only, so a new
+    random epoch is used per process and stale client tokens trigger a reset.
+
+    With pyarrow installed, the ledger is also kept in a Parquet snapshot (master.parquet)
+    that records which prefix of master.csv it covers. Startup reads the snapshot and
+    parses only the CSV rows appended after it, instead of all of master.csv. The
+    snapshot is rewritten at shutdown; master.csv stays the record.
+    """
+    def __init__ (self, master_file='master.csv', compact_every=COMPACT_EVERY, snapshot=True):
+        self.master_file = master_file
+        self.changelog_file = master_file + '.changes'
+        self.compact_every = compact_every
+        self.pending_changes = 0
         self.current_row_index = 0
+        self.lock = threading.RLock()
+        self.snapshot_file = snapshot_path(master_file) if snapshot and pq is not None else None
+        self.snapshot_rows = None
+        self.load()
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.row_versions = np.zeros(len(self.master_df), dtype=np.int64)
+        self.build_index()
+
+        if self.replay_changes():
+            self.compact()
+
+    @timed('ledger.load')
+    def load(self):
+        snapshot, snapshot_rows = read_snapshot(self.master_file) if self.snapshot_file else (None, 0)
+        if snapshot is not None:
+            self.date_keys = snapshot.pop('date_key').to_numpy()
+            self.master_df = snapshot
+        elif os.path.exists(self.master_file) and os.path.getsize(self.master_file) > 0:
+            self.master_df = pd.read_csv(self.master_file, dtype={'Hash': str})
+        else:
+            self.master_df = pd.DataFrame(columns=MASTER_COLUMNS)
+        self.master_df['Hash'] = self.master_df['Hash'].astype(str)
+        self.completion_col = self.master_df.columns.get_loc('Completion')
+        if snapshot is None:
+            self.date_keys = to_date_keys(self.master_df['Transaction Date'])
+            # The next startup can skip parsing master.csv
+            if self.snapshot_file and len(self.master_df):
+                self.save_snapshot()
+        else:
+            print(f"Loaded {snapshot_rows} rows from {self.snapshot_file} and {len(self.master_df) - snapshot_rows} from {self.master_file}")
+            self.snapshot_rows = snapshot_rows
+
+    def __len__(self):
+        return len(self.master_df)
 
-    def get_current_row(self): 
+    def close(self):
+        with self.lock:
+            compacted = self.pending_changes > 0
+            if compacted:
+                self.compact()
+            if self.snapshot_file and (compacted or self.snapshot_rows != len(self.master_df)) and len(self.master_df):
+                self.save_snapshot()
+
+    @timed('ledger.save_snapshot')
+    def save_snapshot(self):
+        """Writes the in-memory ledger to the Parquet snapshot, marked with the master.csv prefix it covers."""
+        if not self.snapshot_file:
+            return
+        with self.lock:
+            try:
+                csv_bytes = os.path.getsize(self.master_file)
+                table = pa.Table.from_pandas(self.master_df.assign(date_key=self.date_keys), preserve_index=False)
+                metadata = {'csv_bytes': csv_bytes, 'csv_crc': file_crc(self.master_file, csv_bytes),
+                            'csv_columns': list(self.master_df.columns)}
+                table = table.replace_schema_metadata({**table.schema.metadata, SNAPSHOT_METADATA_KEY: json.dumps(metadata)})
+                temp_file = self.snapshot_file + '.tmp'
+                pq.write_table(table, temp_file, compression=SNAPSHOT_COMPRESSION, row_group_size=SNAPSHOT_ROW_GROUP_ROWS)
+                os.replace(temp_file, self.snapshot_file)
+                self.snapshot_rows = len(self.master_df)
+            except (OSError, pa.ArrowException) as e:
+                print(f"Could not write ledger snapshot {self.snapshot_file}: {e}")
+
+    def build_index(self):
+        self.hash_index = {hash: position for position, hash in enumerate(self.master_df['Hash'])}
+
+    def replay_changes(self):
+        """Applies changes logged since the last compaction. Returns the number replayed."""
+        if not os.path.exists(self.changelog_file):
+            return 0
+        replayed = 0
+        with open(self.changelog_file, 'r') as f:
+            for line in f:
+                hash, _, value = line.strip().rpartition(',')
+                if hash and self.set_status(hash, int(value)):
+                    replayed += 1
+        print(f"Replayed {replayed} status changes from {self.changelog_file}")
+        return replayed
+
+    @timed('ledger.compact')
+    def compact(self):
+        """Rewrites master.csv from memory and truncates the change log."""
+        with self.lock:
+            temp_file = self.master_file + '.tmp'
+            self.master_df.to_csv(temp_file, index = False)
+            os.replace(temp_file, self.master_file)
+            if os.path.exists(self.changelog_file):
+                os.remove(self.changelog_file)
+            self.pending_changes = 0
+
+    def get_current_row(self):
         if 0 <= self.current_row_index < len(self.master_df):
             return self.master_df.iloc[[self.current_row_index], [0,1,2,3,4]].to_dict('records')[0]
         return None
@@ -15,25 +251,223 @@ class masterUtil:
             self.current_row_index += 1
             return self.get_current_row()
         return None
-    
+
     def get_rows(self):
-        rows = self.master_df.reset_index()
-        rows_filtered = rows[rows['Completion']==0].to_dict(orient='records')
+        with self.lock:
+            rows = self.master_df.reset_index()
+            rows_filtered = to_records(rows[rows['Completion']==0])
         return rows_filtered
-    
+
+    @timed('ledger.query_rows')
+    def query_rows(self, status=0, card=None, date_from=None, date_to=None, amount_min=None, amount_max=None,
+                   sort='index', descending=False, limit=None, cursor=None):
+        """Returns (rows, next_cursor, total) for rows matching the filters, in keyset-paginated sort order."""
+        with self.lock:
+            df = self.master_df
+            mask = np.ones(len(df), dtype=bool)
+            if status is not None:
+                mask &= (df['Completion'] == status).to_numpy()
+            if card:
+                mask &= (df['Card Name'] == card).to_numpy()
+            if date_from:
+                mask &= self.date_keys >= np.datetime64(date_from)
+            if date_to:
+                mask &= self.date_keys <= np.datetime64(date_to)
+            if amount_min is not None:
+                mask &= (df['Amount'] >= amount_min).to_numpy()
+            if amount_max is not None:
+                mask &= (df['Amount'] <= amount_max).to_numpy()
+
+            positions = np.flatnonzero(mask)
+            total = len(positions)
+            values = self.sort_values(sort, positions)
+            order = np.argsort(values, kind='stable')
+            if descending:
+                order = order[::-1]
+            positions, values = positions[order], values[order]
+
+            if cursor:
+                cursor_value, cursor_index = decode_cursor(cursor)
+                if descending:
+                    after = (values < cursor_value) | ((values == cursor_value) & (positions < cursor_index))
+                else:
+                    after = (values > cursor_value) | ((values == cursor_value) & (positions > cursor_index))
+                positions, values = positions[after], values[after]
+
+            next_cursor = None
+            if limit is not None and len(positions) > limit:
+                positions, values = positions[:limit], values[:limit]
+                last_value = values[-1].item() if isinstance(values[-1], np.generic) else values[-1]
+                next_cursor = encode_cursor(last_value, int(positions[-1]))
+
+            rows = to_records(df.iloc[positions].reset_index())
+        return rows, next_cursor, total
+
+    def sort_values(self, sort, positions):
+        if sort == 'date':
+            return self.date_keys[positions].astype('int64')
+        if sort == 'amount':
+            return np.nan_to_num(self.master_df['Amount'].to_numpy(dtype=float)[positions], nan=-np.inf)
+        if sort == 'description':
+            return self.master_df['Description'].fillna('').astype(str).to_numpy()[positions]
+        if sort == 'card':
+            return self.master_df['Card Name'].fillna('').astype(str).to_numpy()[positions]
+        return positions
+
+    @timed('ledger.changes_since')
+    def changes_since(self, token):
+        """Returns (rows, version_token, reset): rows appended or changed since the token's version.
+
+        reset is True when the token is missing or from another ledger instance; the
+        caller should then reload with query_rows.
+        """
+        with self.lock:
+            version_token = f"{self.epoch}.{self.version}"
+            since = parse_version(token, self.epoch) if token else None
+            if since is None:
+                return [], version_token, True
+            positions = np.flatnonzero(self.row_versions > since)
+            return to_records(self.master_df.iloc[positions].reset_index()), version_token, False
+
+    def version_token(self):
+        with self.lock:
+            return f"{self.epoch}.{self.version}"
+
+    def status_since(self, token):
+        """Returns (rows, version_token, reset): position, Hash and Completion of rows appended or changed since the token's version.
+
+        For indexes kept in step with the ledger. reset is True, and every row is returned,
+        when the token is missing or from another ledger instance.
+        """
+        with self.lock:
+            version_token = f"{self.epoch}.{self.version}"
+            since = parse_version(token, self.epoch) if token else None
+            if since is None:
+                positions = np.arange(len(self.master_df))
+            elif since >= self.version:
+                positions = np.empty(0, dtype=np.int64)
+            else:
+                positions = np.flatnonzero(self.row_versions > since)
+            rows = pd.DataFrame({
+                'position': positions,
+                'Hash': self.master_df['Hash'].to_numpy()[positions],
+                'Completion': self.master_df['Completion'].to_numpy()[positions],
+            })
+        return rows, version_token, since is None
+
+    def index_columns(self, start=0):
+        """Description, Amount, Card Name, Category, Completion and parsed date of rows from position start, for the search and analytics indexes."""
+        with self.lock:
+            rows = self.master_df.iloc[start:][['Description', 'Amount', 'Card Name', 'Category', 'Completion']].copy()
+            rows['date_key'] = self.date_keys[start:]
+        return rows
+
+    def rows_at(self, positions):
+        """Rows at the given positions, in that order."""
+        with self.lock:
+            return to_records(self.master_df.iloc[positions].reset_index())
+
+    def status_columns(self, value):
+        """Hash, Amount, Description and parsed date of rows with Completion == value, for reconciliation."""
+        with self.lock:
+            mask = (self.master_df['Completion'] == value).to_numpy()
+            rows = self.master_df.loc[mask, ['Hash', 'Amount', 'Description']].reset_index(drop=True)
+            rows['date_key'] = self.date_keys[mask]
+        return rows
+
+    def hashes(self):
+        with self.lock:
+            return list(self.hash_index)
+
+    def has_hash(self, hash):
+        return str(hash) in self.hash_index
+
+    @timed('ledger.append_rows')
+    def append_rows(self, new_rows_df):
+        """Appends already hashed and standardized rows to master.csv and the in-memory ledger."""
+        new_rows_df = new_rows_df.copy()
+        new_rows_df.columns = self.master_df.columns
+        new_rows_df['Hash'] = new_rows_df['Hash'].astype(str)
+
+        with self.lock:
+            is_empty = not os.path.exists(self.master_file) or os.path.getsize(self.master_file) == 0
+            new_rows_df.to_csv(self.master_file, mode='a', header=is_empty, index=False)
+
+            start = len(self.master_df)
+            if self.master_df.empty:
+                self.master_df = new_rows_df.reset_index(drop=True)
+            else:
+                self.master_df = pd.concat([self.master_df, new_rows_df], ignore_index=True)
+            for offset, hash in enumerate(new_rows_df['Hash']):
+                self.hash_index[hash] = start + offset
+
+            self.version += 1
+            self.date_keys = np.concatenate([self.date_keys, to_date_keys(new_rows_df['Transaction Date'])])
+            self.row_versions = np.concatenate([self.row_versions, np.full(len(new_rows_df), self.version, dtype=np.int64)])
+
+    def set_status(self, hash, value):
+        position = self.hash_index.get(str(hash))
+        if position is None:
+            return False
+        self.master_df.iat[position, self.completion_col] = value
+        self.version += 1
+        self.row_versions[position] = self.version
+        return True
+
+    @timed('ledger.record_changes')
+    def record_changes(self, changes):
+        """Applies (hash, value) pairs in memory and appends them to the change log."""
+        with self.lock:
+            applied = [(hash, value) for hash, value in changes if self.set_status(hash, value)]
+            if not applied:
+                return 0
+            with open(self.changelog_file, 'a') as f:
+                f.writelines(f"{hash},{value}\n" for hash, value in applied)
+            self.pending_changes += len(applied)
+            if self.pending_changes >= self.compact_every:
+                self.compact()
+        return len(applied)
+
+    @timed('ledger.record_pending_changes')
+    def record_pending_changes(self, changes):
+        """record_changes() for rows still pending (Completion 0) only. Returns the hashes it changed.
+
+        The check and the change happen under one lock, so a row clicked or ignored
+        after it was read as pending keeps that status.
+        """
+        with self.lock:
+            changed = {}
+            for hash, value in changes:
+                position = self.hash_index.get(str(hash))
+                if position is not None and hash not in changed and self.master_df.iat[position, self.completion_col] == 0:
+                    changed[hash] = value
+            self.record_changes(changed.items())
+        return list(changed)
+
     def update_completion(self, hash):
-        rowIndex = self.master_df[self.master_df['Hash'] == hash].index
-        self.master_df.loc[rowIndex, 'Completion'] = 1
-        self.master_df.to_csv('master.csv', index = False)
+        return self.record_changes([(hash, 1)]) > 0
+
+    def update_completion_bulk(self, hashes):
+        return self.record_changes([(hash, 1) for hash in hashes])
+
+    def update_sync_pending(self, hashes):
+        return self.record_changes([(hash, SYNC_PENDING) for hash in hashes])
+
+    def update_sync_failed(self, hashes):
+        return self.record_changes([(hash, 0) for hash in hashes])
+
+    def hashes_with_status(self, value):
+        with self.lock:
+            return self.master_df.loc[self.master_df['Completion'] == value, 'Hash'].tolist()
 
     def update_ignore(self, hash):
         try:
-            rowIndex = self.master_df[self.master_df['Hash'] == hash].index
-            self.master_df.loc[rowIndex, 'Completion'] = -1
-            self.master_df.to_csv('master.csv', index = False)
-            return True
+            return self.record_changes([(hash, -1)]) > 0
         except Exception as e:
              print(f"Error ignoring transaction (setting completion to -1) for hash {hash}: {e}")
              return False
 
-
+    def export_csv(self, csv_file='master.csv'):
+        with self.lock:
+            self.master_df.to_csv(csv_file, index = False)
+            return len(self.master_df)
@@ -0,0 +1,192 @@
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds; covers a 1 ms hash index check up to a minute-long Sheets retry
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# The Profile of the request being handled, if it asked for one
+active_profile = contextvars.ContextVar('active_profile', default=None)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named metric with optional labels, rendered in the Prometheus text format."""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """(suffix, label values, extra labels, value) for every sample."""
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', format_value(float(bound))),), cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+STAGE_SECONDS = registry.register(Histogram(
+    'sheetsync_stage_seconds', 'Time spent in each import, ledger and Google Sheets stage.', ('stage',)))
+ROWS_READ = registry.register(Counter('sheetsync_rows_read_total', 'Statement rows parsed from uploads.'))
+ROWS_IMPORTED = registry.register(Counter('sheetsync_rows_imported_total', 'New rows appended to the master ledger.'))
+DUPLICATE_ROWS = registry.register(Counter('sheetsync_duplicate_rows_total', 'Uploaded rows skipped as duplicates.'))
+SHEETS_CALLS = registry.register(Counter('sheetsync_sheets_api_calls_total', 'Google Sheets API requests.', ('method',)))
+SHEETS_ERRORS = registry.register(Counter(
+    'sheetsync_sheets_api_errors_total', 'Failed Google Sheets API requests.', ('method', 'status')))
+ROWS_SYNCED = registry.register(Counter('sheetsync_rows_synced_total', 'Rows appended to Google Sheets by the sync worker.'))
+LEDGER_ROWS = registry.register(Gauge('sheetsync_ledger_rows', 'Rows in the master ledger.'))
+SYNC_QUEUE_DEPTH = registry.register(Gauge('sheetsync_sync_queue_depth', 'Rows waiting for the Google Sheets sync.'))
+RESIDENT_TENANTS = registry.register(Gauge('sheetsync_resident_tenants', 'Tenants loaded in memory.'))
+TENANT_LOADS = registry.register(Counter('sheetsync_tenant_loads_total', 'Tenants loaded on first use.'))
+TENANT_EVICTIONS = registry.register(Counter('sheetsync_tenant_evictions_total', 'Idle tenants closed to make room for others.'))
+
+class Profile:
+    """Stage timings of one request, collected from every span() run while it is active."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.spans.append((stage, seconds))
+
+    def report(self, rows=None):
+        """Total seconds and call count per stage, slowest first, plus rows per second if rows is given."""
+        elapsed = time.perf_counter() - self.started
+        stages = {}
+        with self.lock:
+            for stage, seconds in self.spans:
+                total, calls = stages.get(stage, (0.0, 0))
+                stages[stage] = (total + seconds, calls + 1)
+        report = {
+            "total_seconds": round(elapsed, 6),
+            "stages": [
+                {"stage": stage, "seconds": round(total, 6), "calls": calls}
+                for stage, (total, calls) in sorted(stages.items(), key=lambda item: -item[1][0])
+            ],
+        }
+        if rows is not None:
+            report["rows_per_second"] = round(rows / elapsed, 1) if elapsed > 0 else None
+        return report
+
+def record(stage, seconds):
+    """Adds one stage timing to the histogram and to the active profile."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    profile = active_profile.get()
+    if profile is not None:
+        profile.add(stage, seconds)
+
+@contextmanager
+def span(stage):
+    """Times the block as one observation of stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+def timed(stage):
+    """Decorator form of span() for timing a whole function."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def profiling(enabled=True):
+    """Collects the spans of the current context (and of worker threads given a copy of it) into a Profile."""
+    if not enabled:
+        yield None
+        return
+    profile = Profile()
+    token = active_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        active_profile.reset(token)
@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+from sheetUtil import get_row
+
+RULES_FILE = 'rules.json'
+IGNORE_TARGET = 'ignore'
+WORD_PATTERN = re.compile(r'[^\W_]+')
+# Numbered or named backreferences break when patterns are joined into one alternation
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+def split_words(text):
+    return WORD_PATTERN.findall(str(text).casefold())
+
+class Rule:
+    """One routing rule. Every condition it sets must hold for a row to match."""
+    def __init__(self, rule, card_config, routes=None):
+        self.name = rule.get('name') or f"rule {rule.get('target')}"
+        self.target = rule.get('target')
+        if self.target != IGNORE_TARGET and get_row(self.target, '', 0, '', None, routes) is None:
+            raise ValueError(f"Rule '{self.name}': target must be a sheet name or '{IGNORE_TARGET}', got '{self.target}'.")
+
+        self.keywords = [tuple(split_words(keyword)) for keyword in rule.get('keywords') or []]
+        if any(not keyword for keyword in self.keywords):
+            raise ValueError(f"Rule '{self.name}': keywords must contain letters or digits.")
+        self.pattern = None
+        if rule.get('pattern'):
+            try:
+                self.pattern = re.compile(rule['pattern'], re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"Rule '{self.name}': invalid pattern: {e}")
+
+        # Cards may be given by config.json key or display name; the ledger stores display names
+        card = rule.get('card')
+        self.card = card_config[card].get('display_name', card) if card in card_config else card
+        self.amount_min = rule.get('amount_min')
+        self.amount_max = rule.get('amount_max')
+        self.category = rule['category'].casefold() if rule.get('category') else None
+
+    def accepts(self, description, card, amount, category):
+        """Checks every condition except keywords for a single row."""
+        if self.pattern is not None and not self.pattern.search(description):
+            return False
+        if self.card is not None and card != self.card:
+            return False
+        if self.amount_min is not None and not amount >= self.amount_min:
+            return False
+        if self.amount_max is not None and not amount <= self.amount_max:
+            return False
+        return self.category is None or category.casefold() == self.category
+
+    def accepts_rows(self, descriptions, cards, amounts, categories):
+        """Vectorized accepts() over aligned Series."""
+        mask = np.ones(len(descriptions), dtype=bool)
+        if self.card is not None:
+            mask &= (cards == self.card).to_numpy()
+        if self.amount_min is not None:
+            mask &= (amounts >= self.amount_min).to_numpy()
+        if self.amount_max is not None:
+            mask &= (amounts <= self.amount_max).to_numpy()
+        if self.category is not None:
+            mask &= (categories.str.casefold() == self.category).to_numpy()
+        if self.pattern is not None and mask.any():
+            positions = np.flatnonzero(mask)
+            mask[positions] = descriptions.iloc[positions].str.contains(self.pattern, regex=True).to_numpy()
+        return mask
+
+
+class RulesEngine:
+    """Routes transactions to a sheet, or ignores them, by the first matching rule in rules.json.
+
+    Keyword phrases of every rule are compiled into one index keyed by their
+    first word, so matching keywords costs one lookup per description word no
+    matter how many rules there are. Rules without keywords (pattern, card,
+    amount or category only) are evaluated a rule at a time over the whole
+    batch, only on rows that no earlier rule has matched; their patterns are
+    also joined into one prefilter regex, so each pattern only runs on rows
+    where some pattern matches.
+    """
+    def __init__(self, rules, card_config, routes=None):
+        self.definitions = rules
+        # SheetRoutes the targets are checked against; the default sheets if None
+        self.routes = routes
+        self.rules = [Rule(rule, card_config, routes) for rule in rules]
+        self.keyword_index = {}
+        self.scan_rules = []
+        for position, rule in enumerate(self.rules):
+            if not rule.keywords:
+                self.scan_rules.append(position)
+            for keyword in rule.keywords:
+                self.keyword_index.setdefault(keyword[0], []).append((position, keyword))
+
+        self.prefiltered = {
+            position for position in self.scan_rules
+            if self.rules[position].pattern is not None and not BACKREFERENCE.search(self.rules[position].pattern.pattern)
+        }
+        self.prefilter = None
+        if self.prefiltered:
+            try:
+                self.prefilter = re.compile(
+                    '|'.join(f'(?:{self.rules[position].pattern.pattern})' for position in sorted(self.prefiltered)), re.IGNORECASE
+                )
+            except re.error:
+                self.prefiltered = set()
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def load(cls, card_config, rules_file=RULES_FILE, routes=None):
+        if not os.path.exists(rules_file):
+            return cls([], card_config, routes)
+        with open(rules_file, 'r') as f:
+            return cls(json.load(f), card_config, routes)
+
+    def save(self, rules_file=RULES_FILE):
+        temp_file = rules_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.definitions, f, indent=2)
+        os.replace(temp_file, rules_file)
+
+    def match(self, rows) -> np.ndarray:
+        """Position of the first matching rule for each row, or -1.
+
+        rows is in master.csv column order (date, amount, description, category, card, ...).
+        """
+        no_match = len(self.rules)
+        best = np.full(len(rows), no_match, dtype=np.int64)
+        if not self.rules or rows.empty:
+            return np.full(len(rows), -1, dtype=np.int64)
+
+        descriptions = rows.iloc[:, 2].fillna('').astype(str).reset_index(drop=True)
+        amounts = pd.to_numeric(rows.iloc[:, 1], errors='coerce').reset_index(drop=True)
+        categories = rows.iloc[:, 3].fillna('').astype(str).reset_index(drop=True)
+        cards = rows.iloc[:, 4].fillna('').astype(str).reset_index(drop=True)
+
+        if self.keyword_index:
+            index = self.keyword_index
+            for row, words in enumerate(descriptions.str.casefold().str.findall(WORD_PATTERN)):
+                candidates = set()
+                for start, word in enumerate(words):
+                    for position, keyword in index.get(word, ()):
+                        if len(keyword) == 1 or tuple(words[start:start + len(keyword)]) == keyword:
+                            candidates.add(position)
+                for position in sorted(candidates):
+                    if self.rules[position].accepts(descriptions[row], cards[row], amounts[row], categories[row]):
+                        best[row] = position
+                        break
+
+        may_match = None
+        if self.prefilter is not None and (best > min(self.prefiltered)).any():
+            may_match = descriptions.str.contains(self.prefilter, regex=True).to_numpy()
+        for position in self.scan_rules:
+            open_mask = best > position
+            if not open_mask.any():
+                break
+            if position in self.prefiltered:
+                open_mask &= may_match
+            open_rows = np.flatnonzero(open_mask)
+            accepted = self.rules[position].accepts_rows(
+                descriptions.iloc[open_rows], cards.iloc[open_rows], amounts.iloc[open_rows], categories.iloc[open_rows]
+            )
+            best[open_rows[accepted]] = position
+
+        best[best == no_match] = -1
+        return best
+
+    def route(self, rows, positions=None):
+        """Splits rows by their matching rule (positions from match(), computed if not given).
+
+        Returns:
+            Tuple[np.ndarray, List[dict]]: (mask of rows to ignore, sync items for rows routed to a sheet)
+        """
+        if positions is None:
+            positions = self.match(rows)
+        targets = np.array([rule.target for rule in self.rules] + [None], dtype=object)[positions]
+        ignore_mask = targets == IGNORE_TARGET
+        amounts = pd.to_numeric(rows.iloc[:, 1], errors='coerce').to_numpy(dtype=float)
+        items = []
+        for row, sheet_name, amount in zip(rows.itertuples(index=False, name=None), targets, amounts):
+            # Rows without a numeric amount stay pending for a person to route
+            if sheet_name is None or sheet_name == IGNORE_TARGET or np.isnan(amount):
+                continue
+            items.append({
+                "hash": str(row[5]),
+                "transactionDate": row[0],
+                "amount": float(amount),
+                "description": row[2],
+                "category": row[3] if isinstance(row[3], str) and row[3] else None,
+                "sheetName": sheet_name,
+            })
+        return ignore_mask, items
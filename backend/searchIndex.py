@@ -0,0 +1,171 @@
+import bisect
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+TOKEN_PATTERN = r'[^\W_]+'
+SEARCH_SORT_FIELDS = ('date', 'amount', 'index')
+
+def tokenize(text):
+    return re.findall(TOKEN_PATTERN, str(text).casefold())
+
+class SearchIndex:
+    """In-memory search over the master ledger's descriptions, dates, amounts and cards.
+
+    Descriptions go into an inverted index (case-folded token -> ascending row
+    positions) with a sorted vocabulary for prefix lookups. Dates, amounts and
+    card codes are kept per row for filtering text matches, with sorted orders
+    for range-only queries.
+
+    Ledger rows are append-only and these columns never change, so refresh()
+    only indexes rows appended since the last call. It runs before every query;
+    the first call builds the whole index.
+    """
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self.lock = threading.Lock()
+        self.indexed_rows = 0
+        self.postings = {}
+        self.vocabulary = []
+        self.dates = np.empty(0, dtype='datetime64[D]')
+        self.amounts = np.empty(0, dtype=float)
+        self.card_codes = np.empty(0, dtype=np.int32)
+        self.card_names = {}
+        self.date_order = None
+        self.amount_order = None
+
+    def refresh(self):
+        """Indexes ledger rows appended since the last refresh. Returns how many were added."""
+        with self.lock:
+            rows = self.ledger.index_columns(self.indexed_rows)
+            if rows.empty:
+                return 0
+            positions = np.arange(self.indexed_rows, self.indexed_rows + len(rows))
+            self.add_postings(rows['Description'], positions)
+
+            self.dates = np.concatenate([self.dates, rows['date_key'].to_numpy().astype('datetime64[D]')])
+            self.amounts = np.concatenate([self.amounts, pd.to_numeric(rows['Amount'], errors='coerce').to_numpy(dtype=float)])
+            cards = rows['Card Name'].fillna('').astype(str)
+            for card in cards.unique():
+                self.card_names.setdefault(card, len(self.card_names))
+            self.card_codes = np.concatenate([self.card_codes, cards.map(self.card_names).to_numpy(dtype=np.int32)])
+
+            # Sorted orders are rebuilt on the next range-only query that needs them
+            self.date_order = None
+            self.amount_order = None
+            self.indexed_rows += len(rows)
+            return len(rows)
+
+    def add_postings(self, descriptions, positions):
+        tokens = pd.Series(descriptions.to_numpy(), index=positions, dtype=object).fillna('').astype(str)
+        tokens = tokens.str.casefold().str.findall(TOKEN_PATTERN).explode().dropna()
+        if tokens.empty:
+            return
+        codes, vocabulary = pd.factorize(tokens.to_numpy())
+        # A stable sort by token keeps each token's positions ascending; repeats within a row are dropped
+        order = np.argsort(codes, kind='stable')
+        codes, token_positions = codes[order], tokens.index.to_numpy()[order]
+        keep = (np.diff(codes, prepend=-1) != 0) | (np.diff(token_positions, prepend=-1) != 0)
+        codes, token_positions = codes[keep], token_positions[keep]
+        splits = np.cumsum(np.bincount(codes, minlength=len(vocabulary)))[:-1]
+        new_tokens = []
+        for token, posting in zip(vocabulary, np.split(token_positions, splits)):
+            existing = self.postings.get(token)
+            if existing is None:
+                self.postings[token] = posting
+                new_tokens.append(token)
+            else:
+                self.postings[token] = np.concatenate([existing, posting])
+
+        if len(new_tokens) > len(self.vocabulary) // 8:
+            self.vocabulary = sorted(self.postings)
+        else:
+            for token in new_tokens:
+                bisect.insort(self.vocabulary, token)
+
+    def prefix_postings(self, prefix):
+        """Positions of rows with a token starting with prefix."""
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        matches = []
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            matches.append(self.postings[token])
+        if not matches:
+            return np.empty(0, dtype=np.int64)
+        return matches[0] if len(matches) == 1 else np.unique(np.concatenate(matches))
+
+    def sorted_order(self, field):
+        """Row positions sorted by date or amount (ties by position), built on first use after a refresh."""
+        if field == 'date':
+            if self.date_order is None:
+                self.date_order = np.argsort(self.dates, kind='stable')
+            return self.date_order
+        if self.amount_order is None:
+            self.amount_order = np.argsort(self.amounts, kind='stable')
+        return self.amount_order
+
+    def range_positions(self, values, order, low, high):
+        """Positions whose value is in [low, high] (either bound may be None), using a sorted order."""
+        sorted_values = values[order]
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side='left')
+        end = len(order) if high is None else np.searchsorted(sorted_values, high, side='right')
+        return np.sort(order[start:end])
+
+    def search(self, text=None, cards=None, date_from=None, date_to=None, amount_min=None, amount_max=None,
+               sort='date', descending=True, limit=100, offset=0):
+        """Returns (rows, total) for rows matching every filter.
+
+        Every word of text must prefix-match a description token. cards is a list
+        of card names; dates are ISO strings.
+        """
+        self.refresh()
+        with self.lock:
+            date_low = np.datetime64(date_from, 'D') if date_from else None
+            date_high = np.datetime64(date_to, 'D') if date_to else None
+
+            # Start from the text postings when there is a query, otherwise from a sorted range index
+            candidates = None
+            for word in (tokenize(text) if text else []):
+                postings = self.prefix_postings(word)
+                candidates = postings if candidates is None else np.intersect1d(candidates, postings, assume_unique=True)
+                if not len(candidates):
+                    break
+            if candidates is None:
+                if date_low is not None or date_high is not None:
+                    candidates = self.range_positions(self.dates, self.sorted_order('date'), date_low, date_high)
+                elif amount_min is not None or amount_max is not None:
+                    candidates = self.range_positions(self.amounts, self.sorted_order('amount'), amount_min, amount_max)
+                else:
+                    candidates = np.arange(self.indexed_rows)
+
+            mask = np.ones(len(candidates), dtype=bool)
+            if cards:
+                codes = [self.card_names[card] for card in cards if card in self.card_names]
+                mask &= np.isin(self.card_codes[candidates], codes)
+            if date_low is not None:
+                mask &= self.dates[candidates] >= date_low
+            if date_high is not None:
+                mask &= self.dates[candidates] <= date_high
+            if amount_min is not None:
+                mask &= self.amounts[candidates] >= amount_min
+            if amount_max is not None:
+                mask &= self.amounts[candidates] <= amount_max
+            matches = candidates[mask]
+
+            if sort in ('date', 'amount'):
+                if len(matches) > self.indexed_rows // 16:
+                    # Cheaper to walk the whole sorted order than to sort a large match set
+                    order = self.sorted_order(sort)
+                    selected = np.zeros(self.indexed_rows, dtype=bool)
+                    selected[matches] = True
+                    matches = order[selected[order]]
+                else:
+                    values = self.dates if sort == 'date' else self.amounts
+                    matches = matches[np.argsort(values[matches], kind='stable')]
+            if descending:
+                matches = matches[::-1]
+            page = matches[offset:offset + limit]
+
+        return self.ledger.rows_at(page.tolist()), len(matches)
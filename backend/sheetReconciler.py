@@ -0,0 +1,249 @@
+import json
+import os
+import re
+import string
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+from sheetUtil import DEFAULT_ROUTES, get_row, batch_get_values, delete_rows as delete_sheet_rows
+from transformer import OUTPUT_DATE_FORMAT
+
+SNAPSHOT_FILE = 'sheet_snapshot.json'
+# Google Sheets serial dates count days from this date
+SHEETS_EPOCH = pd.Timestamp('1899-12-30')
+# Most missing/extra rows listed in a report; the counts are always complete
+REPORT_LIMIT = 500
+COMPLETED = 1
+WHITESPACE = re.compile(r'\s+')
+AMOUNT_STRIP = re.compile(r'[\s$,]')
+
+class SheetLayout:
+    """Where one sheet keeps its rows, and which columns hold the date, amount and description.
+
+    Worked out from get_row() with marker values, so the layout cannot drift from what is appended.
+    """
+    def __init__(self, sheet_name, routes=None):
+        date, amount, description = object(), 7919.25, object()
+        row_data, range_to_append, sheetID = get_row(sheet_name, date, amount, description, None, routes)
+        self.sheet_name = sheet_name
+        self.sheetID = sheetID
+        self.tab = range_to_append.split('!')[0]
+        self.last_column = string.ascii_uppercase[len(row_data) - 1]
+        self.date_col = next(col for col, value in enumerate(row_data) if value is date)
+        self.description_col = next(col for col, value in enumerate(row_data) if value is description)
+        # Sheets may store a signed copy of the amount (Business keeps expenses negative)
+        self.amount_col = next(col for col, value in enumerate(row_data) if isinstance(value, float) and abs(value) == amount)
+        self.key = f"{sheetID}|{self.tab}"
+
+    def read_range(self, start_row=1):
+        return f"{self.tab}!A{start_row}:{self.last_column}"
+
+
+def content_keys(dates, amounts, descriptions) -> np.ndarray:
+    """Hashes each row's date, absolute amount in cents and normalized description.
+
+    Rows without a parseable date or amount get key 0, which never matches.
+    """
+    dates = pd.Series(dates).reset_index(drop=True)
+    cents = (pd.Series(amounts, dtype=float).reset_index(drop=True).abs() * 100).round()
+    descriptions = pd.Series(descriptions, dtype=object).reset_index(drop=True).fillna('').astype(str)
+    descriptions = descriptions.str.strip().str.replace(WHITESPACE, ' ', regex=True).str.casefold()
+    valid = (dates.notna() & cents.notna()).to_numpy()
+    keys = np.zeros(len(dates), dtype=np.uint64)
+    if valid.any():
+        text = dates[valid].dt.strftime('%Y-%m-%d') + '|' + cents[valid].astype(np.int64).astype(str) + '|' + descriptions[valid]
+        keys[valid] = pd.util.hash_array(text.to_numpy(dtype=object))
+    keys[keys == 0] = 1
+    keys[~valid] = 0
+    return keys
+
+def parse_sheet_dates(values) -> pd.Series:
+    """Serial numbers, or text in the ledger's format or any other pandas can read, as dates."""
+    values = pd.Series(values, dtype=object)
+    serial = pd.to_numeric(values, errors='coerce')
+    dates = SHEETS_EPOCH + pd.to_timedelta(serial.floordiv(1), unit='D')
+    text = values[serial.isna() & values.notna()].astype(str)
+    if not text.empty:
+        parsed = pd.to_datetime(text, format=OUTPUT_DATE_FORMAT, errors='coerce')
+        unparsed = parsed.isna()
+        if unparsed.any():
+            parsed[unparsed] = pd.to_datetime(text[unparsed], format='mixed', errors='coerce')
+        dates[text.index] = parsed
+    return dates
+
+def parse_sheet_amounts(values) -> pd.Series:
+    values = pd.Series(values, dtype=object)
+    amounts = pd.to_numeric(values, errors='coerce')
+    text = values[amounts.isna() & values.notna()].astype(str).str.replace(AMOUNT_STRIP, '', regex=True)
+    if not text.empty:
+        # Accounting style (12.34) is negative, but only the absolute value is compared
+        amounts[text.index] = pd.to_numeric(text.str.strip('()'), errors='coerce')
+    return amounts
+
+def remote_keys(rows, layout) -> np.ndarray:
+    """content_keys() for rows read from a sheet; headers, blank and partial rows get key 0."""
+    if not rows:
+        return np.zeros(0, dtype=np.uint64)
+
+    def column(col):
+        return [row[col] if col < len(row) and row[col] != '' else None for row in rows]
+
+    return content_keys(
+        parse_sheet_dates(column(layout.date_col)),
+        parse_sheet_amounts(column(layout.amount_col)),
+        column(layout.description_col),
+    )
+
+def occurrences(keys) -> np.ndarray:
+    """How many times each key has appeared before it, so duplicate rows pair up one to one."""
+    return pd.Series(keys).groupby(keys).cumcount().to_numpy()
+
+
+class SheetReconciler:
+    """Checks that every completed ledger row is in a Google Sheet, and that sheets hold nothing extra.
+
+    Each run reads every sheet in routes (the default Primary, Business, Secondary
+    and Joint sheets if None) with one values.batchGet per spreadsheet and keys every row by its date, amount and
+    description; completed ledger rows are keyed the same way. The ledger
+    doesn't record which sheet a row went to, so the two sides are compared
+    as multisets over all sheets.
+
+    Row keys are kept in SNAPSHOT_FILE. Sheets only grow by appends, so the
+    next run re-reads a sheet from its last known row; if that row has changed
+    (a manual edit or deletion above it), the whole sheet is read again.
+    """
+    def __init__(self, ledger, service, snapshot_file=SNAPSHOT_FILE, routes=None):
+        self.ledger = ledger
+        self.service = service
+        self.snapshot_file = snapshot_file
+        self.lock = threading.Lock()
+        # Sheets configured with the same spreadsheet and tab are read once
+        layouts = {}
+        for name in (routes if routes is not None else DEFAULT_ROUTES).names:
+            if get_row(name, '', 0, '', None, routes)[2]:
+                layout = SheetLayout(name, routes)
+                layouts.setdefault(layout.key, layout)
+        self.layouts = list(layouts.values())
+        self.snapshot = {}
+        if os.path.exists(snapshot_file):
+            try:
+                with open(snapshot_file, 'r') as f:
+                    self.snapshot = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Ignoring unreadable sheet snapshot {snapshot_file}: {e}")
+
+    def save_snapshot(self):
+        temp_file = self.snapshot_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.snapshot, f)
+        os.replace(temp_file, self.snapshot_file)
+
+    def fetch(self, full=False):
+        """Brings the snapshot of every sheet up to date. Returns how many rows were read."""
+        if full:
+            self.snapshot = {}
+        fetched = 0
+        pending = self.layouts
+        while pending:
+            # A second pass re-reads, from the top, sheets whose last known row changed
+            stale = []
+            by_spreadsheet = {}
+            for layout in pending:
+                by_spreadsheet.setdefault(layout.sheetID, []).append(layout)
+            for sheetID, layouts in by_spreadsheet.items():
+                starts = [max(1, len(self.snapshot.get(layout.key, {}).get('keys', []))) for layout in layouts]
+                values = batch_get_values(self.service, sheetID, [layout.read_range(start) for layout, start in zip(layouts, starts)])
+                for layout, start, rows in zip(layouts, starts, values):
+                    fetched += len(rows)
+                    cached = self.snapshot.get(layout.key)
+                    if cached and cached['keys']:
+                        if not rows or rows[0] != cached['last']:
+                            del self.snapshot[layout.key]
+                            stale.append(layout)
+                            continue
+                        rows = rows[1:]
+                        keys = cached['keys'] + [int(key) for key in remote_keys(rows, layout)]
+                    else:
+                        keys = [int(key) for key in remote_keys(rows, layout)]
+                    last = rows[-1] if rows else (cached['last'] if cached else None)
+                    self.snapshot[layout.key] = {'sheet': layout.sheet_name, 'keys': keys, 'last': last}
+            pending = stale
+        return fetched
+
+    def reconcile(self, repair=False, full=False, delete_rows=None):
+        """Diffs completed ledger rows against the sheets.
+
+        With repair, missing rows go back to pending so they can be sent again.
+        Extra rows are only reported: a copy of a completed row may be a real
+        repeated purchase typed in by hand. delete_rows lists the extra rows to
+        delete as {"sheet", "row"} from a report; a listed row is deleted only if
+        this run still finds it extra, and the rest come back in "not_deleted".
+        """
+        with self.lock:
+            started = time.perf_counter()
+            # Ledger first: a row synced while the sheets are being read shows up as extra, not as missing
+            completed = self.ledger.status_columns(COMPLETED)
+            fetched = self.fetch(full)
+
+            ledger_keys = content_keys(completed['date_key'], completed['Amount'], completed['Description'])
+            ledger = pd.DataFrame({'key': ledger_keys, 'occurrence': occurrences(ledger_keys)})
+            remote_parts = []
+            for layout in self.layouts:
+                keys = np.array(self.snapshot[layout.key]['keys'], dtype=np.uint64)
+                remote_parts.append(pd.DataFrame({'sheet': layout.sheet_name, 'row': np.arange(1, len(keys) + 1), 'key': keys}))
+            remote = pd.concat(remote_parts, ignore_index=True) if remote_parts else pd.DataFrame(columns=['sheet', 'row', 'key'])
+            remote = remote[remote['key'] != 0].reset_index(drop=True)
+            remote['key'] = remote['key'].astype(np.uint64)
+            remote['occurrence'] = occurrences(remote['key'].to_numpy())
+
+            unkeyed = (ledger_keys == 0)
+            pairs = pd.MultiIndex.from_frame(remote[['key', 'occurrence']])
+            missing = ~pd.MultiIndex.from_frame(ledger).isin(pairs) & ~unkeyed
+            extra = ~pairs.isin(pd.MultiIndex.from_frame(ledger))
+            extra_rows = remote[extra].copy()
+            extra_rows['duplicate'] = extra_rows['key'].isin(ledger_keys)
+
+            missing_rows = completed[missing]
+            report = {
+                "completed_rows": len(completed),
+                "unchecked_rows": int(unkeyed.sum()),
+                "sheet_rows": len(remote),
+                "fetched_rows": fetched,
+                "missing": len(missing_rows),
+                "extra": len(extra_rows),
+                "duplicates": int(extra_rows['duplicate'].sum()),
+                "missing_rows": [
+                    {"hash": row.Hash, "transactionDate": None if pd.isna(row.date_key) else row.date_key.strftime('%Y-%m-%d'),
+                     "amount": None if pd.isna(row.Amount) else float(row.Amount), "description": row.Description}
+                    for row in missing_rows.head(REPORT_LIMIT).itertuples()
+                ],
+                "extra_rows": [
+                    {"sheet": row.sheet, "row": int(row.row), "duplicate": bool(row.duplicate)}
+                    for row in extra_rows.head(REPORT_LIMIT).itertuples()
+                ],
+                "returned_to_pending": 0,
+                "deleted": 0,
+                "not_deleted": [],
+            }
+
+            if repair and len(missing_rows):
+                report["returned_to_pending"] = self.ledger.update_sync_failed(missing_rows['Hash'].tolist())
+            if delete_rows:
+                requested = {(row['sheet'], int(row['row'])) for row in delete_rows}
+                for layout in self.layouts:
+                    rows = [row for row in extra_rows.loc[extra_rows['sheet'] == layout.sheet_name, 'row'].astype(int).tolist()
+                            if (layout.sheet_name, row) in requested]
+                    if not rows:
+                        continue
+                    delete_sheet_rows(self.service, layout.sheetID, layout.tab, rows)
+                    requested.difference_update((layout.sheet_name, row) for row in rows)
+                    report["deleted"] += len(rows)
+                    # Later rows moved up; read this sheet in full next time
+                    self.snapshot.pop(layout.key, None)
+                report["not_deleted"] = [{"sheet": sheet, "row": row} for sheet, row in sorted(requested)]
+
+            self.save_snapshot()
+            report["seconds"] = round(time.perf_counter() - started, 3)
+            return report
@@ -1,11 +1,18 @@
 import os.path
+import google_auth_httplib2
+import httplib2
+from datetime import datetime, timedelta, timezone
 from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from typing import List
 from dotenv import load_dotenv
+import json
 import os
+import threading
+
+from metrics import SHEETS_CALLS, SHEETS_ERRORS, span
 
 load_dotenv()
 primary_sheetID = os.getenv("PRIMARY_SHEETID")
@@ -13,9 +20,134 @@ business_sheetID = os.getenv("BUSINESS_SHEETID")
 secondary_sheetID = os.getenv("SECONDARY_SHEETID")
 joint_sheetID = os.getenv("JOINT_SHEETID")
 SERVICE_ACCOUNT_FILE = 'credentials.json'
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# Points the client at another Sheets endpoint (e.g. a local fake server) without credentials
+SHEETS_API_URL = os.getenv("SHEETS_API_URL")
+SHEETS_TIMEOUT = int(os.getenv("SHEETS_TIMEOUT", "60"))
+# Tokens are refreshed this long before they expire, so no request waits on a refresh or gets a 401
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# Raw service objects share one httplib2 connection, which is not thread-safe
+sheets_lock = threading.Lock()
+
+class SessionCredentials:
+    """One session's handle on a SheetsClient's shared credentials, for AuthorizedHttp.
+
+    AuthorizedHttp refreshes its credentials before a request and again after a
+    401. Both go through the client's refresh lock here, so sessions never refresh
+    the shared credentials at the same time.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.sent_token = None
+
+    def before_request(self, request, method, url, headers):
+        self.client.refresh_token()
+        self.sent_token = self.client.credentials.token
+        self.client.credentials.apply(headers, token=self.sent_token)
+
+    def refresh(self, request):
+        # After a 401: another session may already have replaced the rejected token
+        self.client.refresh_token(rejected=self.sent_token)
+
+class SheetsClient:
+    """Thread-safe Google Sheets client.
+
+    The API resources are built once from the discovery document bundled with
+    google-api-python-client, so startup makes no discovery request. Requests
+    are built from that shared service but executed on an HTTP session owned
+    by the calling thread; each session keeps its connection to the API open
+    between requests. The access token is shared by every session and
+    refreshed ahead of its expiry, or after a 401, under a lock.
+
+    http_factory returns a new session for a thread. It defaults to an
+    authorized httplib2 session, or a plain one when base_url is set, which is
+    how tests and benchmarks point the client at a local fake Sheets server.
+    """
+    def __init__(self, credentials=None, base_url=None, http_factory=None, timeout=SHEETS_TIMEOUT):
+        self.credentials = credentials
+        self.timeout = timeout
+        self.refresh_lock = threading.Lock()
+        self.sessions_lock = threading.Lock()
+        self.local = threading.local()
+        self.sessions = []
+        self.requests = 0
+        self.refreshes = 0
+        if http_factory is None:
+            if credentials is not None:
+                http_factory = lambda: google_auth_httplib2.AuthorizedHttp(SessionCredentials(self), http=httplib2.Http(timeout=timeout))
+            else:
+                http_factory = lambda: httplib2.Http(timeout=timeout)
+        self.http_factory = http_factory
+
+        client_options = {'api_endpoint': base_url} if base_url else None
+        self.service = build('sheets', 'v4', http=self.http(), client_options=client_options,
+                             static_discovery=True, cache_discovery=False)
+        # Each resource call rebuilds its methods from the discovery document, so build them once
+        self.spreadsheets_resource = self.service.spreadsheets()
+        self.values_resource = self.spreadsheets_resource.values()
+
+    def http(self):
+        """The calling thread's HTTP session, created on first use."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.http_factory()
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    def refresh_token(self, force=False, rejected=None):
+        """Refreshes the shared access token if it is missing or about to expire.
+
+        rejected is a token the API refused; it is replaced unless another thread already has.
+        """
+        creds = self.credentials
+        if creds is None:
+            return
+        with self.refresh_lock:
+            # expiry is naive UTC in google-auth
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            expiring = creds.expiry and creds.expiry - TOKEN_REFRESH_MARGIN <= now
+            if force or not creds.token or expiring or (rejected is not None and creds.token == rejected):
+                creds.refresh(Request())
+                self.refreshes += 1
+
+    def prewarm(self):
+        """Fetches the first access token at startup instead of on the first request."""
+        self.refresh_token(force=True)
+
+    def execute(self, request):
+        """Executes a request built from spreadsheets() on the calling thread's session."""
+        self.refresh_token()
+        self.requests += 1
+        return request.execute(http=self.http())
+
+    def spreadsheets(self):
+        return self.spreadsheets_resource
+
+    def values(self):
+        return self.values_resource
+
+    def stats(self):
+        return {"sessions": len(self.sessions), "requests": self.requests, "token_refreshes": self.refreshes}
+
+    def close(self):
+        with self.sessions_lock:
+            for session in self.sessions:
+                http = getattr(session, 'http', session)
+                for connection in list(http.connections.values()):
+                    connection.close()
+                http.connections.clear()
 
 def authenticate_google_sheets():
-    """Authenticates using the service account file and returns the service object."""
+    """Authenticates using the service account file and returns a SheetsClient.
+
+    If SHEETS_API_URL is set, returns an unauthenticated client for that endpoint instead.
+    """
+    if SHEETS_API_URL:
+        client = SheetsClient(base_url=SHEETS_API_URL)
+        print(f"Google Sheets client using {SHEETS_API_URL}.")
+        return client
+
     creds = None
     if not os.path.exists(SERVICE_ACCOUNT_FILE):
         print(f"ERROR: Service account key file not found at: {SERVICE_ACCOUNT_FILE}")
@@ -24,21 +156,54 @@ def authenticate_google_sheets():
 
     try:
         creds = Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE)
+            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
         print("Credentials loaded successfully.")
     except Exception as e:
         print(f"ERROR loading credentials: {e}")
         return None
 
     try:
-        service = build('sheets', 'v4', credentials=creds)
+        client = SheetsClient(credentials=creds)
         print("Google Sheets API service built successfully.")
-        return service
     except Exception as e:
         print(f"ERROR building Google Sheets service: {e}")
         return None
+
+    try:
+        client.prewarm()
+    except Exception as e:
+        # The token is fetched again on the first request
+        print(f"WARN: Could not fetch an access token at startup: {e}")
+    return client
+
+def values_resource(service):
+    """The spreadsheets.values resource, cached by a SheetsClient and rebuilt per call on a raw service."""
+    if isinstance(service, SheetsClient):
+        return service.values()
+    return service.spreadsheets().values()
+
+def execute_request(service, request):
+    """Executes a request on a SheetsClient, or under sheets_lock on a raw service object.
+
+    Each call is timed as a 'sheets.<method>' stage and counted in the Sheets API metrics.
+    """
+    method = getattr(request, 'methodId', None) or 'sheets.request'
+    method = method.replace('sheets.spreadsheets.', 'sheets.')
+    SHEETS_CALLS.inc(method=method)
+    try:
+        with span(method):
+            if isinstance(service, SheetsClient):
+                return service.execute(request)
+            with sheets_lock:
+                return request.execute()
+    except HttpError as err:
+        SHEETS_ERRORS.inc(method=method, status=err.resp.status)
+        raise
+    except Exception:
+        SHEETS_ERRORS.inc(method=method, status='network')
+        raise
     
-def append_row_to_sheet(service, sheet_name: str, transactionDate:str, amount:float, description:str, category:str):
+def append_row_to_sheet(service, sheet_name: str, transactionDate:str, amount:float, description:str, category:str, routes=None):
     """
     Appends a single row of data to the specified sheet (SHEET_NAME).
 
@@ -51,7 +216,7 @@ def append_row_to_sheet(service, sheet_name: str, transactionDate:str, amount:fl
         return False
     
 
-    row_data, range, sheetID = get_row(sheet_name, transactionDate, amount, description, category)
+    row_data, range, sheetID = get_row(sheet_name, transactionDate, amount, description, category, routes)
     
 
     if (not transactionDate) and (not amount) and (not description) and (not category):
@@ -67,13 +232,13 @@ def append_row_to_sheet(service, sheet_name: str, transactionDate:str, amount:fl
         }
 
 
-        result = service.spreadsheets().values().append(
+        result = execute_request(service, values_resource(service).append(
             spreadsheetId=sheetID,
             range=range_to_append,
             valueInputOption='USER_ENTERED',
             insertDataOption='INSERT_ROWS',
             body=body
-        ).execute()
+        ))
 
         updated_range = result.get('updates', {}).get('updatedRange')
         return True
@@ -88,12 +253,133 @@ def append_row_to_sheet(service, sheet_name: str, transactionDate:str, amount:fl
         print(f"\nAn unexpected error occurred during append for row {row_data}: {e}")
         return False
     
-def get_row(sheet_name, transactionDate, amount, description, category):
-    if sheet_name == 'Primary':
-        return [transactionDate, None, amount, description, category], "Eth!A:A", primary_sheetID
-    if sheet_name == 'Business':
-        return [transactionDate, -abs(amount), description, None, category], "Sheet1!A:A", business_sheetID
-    if sheet_name == 'Secondary':
-        return [transactionDate, None, amount, description, category], "Eth!A:A", secondary_sheetID
-    if sheet_name == 'Joint':
-        return [transactionDate, None, amount, description, category], "Eth!A:A", joint_sheetID
+def group_rows(items: List[dict], routes=None):
+    """
+    Groups items by destination spreadsheet/range, looked up in routes (the default sheets if None).
+
+    Returns:
+        Tuple[dict, list]: ({(sheetID, range): {'hashes': [...], 'values': [...]}}, hashes of invalid items)
+    """
+    groups = {}
+    invalid = []
+    for item in items:
+        transactionDate = item.get('transactionDate')
+        amount = item.get('amount')
+        description = item.get('description')
+        category = item.get('category')
+
+        if (not transactionDate) and (not amount) and (not description) and (not category):
+            print(f"WARN: A piece of data is missing for hash {item['hash']}")
+            invalid.append(item['hash'])
+            continue
+
+        row = get_row(item['sheetName'], transactionDate, amount, description, category, routes)
+        if row is None:
+            print(f"WARN: Unknown sheet '{item['sheetName']}' for hash {item['hash']}")
+            invalid.append(item['hash'])
+            continue
+
+        row_data, range, sheetID = row
+        group = groups.setdefault((sheetID, range), {'hashes': [], 'values': []})
+        group['hashes'].append(item['hash'])
+        group['values'].append(row_data)
+    return groups, invalid
+
+def append_values(service, sheetID: str, range_to_append: str, values: List[list]):
+    """Appends rows to one spreadsheet/range in a single API call. Raises HttpError on failure."""
+    return execute_request(service, values_resource(service).append(
+        spreadsheetId=sheetID,
+        range=range_to_append,
+        valueInputOption='USER_ENTERED',
+        insertDataOption='INSERT_ROWS',
+        body={'values': values}
+    ))
+
+def batch_get_values(service, sheetID: str, ranges: List[str]):
+    """Reads several ranges of one spreadsheet in a single API call. Raises HttpError on failure.
+
+    Numbers come back unformatted and dates as serial numbers.
+
+    Returns:
+        List[list]: The rows of each range, in the order of ranges (trailing empty rows are omitted).
+    """
+    result = execute_request(service, values_resource(service).batchGet(
+        spreadsheetId=sheetID,
+        ranges=ranges,
+        valueRenderOption='UNFORMATTED_VALUE',
+        dateTimeRenderOption='SERIAL_NUMBER'
+    ))
+    return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+def delete_rows(service, sheetID: str, tab: str, rows: List[int]):
+    """Deletes rows (1-based) from one tab of a spreadsheet in a single batch update. Raises HttpError on failure."""
+    spreadsheet = execute_request(service, service.spreadsheets().get(
+        spreadsheetId=sheetID, fields='sheets.properties(sheetId,title)'
+    ))
+    tab_id = next(sheet['properties']['sheetId'] for sheet in spreadsheet['sheets'] if sheet['properties']['title'] == tab)
+    # Bottom-up, so each deletion leaves the row numbers of the next ones unchanged
+    requests = [
+        {'deleteDimension': {'range': {'sheetId': tab_id, 'dimension': 'ROWS', 'startIndex': row - 1, 'endIndex': row}}}
+        for row in sorted(set(rows), reverse=True)
+    ]
+    return execute_request(service, service.spreadsheets().batchUpdate(spreadsheetId=sheetID, body={'requests': requests}))
+
+def unique_items(items: List[dict]) -> List[dict]:
+    """items without repeats of a hash, keeping the first; a hash is one transaction, so it is appended once."""
+    unique = {}
+    for item in items:
+        unique.setdefault(item['hash'], item)
+    return list(unique.values())
+
+SHEETS_FILE = 'sheets.json'
+# Column order of a row for each sheet layout
+SHEET_LAYOUTS = {
+    'default': lambda transactionDate, amount, description, category: [transactionDate, None, amount, description, category],
+    # Business sheets keep expenses as negative amounts, before the description
+    'business': lambda transactionDate, amount, description, category: [transactionDate, -abs(amount), description, None, category],
+}
+DEFAULT_SHEETS = {
+    'Primary': {'spreadsheet_id': primary_sheetID, 'range': 'Eth!A:A', 'layout': 'default'},
+    'Business': {'spreadsheet_id': business_sheetID, 'range': 'Sheet1!A:A', 'layout': 'business'},
+    'Secondary': {'spreadsheet_id': secondary_sheetID, 'range': 'Eth!A:A', 'layout': 'default'},
+    'Joint': {'spreadsheet_id': joint_sheetID, 'range': 'Eth!A:A', 'layout': 'default'},
+}
+
+class SheetRoutes:
+    """The sheets rows can be sent to, by name, each with its spreadsheet, range and column layout.
+
+    sheets maps a sheet name to {"spreadsheet_id": ..., "range": "Tab!A:A", "layout": "default"},
+    where layout is a key of SHEET_LAYOUTS. Raises ValueError for an invalid entry.
+    """
+    def __init__(self, sheets):
+        for name, sheet in sheets.items():
+            if not isinstance(sheet, dict) or '!' not in str(sheet.get('range', '')):
+                raise ValueError(f"Sheet '{name}' needs a range such as 'Sheet1!A:A'.")
+            if sheet.get('layout', 'default') not in SHEET_LAYOUTS:
+                raise ValueError(f"Sheet '{name}': layout must be one of {', '.join(SHEET_LAYOUTS)}.")
+        self.sheets = sheets
+        self.names = tuple(sheets)
+
+    @classmethod
+    def load(cls, sheets_file=SHEETS_FILE, default=DEFAULT_SHEETS):
+        """Routes from sheets_file, or default (the *_SHEETID environment variables) if there is none."""
+        if not os.path.exists(sheets_file):
+            return cls(default)
+        with open(sheets_file, 'r') as f:
+            return cls(json.load(f))
+
+    def row(self, sheet_name, transactionDate, amount, description, category):
+        """(row values, range, spreadsheet id) for a row sent to sheet_name, or None for an unknown sheet."""
+        sheet = self.sheets.get(sheet_name)
+        if sheet is None:
+            return None
+        row_data = SHEET_LAYOUTS[sheet.get('layout', 'default')](transactionDate, amount, description, category)
+        return row_data, sheet['range'], sheet.get('spreadsheet_id')
+
+DEFAULT_ROUTES = SheetRoutes(DEFAULT_SHEETS)
+SHEET_NAMES = DEFAULT_ROUTES.names
+
+def get_row(sheet_name, transactionDate, amount, description, category, routes=None):
+    """(row values, range, spreadsheet id) for sheet_name in routes (the default sheets if None), or None."""
+    routes = routes if routes is not None else DEFAULT_ROUTES
+    return routes.row(sheet_name, transactionDate, amount, description, category)
@@ -0,0 +1,312 @@
+import sqlite3
+import sys
+import threading
+import uuid
+import pandas as pd
+
+from metrics import timed
+from masterUtil import MASTER_COLUMNS, SYNC_PENDING, encode_cursor, decode_cursor, parse_version, to_date_keys
+
+SQL_COLUMNS = ', '.join(f'"{col}"' for col in MASTER_COLUMNS)
+# Stay under SQLite's bound-parameter limit on older builds
+SQL_VARIABLE_LIMIT = 900
+SQL_SORT_COLUMNS = {
+    'index': 'id',
+    'date': "COALESCE(date_key, '')",
+    'amount': 'COALESCE(Amount, -1e308)',
+    'description': "COALESCE(Description, '')",
+    'card': 'COALESCE("Card Name", \'\')',
+}
+
+def date_key_values(dates):
+    """ISO dates (or None) for standardized 'Transaction Date' strings, stored for date filters and sorting."""
+    return [None if pd.isna(key) else str(key)[:10] for key in to_date_keys(dates)]
+
+class SqliteLedger:
+    """SQLite storage for the master ledger, a drop-in replacement for masterUtil.
+
+    Hash and Completion are indexed, so duplicate checks and the pending-row
+    query do not scan the table. The shared connection is guarded by self.lock.
+
+    Each row records the ledger version of its last append or status change,
+    which powers the changes_since() feed; the epoch is stored in the database.
+    """
+    def __init__(self, db_file='master.db'):
+        self.db_file = db_file
+        self.pending_changes = 0
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS master (
+                id INTEGER PRIMARY KEY,
+                "Transaction Date" TEXT,
+                Amount REAL,
+                Description TEXT,
+                Category TEXT,
+                "Card Name" TEXT,
+                Hash TEXT,
+                Completion INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_master_hash ON master(Hash);
+            CREATE INDEX IF NOT EXISTS idx_master_completion ON master(Completion);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.migrate()
+        self.conn.commit()
+        self.epoch = self.conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+        self.version = self.conn.execute('SELECT COALESCE(MAX(version), 0) FROM master').fetchone()[0]
+
+    def migrate(self):
+        """Adds the version and date_key columns to databases created before they existed."""
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(master)')}
+        if 'version' not in columns:
+            self.conn.execute('ALTER TABLE master ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        if 'date_key' not in columns:
+            self.conn.execute('ALTER TABLE master ADD COLUMN date_key TEXT')
+            rows = self.conn.execute('SELECT id, "Transaction Date" FROM master').fetchall()
+            keys = date_key_values([row[1] for row in rows])
+            self.conn.executemany('UPDATE master SET date_key = ? WHERE id = ?', zip(keys, (row[0] for row in rows)))
+        self.conn.executescript('''
+            CREATE INDEX IF NOT EXISTS idx_master_version ON master(version);
+            CREATE INDEX IF NOT EXISTS idx_master_date ON master(date_key);
+        ''')
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (uuid.uuid4().hex[:8],))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM master').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.conn.close()
+
+    def get_rows(self):
+        with self.lock:
+            cursor = self.conn.execute(
+                f'SELECT id - 1 AS "index", {SQL_COLUMNS} FROM master WHERE Completion = 0 ORDER BY id'
+            )
+            return [dict(row) for row in cursor]
+
+    def index_columns(self, start=0):
+        """Description, Amount, Card Name, Category, Completion and parsed date of rows from position start, for the search and analytics indexes."""
+        with self.lock:
+            rows = pd.read_sql_query(
+                'SELECT Description, Amount, "Card Name", Category, Completion, date_key FROM master WHERE id > ? ORDER BY id',
+                self.conn, params=(start,)
+            )
+        rows['date_key'] = pd.to_datetime(rows['date_key'])
+        return rows
+
+    def rows_at(self, positions):
+        """Rows at the given positions, in that order."""
+        rows = {}
+        with self.lock:
+            for start in range(0, len(positions), SQL_VARIABLE_LIMIT):
+                ids = [position + 1 for position in positions[start:start + SQL_VARIABLE_LIMIT]]
+                cursor = self.conn.execute(
+                    f'SELECT id - 1 AS "index", {SQL_COLUMNS} FROM master WHERE id IN ({", ".join("?" * len(ids))})', ids
+                )
+                rows.update((row['index'], dict(row)) for row in cursor)
+        return [rows[position] for position in positions]
+
+    def status_columns(self, value):
+        """Hash, Amount, Description and parsed date of rows with Completion == value, for reconciliation."""
+        with self.lock:
+            rows = pd.read_sql_query(
+                'SELECT Hash, Amount, Description, date_key FROM master WHERE Completion = ? ORDER BY id', self.conn, params=(value,)
+            )
+        rows['date_key'] = pd.to_datetime(rows['date_key'])
+        return rows
+
+    def hashes(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT Hash FROM master')]
+
+    @timed('ledger.query_rows')
+    def query_rows(self, status=0, card=None, date_from=None, date_to=None, amount_min=None, amount_max=None,
+                   sort='index', descending=False, limit=None, cursor=None):
+        """Returns (rows, next_cursor, total) for rows matching the filters, in keyset-paginated sort order."""
+        where, params = [], []
+        if status is not None:
+            where.append('Completion = ?')
+            params.append(status)
+        if card:
+            where.append('"Card Name" = ?')
+            params.append(card)
+        if date_from:
+            where.append('date_key >= ?')
+            params.append(date_from)
+        if date_to:
+            where.append('date_key <= ?')
+            params.append(date_to)
+        if amount_min is not None:
+            where.append('Amount >= ?')
+            params.append(amount_min)
+        if amount_max is not None:
+            where.append('Amount <= ?')
+            params.append(amount_max)
+
+        sort_column = SQL_SORT_COLUMNS[sort]
+        page_where, page_params = list(where), list(params)
+        if cursor:
+            cursor_value, cursor_index = decode_cursor(cursor)
+            op = '<' if descending else '>'
+            page_where.append(f'({sort_column} {op} ? OR ({sort_column} = ? AND id {op} ?))')
+            page_params += [cursor_value, cursor_value, cursor_index + 1]
+
+        direction = 'DESC' if descending else 'ASC'
+        sql = (f'SELECT id - 1 AS "index", {SQL_COLUMNS}, {sort_column} AS sort_value FROM master'
+               f'{" WHERE " + " AND ".join(page_where) if page_where else ""}'
+               f' ORDER BY {sort_column} {direction}, id {direction}')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            page_params.append(limit + 1)
+
+        with self.lock:
+            rows = [dict(row) for row in self.conn.execute(sql, page_params)]
+            total = self.conn.execute(
+                f'SELECT COUNT(*) FROM master{" WHERE " + " AND ".join(where) if where else ""}', params
+            ).fetchone()[0]
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['sort_value'], rows[-1]['index'])
+        for row in rows:
+            del row['sort_value']
+        return rows, next_cursor, total
+
+    @timed('ledger.changes_since')
+    def changes_since(self, token):
+        """Returns (rows, version_token, reset): rows appended or changed since the token's version.
+
+        reset is True when the token is missing or from another database; the caller
+        should then reload with query_rows.
+        """
+        with self.lock:
+            version_token = f"{self.epoch}.{self.version}"
+            since = parse_version(token, self.epoch) if token else None
+            if since is None:
+                return [], version_token, True
+            cursor = self.conn.execute(
+                f'SELECT id - 1 AS "index", {SQL_COLUMNS} FROM master WHERE version > ? ORDER BY id', (since,)
+            )
+            return [dict(row) for row in cursor], version_token, False
+
+    def status_since(self, token):
+        """Returns (rows, version_token, reset): position, Hash and Completion of rows appended or changed since the token's version.
+
+        For indexes kept in step with the ledger. reset is True, and every row is returned,
+        when the token is missing or from another database.
+        """
+        with self.lock:
+            version_token = f"{self.epoch}.{self.version}"
+            since = parse_version(token, self.epoch) if token else None
+            if since is None:
+                query, params = 'SELECT id - 1 AS position, Hash, Completion FROM master ORDER BY id', ()
+            else:
+                query, params = 'SELECT id - 1 AS position, Hash, Completion FROM master WHERE version > ? ORDER BY id', (since,)
+            rows = pd.read_sql_query(query, self.conn, params=params)
+        return rows, version_token, since is None
+
+    def version_token(self):
+        with self.lock:
+            return f"{self.epoch}.{self.version}"
+
+    def has_hash(self, hash):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM master WHERE Hash = ? LIMIT 1', (str(hash),)).fetchone() is not None
+
+    @timed('ledger.append_rows')
+    def append_rows(self, new_rows_df):
+        """Inserts already hashed and standardized rows, in master.csv column order."""
+        new_rows_df = new_rows_df.astype(object).where(pd.notna(new_rows_df), None)
+        new_rows_df.iloc[:, MASTER_COLUMNS.index('Hash')] = new_rows_df.iloc[:, MASTER_COLUMNS.index('Hash')].astype(str)
+        date_keys = date_key_values(new_rows_df.iloc[:, 0])
+        with self.lock, self.conn:
+            self.version += 1
+            self.conn.executemany(
+                f'INSERT INTO master ({SQL_COLUMNS}, version, date_key) VALUES ({", ".join("?" * (len(MASTER_COLUMNS) + 2))})',
+                (row + (self.version, date_key) for row, date_key in zip(new_rows_df.itertuples(index=False, name=None), date_keys))
+            )
+
+    @timed('ledger.record_changes')
+    def record_changes(self, changes):
+        """Sets Completion for (hash, value) pairs in one transaction. Returns the number of rows changed."""
+        with self.lock, self.conn:
+            self.version += 1
+            cursor = self.conn.executemany(
+                'UPDATE master SET Completion = ?, version = ? WHERE Hash = ?',
+                [(value, self.version, str(hash)) for hash, value in changes]
+            )
+        return cursor.rowcount
+
+    @timed('ledger.record_pending_changes')
+    def record_pending_changes(self, changes):
+        """record_changes() for rows still pending (Completion 0) only. Returns the hashes it changed."""
+        with self.lock, self.conn:
+            self.version += 1
+            return [str(hash) for hash, value in changes
+                    if self.conn.execute('UPDATE master SET Completion = ?, version = ? WHERE Hash = ? AND Completion = 0',
+                                         (value, self.version, str(hash))).rowcount]
+
+    def update_completion(self, hash):
+        return self.record_changes([(hash, 1)]) > 0
+
+    def update_completion_bulk(self, hashes):
+        return self.record_changes([(hash, 1) for hash in hashes])
+
+    def update_sync_pending(self, hashes):
+        return self.record_changes([(hash, SYNC_PENDING) for hash in hashes])
+
+    def update_sync_failed(self, hashes):
+        return self.record_changes([(hash, 0) for hash in hashes])
+
+    def hashes_with_status(self, value):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT Hash FROM master WHERE Completion = ?', (value,))]
+
+    def update_ignore(self, hash):
+        try:
+            return self.record_changes([(hash, -1)]) > 0
+        except Exception as e:
+             print(f"Error ignoring transaction (setting completion to -1) for hash {hash}: {e}")
+             return False
+
+    def export_csv(self, csv_file='master.csv'):
+        with self.lock:
+            df = pd.read_sql_query(f'SELECT {SQL_COLUMNS} FROM master ORDER BY id', self.conn)
+        df.to_csv(csv_file, index=False)
+        return len(df)
+
+
+def import_master_csv(csv_file='master.csv', db_file='master.db', chunksize=100_000):
+    """One-shot import of an existing master.csv into a SQLite ledger."""
+    ledger = SqliteLedger(db_file)
+    imported = 0
+    for chunk in pd.read_csv(csv_file, chunksize=chunksize, dtype={'Hash': str}):
+        if chunk.empty:
+            continue
+        ledger.append_rows(chunk[MASTER_COLUMNS])
+        imported += len(chunk)
+    print(f"Imported {imported} rows from {csv_file} into {db_file}")
+    return ledger
+
+
+if __name__ == '__main__':
+    # python sqliteUtil.py import|export [master.csv] [master.db]
+    if len(sys.argv) < 2 or sys.argv[1] not in ('import', 'export'):
+        print("Usage: python sqliteUtil.py import|export [csv_file] [db_file]")
+        sys.exit(1)
+    csv_file = sys.argv[2] if len(sys.argv) > 2 else 'master.csv'
+    db_file = sys.argv[3] if len(sys.argv) > 3 else 'master.db'
+    if sys.argv[1] == 'import':
+        import_master_csv(csv_file, db_file).close()
+    else:
+        ledger = SqliteLedger(db_file)
+        print(f"Exported {ledger.export_csv(csv_file)} rows from {db_file} to {csv_file}")
+        ledger.close()
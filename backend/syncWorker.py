@@ -0,0 +1,280 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from googleapiclient.errors import HttpError
+
+from masterUtil import SYNC_PENDING
+from metrics import ROWS_SYNCED
+from sheetUtil import group_rows, append_values
+
+OUTBOX_FILE = 'sync_outbox.jsonl'
+SYNC_BATCH_SIZE = 200
+# Sheets allows 60 write requests per minute per user; stay just under it
+SYNC_RATE_PER_SECOND = 0.9
+SYNC_BURST = 10
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 300
+IDLE_POLL_SECONDS = 5
+OUTBOX_COMPACT_EVERY = 1000
+
+class TokenBucket:
+    """Async token bucket: refills at `rate` tokens per second up to `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self, tokens=1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class SyncOutbox:
+    """Durable queue of completions waiting to be pushed to Google Sheets.
+
+    Entries are appended to a JSON-lines file as they are queued and marked done
+    once synced, so a restart resumes with whatever was still outstanding.
+    """
+    def __init__(self, outbox_file=OUTBOX_FILE):
+        self.outbox_file = outbox_file
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.done_since_compact = 0
+        self.replay()
+
+    def __len__(self):
+        return len(self.items)
+
+    def replay(self):
+        if not os.path.exists(self.outbox_file):
+            return
+        with open(self.outbox_file, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry['op'] == 'add':
+                    self.items[entry['item']['hash']] = entry
+                else:
+                    for hash in entry['hashes']:
+                        self.items.pop(hash, None)
+        self.compact()
+        if self.items:
+            print(f"Resuming {len(self.items)} pending Google Sheets syncs from {self.outbox_file}")
+
+    def compact(self):
+        """Rewrites the outbox file with only the outstanding entries."""
+        with self.lock:
+            temp_file = self.outbox_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in self.items.values())
+            os.replace(temp_file, self.outbox_file)
+            self.done_since_compact = 0
+
+    def add(self, item):
+        """Queues an item. Returns False if the hash is already queued."""
+        return self.add_many([item]) == 1
+
+    def add_many(self, items):
+        """Queues items whose hash isn't already queued, in one file write. Returns how many were added."""
+        with self.lock:
+            queued_at = time.time()
+            entries = {}
+            for item in items:
+                if item['hash'] not in self.items and item['hash'] not in entries:
+                    entries[item['hash']] = {'op': 'add', 'item': item, 'queued_at': queued_at}
+            if entries:
+                with open(self.outbox_file, 'a') as f:
+                    f.writelines(json.dumps(entry) + '\n' for entry in entries.values())
+                self.items.update(entries)
+            return len(entries)
+
+    def peek(self, limit):
+        with self.lock:
+            return [entry['item'] for entry, _ in zip(self.items.values(), range(limit))]
+
+    def done(self, hashes):
+        with self.lock:
+            with open(self.outbox_file, 'a') as f:
+                f.write(json.dumps({'op': 'done', 'hashes': list(hashes)}) + '\n')
+            for hash in hashes:
+                self.items.pop(hash, None)
+            self.done_since_compact += 1
+            needs_compact = not self.items or self.done_since_compact >= OUTBOX_COMPACT_EVERY
+        if needs_compact:
+            self.compact()
+
+    def oldest_queued_at(self):
+        with self.lock:
+            return next(iter(self.items.values()))['queued_at'] if self.items else None
+
+class SyncWorker:
+    """Background task that drains the outbox into Google Sheets.
+
+    Items are sent in batches (one append per destination), rate limited by a
+    token bucket, with exponential backoff on 429/5xx and network errors. Other
+    API errors are permanent: the rows go back to pending so the user can retry.
+    Workers writing with the same Google account should share one bucket.
+    """
+    def __init__(self, ledger, service, executor, outbox_file=OUTBOX_FILE, targets=None, routes=None, bucket=None):
+        self.ledger = ledger
+        self.service = service
+        self.targets = targets
+        self.routes = routes
+        self.executor = executor
+        self.outbox = SyncOutbox(outbox_file)
+        self.bucket = bucket or TokenBucket(SYNC_RATE_PER_SECOND, SYNC_BURST)
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.failures = 0
+        self.backoff_until = 0
+        self.last_success_at = None
+        self.last_error = None
+        self.synced_count = 0
+
+    def enqueue(self, item):
+        """Records a completion for syncing and marks its ledger row pending-sync.
+
+        Returns False, without queueing, if the row is unknown or no longer pending, so a
+        repeated click can't send it twice. Blocking.
+        """
+        return bool(self.enqueue_pending([item]))
+
+    def enqueue_pending(self, items):
+        """enqueue() for the items whose rows are still pending, with one outbox write.
+
+        Rows completed or ignored since they were read are skipped. Returns the items queued. Blocking.
+        """
+        # Claimed in the ledger first: rows left pending-sync without an outbox entry are returned by start()
+        claimed = set(self.ledger.record_pending_changes([(item['hash'], SYNC_PENDING) for item in items]))
+        items = [item for item in items if item['hash'] in claimed]
+        if items:
+            self.outbox.add_many(items)
+        return items
+
+    async def append_now(self, items):
+        """Appends items to their sheets now, one request per destination, under the same rate limit
+        as the queue. The caller claims the rows first and records the outcome. Returns {hash: appended}.
+        """
+        loop = asyncio.get_running_loop()
+        results = {item['hash']: False for item in items}
+        groups, _ = group_rows(items, self.routes)
+        for (sheetID, range_to_append), group in groups.items():
+            await self.bucket.acquire()
+            try:
+                await loop.run_in_executor(self.executor, append_values, self.service, sheetID, range_to_append, group['values'])
+            except Exception as e:
+                print(f"Error appending {len(group['values'])} rows to {range_to_append}: {e}")
+                continue
+            results.update(dict.fromkeys(group['hashes'], True))
+        return results
+
+    def notify(self):
+        self.wakeup.set()
+
+    def start(self):
+        # Rows left pending-sync without an outbox entry (e.g. the outbox file was removed) go back to pending
+        orphaned = [hash for hash in self.ledger.hashes_with_status(SYNC_PENDING) if hash not in self.outbox.items]
+        if orphaned:
+            print(f"Returning {len(orphaned)} pending-sync rows without an outbox entry to pending")
+            self.ledger.update_sync_failed(orphaned)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            # wait_for() before 3.12 can swallow a cancel that lands as the wakeup fires; the flag still ends the loop
+            self.stopping = True
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self):
+        oldest = self.outbox.oldest_queued_at()
+        return {
+            "queue_depth": len(self.outbox),
+            "sync_lag_seconds": round(time.time() - oldest, 3) if oldest else 0,
+            "synced": self.synced_count,
+            "last_success_at": self.last_success_at,
+            "last_error": self.last_error,
+            "backoff_seconds": round(max(0, self.backoff_until - time.monotonic()), 3),
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            delay = self.backoff_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.wakeup.clear()
+            batch = self.outbox.peek(SYNC_BATCH_SIZE)
+            if not batch:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), IDLE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.sync_batch(loop, batch)
+
+    async def sync_batch(self, loop, batch):
+        groups, invalid = group_rows(batch, self.routes)
+        if invalid:
+            await loop.run_in_executor(self.executor, self.fail, invalid)
+
+        for (sheetID, range_to_append), group in groups.items():
+            await self.bucket.acquire()
+            try:
+                await loop.run_in_executor(self.executor, append_values, self.service, sheetID, range_to_append, group['values'])
+            except HttpError as err:
+                status = err.resp.status
+                self.last_error = f"HTTP {status} appending {len(group['values'])} rows to {range_to_append}"
+                if status == 429 or status >= 500:
+                    self.back_off(err.resp.get('retry-after'))
+                    return
+                print(f"Permanent Google Sheets error, returning {len(group['hashes'])} rows to pending: {self.last_error}")
+                await loop.run_in_executor(self.executor, self.fail, group['hashes'])
+                continue
+            except Exception as e:
+                self.last_error = f"{e} appending {len(group['values'])} rows to {range_to_append}"
+                self.back_off()
+                return
+
+            await loop.run_in_executor(self.executor, self.complete, group['hashes'])
+
+    def complete(self, hashes):
+        if self.targets is not None:
+            self.targets.record((hash, self.outbox.items[hash]['item']['sheetName']) for hash in hashes if hash in self.outbox.items)
+        # Ledger first: a crash before done() re-sends the rows rather than losing them
+        self.ledger.update_completion_bulk(hashes)
+        self.outbox.done(hashes)
+        self.failures = 0
+        self.synced_count += len(hashes)
+        ROWS_SYNCED.inc(len(hashes))
+        self.last_success_at = time.time()
+
+    def fail(self, hashes):
+        self.ledger.update_sync_failed(hashes)
+        self.outbox.done(hashes)
+
+    def back_off(self, retry_after=None):
+        self.failures += 1
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (self.failures - 1))
+        delay = delay * (0.5 + random.random() / 2)
+        if retry_after and str(retry_after).isdigit():
+            delay = max(delay, int(retry_after))
+        self.backoff_until = time.monotonic() + delay
+        print(f"Google Sheets sync backing off for {delay:.1f}s after: {self.last_error}")
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+from analytics import TARGETS_FILE, SheetTargets, SpendingAnalytics
+from duplicateMatcher import NearDuplicateIndex
+from formatSniffer import PROFILE_CACHE_FILE, FormatSniffer
+from masterUtil import open_ledger
+from metrics import TENANT_EVICTIONS, TENANT_LOADS
+from rulesEngine import RULES_FILE, RulesEngine
+from searchIndex import SearchIndex
+from sheetReconciler import SNAPSHOT_FILE, SheetReconciler
+from sheetUtil import DEFAULT_SHEETS, SHEETS_FILE, SheetRoutes
+from syncWorker import OUTBOX_FILE, SYNC_BURST, SYNC_RATE_PER_SECOND, SyncWorker, TokenBucket
+from transformer import HASH_INDEX_FILE, DedupeIndex
+from uploadCache import UPLOAD_CACHE_DIR, UPLOAD_CACHE_ROWS, UPLOAD_DIR, ResumableUploads, UploadCache
+
+CONFIG_FILE = 'config.json'
+# Set to run one server for many households, one subdirectory each; unset, the working directory holds the only ledger
+TENANTS_DIR = os.getenv('TENANTS_DIR')
+MAX_RESIDENT_TENANTS = int(os.getenv('MAX_RESIDENT_TENANTS', 32))
+# Tenant ids name directories, so they are kept to plain names
+TENANT_ID = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+
+def load_card_config(config_file=CONFIG_FILE):
+    """Card profiles from config_file; {} if it is missing or invalid."""
+    try:
+        with open(config_file, 'r') as f:
+            card_config = json.load(f)
+        print("Card configuration loaded successfully.")
+        return card_config
+    except FileNotFoundError:
+        print(f"ERROR: {config_file} not found!")
+    except json.JSONDecodeError:
+        print(f"ERROR: {config_file} is not valid JSON!")
+    return {}
+
+class Tenant:
+    """One household's ledger, with its dedupe and search indexes, card profiles, routing rules and sheets.
+
+    Every file is kept under directory: '' is the working directory, as in
+    single-tenant mode. A tenant without its own config.json uses the shared one.
+    Sheets come from the tenant's sheets.json, or default_sheets without one.
+    open() loads everything and close() saves and releases it, so a tenant can
+    be evicted and loaded again later.
+    """
+    def __init__(self, tenant_id, directory='', default_sheets=DEFAULT_SHEETS, upload_cache_rows=UPLOAD_CACHE_ROWS):
+        self.tenant_id = tenant_id
+        self.directory = directory
+        self.default_sheets = default_sheets
+        self.upload_cache_rows = upload_cache_rows
+        self.card_config = {}
+        self.format_sniffer = None
+        self.routes = None
+        self.rules_engine = None
+        self.ledger = None
+        self.hashes = None
+        self.search_index = None
+        self.sheet_targets = None
+        self.spending_analytics = None
+        self.near_duplicate_index = None
+        self.upload_cache = None
+        self.resumable_uploads = None
+        self.sync_worker = None
+        self.sheet_reconciler = None
+        self.refreshes = []
+        # Requests using the tenant; it is only evicted while there are none
+        self.active = 0
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def load(self):
+        """Reads the tenant's configuration, ledger and dedupe index. Blocking."""
+        config_file = self.path(CONFIG_FILE)
+        self.card_config = load_card_config(config_file if os.path.exists(config_file) else CONFIG_FILE)
+        self.format_sniffer = FormatSniffer(self.card_config, self.path(PROFILE_CACHE_FILE))
+        try:
+            self.routes = SheetRoutes.load(self.path(SHEETS_FILE), self.default_sheets)
+        except (ValueError, json.JSONDecodeError) as e:
+            print(f"ERROR: {self.path(SHEETS_FILE)} is invalid, no sheets are configured: {e}")
+            self.routes = SheetRoutes({})
+        if not self.routes.names:
+            print(f"ERROR: Tenant '{self.tenant_id}' has no sheets configured, so its rows can't be sent to Google Sheets. "
+                  f"Add {self.path(SHEETS_FILE)}.")
+        try:
+            self.rules_engine = RulesEngine.load(self.card_config, self.path(RULES_FILE), self.routes)
+            print(f"Loaded {len(self.rules_engine)} routing rules.")
+        except (ValueError, json.JSONDecodeError) as e:
+            print(f"ERROR: rules.json is invalid, auto-routing is off: {e}")
+            self.rules_engine = RulesEngine([], self.card_config, self.routes)
+
+        self.ledger = open_ledger(self.directory)
+        print(f"Loaded {len(self.ledger)} rows into the master ledger.")
+        self.hashes = DedupeIndex(self.path(HASH_INDEX_FILE))
+        self.hashes.load(self.ledger)
+        self.search_index = SearchIndex(self.ledger)
+        self.sheet_targets = SheetTargets(self.path(TARGETS_FILE))
+        self.spending_analytics = SpendingAnalytics(self.ledger, self.sheet_targets)
+        self.near_duplicate_index = NearDuplicateIndex(self.ledger)
+        self.upload_cache = UploadCache(self.path(UPLOAD_CACHE_DIR), max_rows=self.upload_cache_rows)
+        self.resumable_uploads = ResumableUploads(self.path(UPLOAD_DIR))
+
+    async def open(self, executor, google_service, build_indexes=True, sync_bucket=None):
+        """Loads the tenant on executor and starts its Sheets sync, rate limited by sync_bucket if given.
+
+        With build_indexes, the search, analytics and near-duplicate indexes are built
+        in the background; otherwise each is built by its first query.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self.load)
+        if build_indexes:
+            # A query before a build finishes waits for it
+            self.refreshes = [loop.run_in_executor(executor, index.refresh)
+                              for index in (self.search_index, self.spending_analytics, self.near_duplicate_index)]
+        if google_service:
+            self.sync_worker = SyncWorker(self.ledger, google_service, executor, self.path(OUTBOX_FILE),
+                                          targets=self.sheet_targets, routes=self.routes, bucket=sync_bucket)
+            self.sync_worker.start()
+            self.sheet_reconciler = SheetReconciler(self.ledger, google_service, self.path(SNAPSHOT_FILE), routes=self.routes)
+
+    async def close(self, executor):
+        """Stops the Sheets sync, then saves the dedupe index and closes the ledger."""
+        if self.sync_worker:
+            await self.sync_worker.stop()
+        # Index builds still running read the ledger
+        await asyncio.gather(*self.refreshes, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(executor, self.save)
+
+    def save(self):
+        self.hashes.save(self.ledger)
+        self.ledger.close()
+
+class Tenants:
+    """The tenants under tenants_dir, one subdirectory each, loaded on first use.
+
+    At most max_resident tenants stay loaded. Loading one more closes the least
+    recently used tenant that no request is using, so memory follows the number
+    of active tenants rather than all of them. If every tenant is in use, the
+    extra one is closed when a request releases it. A closed tenant's queued
+    Google Sheets rows stay in its outbox file and are sent once it is loaded again.
+    """
+    def __init__(self, tenants_dir, executor, google_service, max_resident=MAX_RESIDENT_TENANTS, sync_bucket=None):
+        self.tenants_dir = tenants_dir
+        self.executor = executor
+        self.google_service = google_service
+        # One Sheets write quota for all tenants, however many are loaded
+        self.sync_bucket = sync_bucket or TokenBucket(SYNC_RATE_PER_SECOND, SYNC_BURST)
+        self.max_resident = max(1, max_resident)
+        # Tenant id -> Tenant, least recently used first
+        self.resident = OrderedDict()
+        self.loading = {}
+        self.closing = {}
+
+    def exists(self, tenant_id):
+        return bool(TENANT_ID.match(tenant_id)) and os.path.isdir(os.path.join(self.tenants_dir, tenant_id))
+
+    async def acquire(self, tenant_id):
+        """The tenant, loaded if it isn't resident; pass it to release() when done. Raises KeyError for an unknown tenant."""
+        # Loop in case the tenant is evicted again between loading and this request resuming
+        while tenant_id not in self.resident:
+            if not self.exists(tenant_id):
+                raise KeyError(tenant_id)
+            if tenant_id not in self.loading:
+                self.loading[tenant_id] = asyncio.ensure_future(self.load(tenant_id))
+            await asyncio.shield(self.loading[tenant_id])
+        tenant = self.resident[tenant_id]
+        self.resident.move_to_end(tenant_id)
+        tenant.active += 1
+        return tenant
+
+    def release(self, tenant):
+        tenant.active -= 1
+        if len(self.resident) > self.max_resident:
+            self.evict()
+
+    async def load(self, tenant_id):
+        try:
+            # A tenant being evicted finishes writing its files before they are read again
+            if tenant_id in self.closing:
+                await asyncio.shield(self.closing[tenant_id])
+            started = time.perf_counter()
+            # The in-memory upload cache budget is shared by the resident tenants
+            tenant = Tenant(tenant_id, os.path.join(self.tenants_dir, tenant_id), default_sheets={},
+                            upload_cache_rows=max(1, UPLOAD_CACHE_ROWS // self.max_resident))
+            await tenant.open(self.executor, self.google_service, build_indexes=False, sync_bucket=self.sync_bucket)
+            self.resident[tenant_id] = tenant
+            TENANT_LOADS.inc()
+            print(f"Loaded tenant '{tenant_id}' in {time.perf_counter() - started:.3f}s ({len(self.resident)} resident).")
+            self.evict()
+        finally:
+            self.loading.pop(tenant_id, None)
+
+    def evict(self):
+        """Starts closing the least recently used idle tenants until at most max_resident are loaded."""
+        excess = len(self.resident) - self.max_resident
+        # The most recently used tenant may have just been loaded for a request that hasn't acquired it yet
+        idle = [tenant_id for tenant_id, tenant in list(self.resident.items())[:-1] if not tenant.active]
+        for tenant_id in idle[:max(0, excess)]:
+            tenant = self.resident.pop(tenant_id)
+            self.closing[tenant_id] = asyncio.ensure_future(self.close(tenant))
+            TENANT_EVICTIONS.inc()
+
+    async def close(self, tenant):
+        try:
+            await tenant.close(self.executor)
+        except Exception as e:
+            print(f"ERROR closing tenant '{tenant.tenant_id}': {e}")
+        finally:
+            self.closing.pop(tenant.tenant_id, None)
+
+    async def close_all(self):
+        """Closes every tenant, at shutdown."""
+        await asyncio.gather(*self.loading.values(), return_exceptions=True)
+        while self.resident:
+            tenant_id, tenant = self.resident.popitem(last=False)
+            self.closing[tenant_id] = asyncio.ensure_future(self.close(tenant))
+        await asyncio.gather(*self.closing.values())
@@ -1,36 +1,106 @@
+import numpy as np
 import pandas as pd
+import codecs
 import csv
 import hashlib
 from dateutil import parser
 import io
 import os
+import threading
 from typing import List, Tuple, Optional
 
+from hashIndex import DIGEST_DTYPE, HashIndex, key_to_digest
+from metrics import DUPLICATE_ROWS, ROWS_IMPORTED, ROWS_READ, profiling, record, span
+
+STREAM_BLOCK_SIZE = 1024 * 1024
+STREAM_CHUNK_ROWS = 50_000
+
+OUTPUT_DATE_FORMAT = "%A, %B %d, %Y"
+# Tried over every distinct date when a card has no date_format; the one that parses the most wins
+CANDIDATE_DATE_FORMATS = [
+    "%Y-%m-%d", "%m/%d/%Y", "%d/%m/%Y", "%Y/%m/%d", "%m/%d/%y", "%d/%m/%y",
+    "%m-%d-%Y", "%d-%m-%Y", "%d.%m.%Y", "%Y%m%d", "%b %d, %Y", "%d %b %Y",
+    "%d-%b-%Y", "%B %d, %Y", "%Y-%m-%d %H:%M:%S", "%m/%d/%Y %H:%M", OUTPUT_DATE_FORMAT,
+]
+
+
+HASH_INDEX_FILE = 'master.hashidx'
+
+class DedupeIndex:
+    """The hash index of one ledger's rows, saved to index_file between runs.
+
+    lock is held while checking and adding hashes, so concurrent uploads can't both accept the same row.
+    """
+    def __init__(self, index_file=HASH_INDEX_FILE):
+        self.index_file = index_file
+        self.index = HashIndex()
+        self.lock = threading.Lock()
+        # Ledger length index_file was written for
+        self.saved_rows = None
+
+    def load(self, ledger):
+        """Loads the index from index_file when it matches the ledger, otherwise from the ledger's hashes."""
+        saved_index = HashIndex.load(self.index_file, len(ledger))
+        if saved_index is not None:
+            self.index = saved_index
+            self.saved_rows = len(ledger)
+            print(f"Loaded {len(self.index)} hashes from {self.index_file}")
+            return
+        self.index = HashIndex(digest for digest in map(key_to_digest, ledger.hashes()) if digest is not None)
+        self.index.save(self.index_file, len(ledger))
+        self.saved_rows = len(ledger)
+        print(f"Preloaded {len(self.index)} hashes from the master ledger")
+
+    def save(self, ledger):
+        """Persists the index so the next startup can memory-map it instead of rebuilding."""
+        with self.lock:
+            # Hashes are only added along with ledger rows, so the file is current if the ledger hasn't grown
+            if self.saved_rows == len(ledger):
+                return
+            self.index.save(self.index_file, len(ledger))
+            self.saved_rows = len(ledger)
+
+# The index of master.csv in the working directory, used when no other DedupeIndex is given
+dedupe_index = DedupeIndex()
+
+def precheck_hash_dupe(ledger=None):
+    """Loads the default dedupe index, from its saved file when it matches the ledger, otherwise from the ledger's hashes."""
+    if ledger is not None:
+        dedupe_index.load(ledger)
+        return
 
-hash_dict = {}
-
-def precheck_hash_dupe():
-    global hash_dict
     try:
-        df = pd.read_csv("master.csv")
-        if 'Hash' in df.columns:
-             df['Hash'] = df['Hash'].astype(str)
-             hash_dict.update(df.set_index('Hash').to_dict('index'))
-             print(f"Preloaded {len(hash_dict)} hashes from master.csv")
-        else:
-             print("Warning: 'Hash' column not found in master.csv during precheck.")
-             hash_dict = {}
+        # masterUtil imports this module, so it is imported here
+        from masterUtil import read_snapshot
+        df, _ = read_snapshot("master.csv", columns=['Hash'])
+        if df is None:
+            df = pd.read_csv("master.csv", usecols=['Hash'], dtype=str)
+        dedupe_index.index = HashIndex(digest for digest in map(key_to_digest, df['Hash']) if digest is not None)
+        print(f"Preloaded {len(dedupe_index.index)} hashes from master.csv")
 
     except FileNotFoundError:
-        print("master.csv not found, starting with empty hash dictionary.")
-        hash_dict = {}
+        print("master.csv not found, starting with empty hash index.")
+        dedupe_index.index = HashIndex()
+    except ValueError:
+        print("Warning: 'Hash' column not found in master.csv during precheck.")
+        dedupe_index.index = HashIndex()
     except Exception as e:
         print(f"Error pre-loading hashes: {e}")
-        hash_dict = {}
+        dedupe_index.index = HashIndex()
+
+def to_row_dicts(df) -> List[dict]:
+    """df.to_dict(orient='records'), built column-wise; tolist() already gives native Python values."""
+    columns = list(df.columns)
+    return [dict(zip(columns, values)) for values in zip(*(df.iloc[:, i].tolist() for i in range(len(columns))))]
+
+def save_hash_index(ledger):
+    """Persists the default dedupe index so the next startup can memory-map it instead of rebuilding."""
+    dedupe_index.save(ledger)
 
 
 class Transformer:
-    def __init__(self, card_name: str, date_col: int, amount_col: int, description_col: int, category_col: Optional[int], header: bool, skip_rows: int):
+    def __init__(self, card_name: str, date_col: int, amount_col: int, description_col: int, category_col: Optional[int], header: bool, skip_rows: int, date_format: Optional[str] = None, rules=None,
+                 near_duplicates=None, hashes=None):
         self.card_name = card_name
         self.header = header
         self.date_col = date_col
@@ -38,6 +108,18 @@ class Transformer:
         self.description_col = description_col
         self.category_col = category_col
         self.skip_rows = skip_rows
+        self.date_format = date_format
+        self.date_cache = {}
+        # Optional RulesEngine; rows it routes to a sheet are collected in self.routed for the sync queue
+        self.rules = rules
+        self.routed = []
+        # Optional NearDuplicateIndex; appended rows that probably repeat a ledger row are collected in self.probable_duplicates
+        self.near_duplicates = near_duplicates
+        self.probable_duplicates = []
+        # DedupeIndex of the ledger rows are imported into
+        self.hashes = hashes if hashes is not None else dedupe_index
+        # Ledger length when a streamed import started, so later chunks aren't matched against earlier ones
+        self.ledger_rows = None
 
         # Build list of column indices to read from CSV
         self.cols_to_read = [self.date_col, self.amount_col, self.description_col]
@@ -51,9 +133,15 @@ class Transformer:
         self.output_desc_col_name = self.description_col
         self.output_cat_col_name = self.category_col if self.category_col is not None else 'Category_Placeholder'
 
+        # Running totals across reformat_csv calls, used to summarize streamed imports
+        self.rows_checked = 0
+        self.rows_appended = 0
 
-    def reformat_csv(self, inputCSV) -> Tuple[bool, List[str]]:
+    def reformat_csv(self, inputCSV, ledger=None) -> Tuple[bool, List[str], List]:
         """Process CSV file and append new transactions to master.csv.
+
+        When a ledger (masterUtil) is given, new rows are appended through it so
+        its in-memory view stays in sync with master.csv.
         
         Returns:
             Tuple[bool, List[str], List]: (success, messages, duplicate_rows)
@@ -61,6 +149,140 @@ class Transformer:
         all_messages = []
         success = False
 
+        with span('transformer.read_csv'):
+            df_ordered, date_col_actual_name, read_messages = self.read_rows(inputCSV)
+        all_messages.extend(read_messages)
+        if df_ordered.empty:
+            return True, all_messages, []
+        ROWS_READ.inc(len(df_ordered))
+
+        # Process hashing and remove duplicates
+        inputCSV.seek(0)
+        df_final, hash_messages, duplicate_rows = self.append_hash(inputCSV, df_ordered)
+        all_messages.extend(hash_messages)
+        DUPLICATE_ROWS.inc(len(duplicate_rows))
+
+        if df_final.empty:
+            msg = "No new transactions found after duplicate check."
+            all_messages.append(msg)
+            print(msg)
+            return True, all_messages, duplicate_rows
+
+        # Standardize date formatting
+        all_messages.extend(self.standardize_date_column(df_final, date_col_actual_name))
+        return self.store_rows(df_final, ledger, all_messages, duplicate_rows)
+
+    def import_prepared(self, rows, digests, messages, ledger=None) -> Tuple[bool, List[str], List]:
+        """reformat_csv for an upload already parsed, hashed and standardized by prepare().
+
+        Used when an identical upload was prepared before (see UploadCache), so the
+        file isn't parsed again. rows isn't modified.
+
+        Returns:
+            Tuple[bool, List[str], List]: (success, messages, duplicate_rows)
+        """
+        all_messages = list(messages)
+        self.rows_checked = len(rows)
+        if rows.empty:
+            return True, all_messages, []
+        ROWS_READ.inc(len(rows))
+
+        df_final, dedupe_messages, duplicate_rows = self.dedupe(rows, digests)
+        all_messages.extend(dedupe_messages)
+        DUPLICATE_ROWS.inc(len(duplicate_rows))
+
+        if df_final.empty:
+            msg = "No new transactions found after duplicate check."
+            all_messages.append(msg)
+            print(msg)
+            return True, all_messages, duplicate_rows
+        return self.store_rows(df_final, ledger, all_messages, duplicate_rows)
+
+    def store_rows(self, df_final, ledger, all_messages, duplicate_rows) -> Tuple[bool, List[str], List]:
+        """Applies the rules to new, standardized rows and appends them to master.csv (through ledger if given)."""
+        success = False
+        if self.rules is not None and len(self.rules):
+            with span('transformer.rules'):
+                all_messages.extend(self.apply_rules(df_final))
+
+        # Write processed data to master.csv
+        master_file = "master.csv"
+        file_exists = os.path.exists(master_file)
+        is_empty = file_exists and os.path.getsize(master_file) == 0
+
+        try:
+            if ledger is not None:
+                before = self.ledger_rows if self.ledger_rows is not None else len(ledger)
+                ledger.append_rows(df_final)
+            else:
+                with span('ledger.append_rows'):
+                    df_final.to_csv(
+                        master_file,
+                        mode='a',
+                        header=not file_exists or is_empty,
+                        index=False
+                    )
+            success_msg = f"Appended {len(df_final)} new rows to {master_file}."
+            all_messages.append(success_msg)
+            print(success_msg)
+            self.rows_appended += len(df_final)
+            ROWS_IMPORTED.inc(len(df_final))
+            success = True
+            if ledger is not None and self.near_duplicates is not None:
+                all_messages.extend(self.flag_near_duplicates(df_final, before))
+
+        except Exception as e:
+            error_msg = f"Error writing to {master_file}: {e}"
+            all_messages.append(error_msg)
+            print(error_msg)
+            success = False
+
+        return success, all_messages, duplicate_rows
+
+    def flag_near_duplicates(self, df, before) -> List[str]:
+        """Collects appended rows that probably repeat a ledger row from before position before."""
+        matches = self.near_duplicates.match(df, before)
+        self.probable_duplicates.extend(matches)
+        if not matches:
+            return []
+        return [f"Flagged {len(matches)} new rows as probable duplicates of existing transactions."]
+
+    def prepare(self, inputCSV) -> Tuple[pd.DataFrame, np.ndarray, List[str]]:
+        """Parse, hash and standardize an upload without touching the hash index or the ledger.
+
+        Batch imports run this for each file in parallel and dedupe all of them in
+        one step afterwards (see import_uploads).
+
+        Returns:
+            Tuple[pd.DataFrame, np.ndarray, List[str]]: (rows with Hash set, digests, messages)
+        """
+        with span('transformer.read_csv'):
+            df_ordered, date_col_actual_name, messages = self.read_rows(inputCSV)
+        if df_ordered.empty:
+            return df_ordered, np.empty(0, dtype=DIGEST_DTYPE), messages
+
+        inputCSV.seek(0)
+        df_final, digests, hash_messages = self.hash_rows(inputCSV, df_ordered)
+        messages.extend(hash_messages)
+        messages.extend(self.standardize_date_column(df_final, date_col_actual_name))
+        return df_final, digests, messages
+
+    def apply_rules(self, df) -> List[str]:
+        """Marks rows matched by an ignore rule as ignored in place and queues sheet-routed rows in self.routed."""
+        ignore_mask, items = self.rules.route(df)
+        df.loc[ignore_mask, 'Completion'] = -1
+        self.routed.extend(items)
+        if not ignore_mask.any() and not items:
+            return []
+        return [f"Rules routed {len(items)} rows to sheets and ignored {int(ignore_mask.sum())} rows."]
+
+    def read_rows(self, inputCSV) -> Tuple[pd.DataFrame, Optional[object], List[str]]:
+        """Read the configured columns of an upload in master.csv column order, with Hash still unset.
+
+        Returns:
+            Tuple[pd.DataFrame, Optional[object], List[str]]: (rows, date column name, messages)
+        """
+        all_messages = []
         header_param = 0 if self.header else None
 
         try:
@@ -84,7 +306,7 @@ class Transformer:
             msg = f"No data read from CSV for card '{self.card_name}' (possibly empty or only skipped rows)."
             all_messages.append(msg)
             print(msg)
-            return True, all_messages
+            return df, None, all_messages
 
         # Map CSV columns to expected order for master.csv
         actual_col_names = df.columns.tolist()
@@ -123,150 +345,340 @@ class Transformer:
              if output_category_col_name not in df_ordered.columns:
                   df_ordered[output_category_col_name] = None
 
+        return df_ordered, map_original_index_to_actual_name.get(self.date_col), all_messages
 
-        # Process hashing and remove duplicates
-        inputCSV.seek(0)
-        df_final, hash_messages, duplicate_rows = self.append_hash(inputCSV, df_ordered)
-        all_messages.extend(hash_messages)
-
-        if df_final.empty:
-            msg = "No new transactions found after duplicate check."
-            all_messages.append(msg)
-            print(msg)
-            return True, all_messages, duplicate_rows
-
-        # Standardize date formatting
-        date_col_actual_name = map_original_index_to_actual_name.get(self.date_col)
-        if date_col_actual_name and date_col_actual_name in df_final.columns:
+    def standardize_date_column(self, df, date_col_actual_name) -> List[str]:
+        """Standardize the date column of df in place. Returns any warning messages."""
+        messages = []
+        if date_col_actual_name is not None and date_col_actual_name in df.columns:
              try:
-                 df_final[date_col_actual_name] = df_final[date_col_actual_name].apply(self.standardize_date)
+                 with span('transformer.standardize_date'):
+                     df[date_col_actual_name] = self.standardize_dates(df[date_col_actual_name])
              except Exception as e:
                  msg = f"Warning: Error standardizing date column '{date_col_actual_name}': {e}"
-                 all_messages.append(msg)
+                 messages.append(msg)
                  print(msg)
         else:
              msg = f"Warning: Could not find date column (index {self.date_col}) to standardize."
-             all_messages.append(msg)
+             messages.append(msg)
              print(msg)
+        return messages
 
 
-        # Write processed data to master.csv
-        master_file = "master.csv"
-        file_exists = os.path.exists(master_file)
-        is_empty = file_exists and os.path.getsize(master_file) == 0
-
-        try:
-            df_final.to_csv(
-                master_file,
-                mode='a',
-                header=not file_exists or is_empty,
-                index=False
-            )
-            success_msg = f"Appended {len(df_final)} new rows to {master_file}."
-            all_messages.append(success_msg)
-            print(success_msg)
-            success = True
-
-        except Exception as e:
-            error_msg = f"Error writing to {master_file}: {e}"
-            all_messages.append(error_msg)
-            print(error_msg)
-            success = False
-
-        return success, all_messages, duplicate_rows
+    def reformat_csv_stream(self, inputFile, ledger=None, chunk_rows=STREAM_CHUNK_ROWS) -> Tuple[bool, List[str], List]:
+        """Process a CSV file chunk by chunk so memory stays bounded regardless of file size.
 
+        Each chunk of chunk_rows lines is parsed, hashed, deduplicated and appended
+        with reformat_csv, prefixed by the file's skipped and header lines.
 
-    def append_hash(self, inputCSV, df) -> Tuple[pd.DataFrame, List[str], List]:
-        """Generate hashes for transactions and filter out duplicates.
-        
         Returns:
-            Tuple[pd.DataFrame, List[str], List]: (filtered_df, messages, duplicate_rows)
+            Tuple[bool, List[str], List]: (success, messages, duplicate_rows)
         """
-        global hash_dict
-        messages = []
-        rows_to_drop = []
+        all_messages = []
+        duplicate_rows = []
+        chunk_count = 0
+        self.rows_checked = 0
+        self.rows_appended = 0
+        self.ledger_rows = len(ledger) if ledger is not None else None
+
+        for chunk in self.iter_csv_chunks(inputFile, chunk_rows):
+            chunk_count += 1
+            success, messages, chunk_duplicates = self.reformat_csv(chunk, ledger)
+            duplicate_rows.extend(chunk_duplicates)
+            if not success:
+                all_messages.extend(messages)
+                all_messages.append(f"Stopped streaming import at chunk {chunk_count}.")
+                return False, all_messages, duplicate_rows
+
+        all_messages.append(f"Successfully read CSV using config for '{self.card_name}' in {chunk_count} chunks.")
+        if duplicate_rows:
+            all_messages.append(f"Checked {self.rows_checked} data lines: Found and skipped {len(duplicate_rows)} duplicate rows based on existing hashes.")
+        else:
+            all_messages.append(f"Checked {self.rows_checked} data lines: No duplicates found based on existing hashes.")
+        if self.rows_appended == 0:
+            all_messages.append("No new transactions found after duplicate check.")
+        else:
+            all_messages.append(f"Appended {self.rows_appended} new rows to master.csv.")
+        if self.probable_duplicates:
+            all_messages.append(f"Flagged {len(self.probable_duplicates)} new rows as probable duplicates of existing transactions.")
+        return True, all_messages, duplicate_rows
 
+    def iter_csv_chunks(self, inputFile, chunk_rows):
+        """Yield BytesIO chunks of at most chunk_rows lines, each starting with the file's skipped/header lines.
+
+        Lines are split exactly like append_hash splits a whole upload, so hashes match a non-streamed import.
+        """
         lines_to_skip = self.skip_rows
         if self.header:
             lines_to_skip += 1
 
-        file_content = inputCSV.getvalue().decode("utf-8")
-        lines = file_content.splitlines()
-
-        processed_line_count = 0
-        duplicate_count = 0
-        new_hashes_added_to_dict = 0
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        prefix_lines = []
+        chunk_lines = []
+        carry = ''
+        while True:
+            block = inputFile.read(STREAM_BLOCK_SIZE)
+            text = carry + decoder.decode(block, final=not block)
+            lines = text.splitlines(keepends=True)
+            # Keep a trailing partial line (or a lone '\r' that may be half of '\r\n') for the next block
+            carry = lines.pop() if block and lines and (lines[-1] == lines[-1].rstrip('\r\n') or lines[-1].endswith('\r')) else ''
+
+            for line in lines:
+                if len(prefix_lines) < lines_to_skip:
+                    prefix_lines.append(line)
+                    continue
+                chunk_lines.append(line)
+                if len(chunk_lines) >= chunk_rows:
+                    yield io.BytesIO(''.join(prefix_lines + chunk_lines).encode("utf-8"))
+                    chunk_lines = []
+
+            if not block:
+                break
 
-        current_data_row_index = 0
-        for line_index, line in enumerate(lines):
-            if line_index < lines_to_skip:
-                continue
-            if not line.strip():
-                continue
+        if chunk_lines:
+            yield io.BytesIO(''.join(prefix_lines + chunk_lines).encode("utf-8"))
 
-            if current_data_row_index >= len(df):
-                messages.append(f"Warning: More lines in CSV than rows in DataFrame. Stopped processing at line {line_index + 1}.")
-                break
+    def append_hash(self, inputCSV, df) -> Tuple[pd.DataFrame, List[str], List]:
+        """Generate hashes for transactions and filter out duplicates.
+        
+        Returns:
+            Tuple[pd.DataFrame, List[str], List]: (filtered_df, messages, duplicate_rows)
+        """
+        df, digests, messages = self.hash_rows(inputCSV, df)
+        df_filtered, dedupe_messages, duplicate_rows = self.dedupe(df, digests)
+        return df_filtered, messages + dedupe_messages, duplicate_rows
 
-            processed_line_count += 1
-            str_bytes = bytes(line, "UTF-8")
-            m = hashlib.md5(str_bytes)
-            hash_val_hex = m.hexdigest()
-            hash_key = str(int(hash_val_hex, base=16))
+    def dedupe(self, df, digests) -> Tuple[pd.DataFrame, List[str], List]:
+        """Drop hashed rows already in the hash index or repeated within df, and add the rest to the index.
 
-            if self.check_hashDict(hash_key):
-                rows_to_drop.append(df.index[current_data_row_index])
-                duplicate_count += 1
-            else:
-                df.loc[df.index[current_data_row_index], 'Hash'] = hash_key
-                self.append_hashDict(df.loc[df.index[current_data_row_index]])
-                if hash_key in hash_dict:
-                     new_hashes_added_to_dict +=1
+        Returns:
+            Tuple[pd.DataFrame, List[str], List]: (filtered_df, messages, duplicate_rows)
+        """
+        messages = []
+        processed_line_count = len(df)
 
+        # A row is a duplicate if its hash is already known or appeared earlier in this file
+        with span('transformer.dedupe'), self.hashes.lock:
+            duplicate_mask = self.check_hashDict(digests) | df['Hash'].duplicated().to_numpy()
+            new_hashes_added_to_index = self.append_hashDict(digests[~duplicate_mask])
+        duplicate_count = int(duplicate_mask.sum())
 
-            current_data_row_index += 1
-        
         duplicate_rows = []
         if duplicate_count > 0:
             messages.append(f"Checked {processed_line_count} data lines: Found and skipped {duplicate_count} duplicate rows based on existing hashes.")
-            df_duplicates = df.loc[rows_to_drop].copy()
-            df_duplicates = df_duplicates.iloc[:, :-2]
-            duplicate_rows = df_duplicates.to_dict(orient='records')
+            duplicate_rows = to_row_dicts(df[duplicate_mask].iloc[:, :-2])
         else:
             messages.append(f"Checked {processed_line_count} data lines: No duplicates found based on existing hashes.")
-        
-        if new_hashes_added_to_dict > 0:
-             messages.append(f"Added {new_hashes_added_to_dict} new transaction hashes to the runtime dictionary.")
 
-        df_filtered = df.drop(index=rows_to_drop)
+        df_filtered = df[~duplicate_mask]
+        if new_hashes_added_to_index > 0:
+             messages.append(f"Added {new_hashes_added_to_index} new transaction hashes to the runtime dictionary.")
 
         return df_filtered.reset_index(drop=True), messages, duplicate_rows
 
+    def hash_rows(self, inputCSV, df) -> Tuple[pd.DataFrame, np.ndarray, List[str]]:
+        """Set the Hash column of df from the upload's raw lines.
+
+        Returns:
+            Tuple[pd.DataFrame, np.ndarray, List[str]]: (hashed rows, digests, messages)
+        """
+        messages = []
+
+        with span('transformer.hash'):
+            hash_keys, digests = self.hash_lines(inputCSV)
+        processed_line_count = min(len(hash_keys), len(df))
+        if len(hash_keys) > len(df):
+            messages.append(f"Warning: More lines in CSV than rows in DataFrame. Stopped processing after {len(df)} data lines.")
+        elif len(hash_keys) < len(df):
+            messages.append(f"Warning: Fewer lines in CSV than rows in DataFrame. Only the first {len(hash_keys)} rows were processed.")
+        self.rows_checked += processed_line_count
+
+        df = df.iloc[:processed_line_count].copy()
+        df['Hash'] = pd.Series(hash_keys[:processed_line_count], index=df.index, dtype=object)
+        return df, digests[:processed_line_count], messages
+
+    def hash_lines(self, inputCSV) -> Tuple[List[str], np.ndarray]:
+        """Hash every non-blank data line of the upload.
+
+        Returns the master.csv Hash keys (md5 of the raw line as a decimal string)
+        and the same hashes as 16-byte digests for the dedupe index.
+        """
+        lines_to_skip = self.skip_rows
+        if self.header:
+            lines_to_skip += 1
+
+        lines = inputCSV.getvalue().decode("utf-8").splitlines()[lines_to_skip:]
+        md5 = hashlib.md5
+        digests = [md5(line.encode("utf-8")).digest() for line in lines if line.strip()]
+        from_bytes = int.from_bytes
+        hash_keys = [str(from_bytes(digest, "big")) for digest in digests]
+        return hash_keys, np.asarray(digests, dtype=DIGEST_DTYPE)
+
+    def standardize_dates(self, dates: pd.Series) -> pd.Series:
+        """Standardize a whole date column.
+
+        Each distinct string is parsed once: in bulk with the card's date_format (or
+        one inferred from all the distinct values), falling back to standardize_date
+        for values that don't match. Results are cached for later chunks.
+        """
+        dates = dates.astype(object).where(dates.notna(), '').astype(str)
+        new_values = pd.Index(dates.unique()).difference(pd.Index(list(self.date_cache)))
+
+        if len(new_values):
+            if self.date_format is None:
+                self.date_format = self.infer_date_format(new_values)
+            parsed = pd.Series(pd.NaT, index=new_values)
+            if self.date_format is not None:
+                parsed = pd.Series(pd.to_datetime(new_values, format=self.date_format, errors='coerce'), index=new_values)
+            formatted = parsed.dt.strftime(OUTPUT_DATE_FORMAT)
+            for value, result in formatted.items():
+                self.date_cache[value] = result if isinstance(result, str) else self.standardize_date(value)
+
+        return dates.map(self.date_cache)
+
+    def infer_date_format(self, values) -> Optional[str]:
+        """Return the candidate format that parses the most of values, each candidate tried once over all of them.
+
+        None if no candidate parses any value, or if candidates that read the values
+        differently parse as many (e.g. every day is 12 or less, so %m/%d/%Y and
+        %d/%m/%Y both fit). Such values are parsed one by one, and a later chunk of
+        a streamed import can still settle the format.
+        """
+        values = pd.Index([value for value in values if value.strip()])
+        if values.empty:
+            return None
+        best, best_count, best_parsed, tied = None, 0, None, []
+        for date_format in CANDIDATE_DATE_FORMATS:
+            parsed = pd.to_datetime(values, format=date_format, errors='coerce')
+            count = int(parsed.notna().sum())
+            if count > best_count:
+                best, best_count, best_parsed, tied = date_format, count, parsed, []
+            elif count and count == best_count and not parsed.equals(best_parsed):
+                tied.append(date_format)
+        if best is None:
+            print(f"Could not infer a date format for '{self.card_name}'; falling back to per-value parsing.")
+            return None
+        if tied:
+            print(f"Dates of '{self.card_name}' fit {' and '.join([best] + tied)} alike; parsing each value. "
+                  "Set date_format for the card in config.json to pick one.")
+            return None
+        return best
+
     def standardize_date(self, date_str):
         try:
             if pd.isna(date_str) or date_str == '': return None
             if not isinstance(date_str, str): date_str = str(date_str)
             parsed_date = parser.parse(date_str)
-            return parsed_date.strftime("%A, %B %d, %Y")
+            return parsed_date.strftime(OUTPUT_DATE_FORMAT)
         except Exception as e:
              print(f"Error parsing date '{date_str}': {e}. Returning original.")
              return date_str
 
-    def check_hashDict(self, new_hash_str):
-        global hash_dict
-        return str(new_hash_str) in hash_dict
+    def check_hashDict(self, digests) -> np.ndarray:
+        """Return a boolean mask of which digests are already in the hash index."""
+        return self.hashes.index.contains(digests)
 
-    def append_hashDict(self, new_data_row_series):
-        global hash_dict
-        new_hash = new_data_row_series.get('Hash')
-        if pd.isna(new_hash):
-             print("Warning: Trying to add row with NA hash to hash_dict. Skipping.")
-             return
-        new_hash_str = str(new_hash)
+    def append_hashDict(self, digests) -> int:
+        """Add new digests to the hash index in bulk. Returns how many were added."""
+        return self.hashes.index.add(digests)
 
-        if new_hash_str in hash_dict:
-            return
 
-        # Store row data in hash dictionary
-        dataAdd = new_data_row_series.drop('Hash').to_dict()
-        hash_dict[new_hash_str] = dataAdd
+def prepare_upload(transformer_kwargs, file_name, file_bytes):
+    """Process-pool entry point for batch imports: parse, hash and standardize one file.
+
+    Returns a dict for import_uploads; errors are reported in it rather than raised
+    so one bad file doesn't fail the whole batch.
+    """
+    transformer = Transformer(**transformer_kwargs)
+    # Stage timings are recorded in this worker process, so they go back with the result
+    with profiling() as profile:
+        try:
+            rows, digests, messages = transformer.prepare(io.BytesIO(file_bytes))
+        except Exception as e:
+            return {"file": file_name, "card": transformer.card_name, "error": str(e), "messages": [f"Error reading CSV for card '{transformer.card_name}': {e}"],
+                    "spans": profile.spans}
+    return {"file": file_name, "card": transformer.card_name, "rows": rows, "digests": digests, "messages": messages, "spans": profile.spans}
+
+def import_uploads(prepared, ledger, rules=None, near_duplicates=None, hashes=None) -> Tuple[bool, List[dict], List[dict]]:
+    """Dedupe prepared uploads against the hash index and each other, then append all new rows in one write.
+
+    A row repeated across files is kept from the first file it appears in. With a
+    RulesEngine, new rows matching an ignore rule are stored as ignored and rows
+    routed to a sheet are returned as sync items. With a NearDuplicateIndex, each
+    file's new rows are matched against the ledger and the files before it.
+    hashes is the ledger's DedupeIndex (the default one if None).
+
+    Returns:
+        Tuple[bool, List[dict], List[dict]]: (success, per-file summaries, routed sync items)
+    """
+    from masterUtil import MASTER_COLUMNS
+
+    summaries = []
+    frames = []
+    for upload in prepared:
+        for stage, seconds in upload.get("spans", ()):
+            record(stage, seconds)
+        summary = {"file": upload["file"], "card": upload["card"], "rows": 0, "appended": 0, "duplicates": 0,
+                   "duplicate_rows": [], "probable_duplicates": [], "details": list(upload["messages"])}
+        if "error" in upload:
+            summary["error"] = upload["error"]
+        elif len(upload["rows"]):
+            summary["rows"] = len(upload["rows"])
+            # Cards name their columns differently, so line them up by position; object dtype keeps
+            # each file's values as written (an int Amount column isn't upcast by another file's floats)
+            frames.append((summary, upload["rows"].set_axis(MASTER_COLUMNS, axis=1).astype(object), upload["digests"]))
+        summaries.append(summary)
+
+    if not frames:
+        return all("error" not in summary for summary in summaries), summaries, []
+
+    combined = pd.concat([rows for _, rows, _ in frames], ignore_index=True)
+    digests = np.concatenate([file_digests for _, _, file_digests in frames])
+    hashes = hashes if hashes is not None else dedupe_index
+    with span('transformer.dedupe'), hashes.lock:
+        duplicate_mask = hashes.index.contains(digests) | combined['Hash'].duplicated().to_numpy()
+        hashes.index.add(digests[~duplicate_mask])
+    ROWS_READ.inc(len(combined))
+    DUPLICATE_ROWS.inc(int(duplicate_mask.sum()))
+
+    start = 0
+    for summary, rows, _ in frames:
+        file_mask = duplicate_mask[start:start + len(rows)]
+        start += len(rows)
+        summary["duplicates"] = int(file_mask.sum())
+        summary["appended"] = len(rows) - summary["duplicates"]
+        summary["duplicate_rows"] = to_row_dicts(rows[file_mask].iloc[:, :-2])
+        summary["details"].append(f"Checked {len(rows)} data lines: {summary['appended']} new, {summary['duplicates']} duplicates across the master ledger and this batch.")
+
+    new_rows = combined[~duplicate_mask].copy()
+    if new_rows.empty:
+        return all("error" not in summary for summary in summaries), summaries, []
+
+    routed = []
+    if rules is not None and len(rules):
+        with span('transformer.rules'):
+            ignore_mask, routed = rules.route(new_rows)
+        new_rows.loc[ignore_mask, 'Completion'] = -1
+
+    try:
+        before = len(ledger)
+        ledger.append_rows(new_rows)
+        ROWS_IMPORTED.inc(len(new_rows))
+        print(f"Appended {len(new_rows)} new rows from {len(frames)} files to master.csv.")
+    except Exception as e:
+        error_msg = f"Error writing to master.csv: {e}"
+        print(error_msg)
+        for summary, _, _ in frames:
+            summary["appended"] = 0
+            summary["details"].append(error_msg)
+        return False, summaries, []
+
+    if near_duplicates is not None:
+        start = 0
+        for summary, _, _ in frames:
+            file_rows = new_rows.iloc[start:start + summary["appended"]]
+            summary["probable_duplicates"] = near_duplicates.match(file_rows, before + start)
+            start += summary["appended"]
+            if summary["probable_duplicates"]:
+                summary["details"].append(f"Flagged {len(summary['probable_duplicates'])} new rows as probable duplicates of existing transactions.")
+    return all("error" not in summary for summary in summaries), summaries, routed
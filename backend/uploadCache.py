@@ -0,0 +1,237 @@
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+UPLOAD_CACHE_DIR = 'upload_cache'
+# Parsed rows kept in memory across all cached uploads; older uploads stay on disk only
+UPLOAD_CACHE_ROWS = int(os.getenv('UPLOAD_CACHE_ROWS', 500_000))
+UPLOAD_CACHE_FILES = int(os.getenv('UPLOAD_CACHE_FILES', 200))
+# Bumped when what prepare() returns changes, so older cache files are ignored
+UPLOAD_CACHE_VERSION = 1
+REUSED_MESSAGE = "Reused the parsed result of an identical earlier upload."
+
+UPLOAD_DIR = 'uploads'
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+# Unfinished chunked uploads are deleted after this long without a new chunk
+UPLOAD_SESSION_SECONDS = 24 * 60 * 60
+
+def file_digest(file_bytes) -> str:
+    return hashlib.sha256(file_bytes).hexdigest()
+
+def profile_key(transformer_kwargs) -> str:
+    """Fingerprint of the card settings an upload is parsed with; editing the card in config.json changes it."""
+    settings = dict(transformer_kwargs, cache_version=UPLOAD_CACHE_VERSION)
+    return hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+class UploadCache:
+    """Transformer.prepare results (parsed, hashed and standardized rows) by file digest and card settings.
+
+    Uploading the same statement again, after a dropped connection or to be sure it
+    went through, then skips parsing and hashing: its rows only go through the
+    dedupe check, which reports them as duplicates. Recent results are kept in memory
+    up to max_rows rows, least recently used first out, and every result is also
+    written to cache_dir (up to max_files files) so it survives a restart.
+    """
+    def __init__(self, cache_dir=UPLOAD_CACHE_DIR, max_rows=UPLOAD_CACHE_ROWS, max_files=UPLOAD_CACHE_FILES):
+        self.cache_dir = cache_dir
+        self.max_rows = max_rows
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, file_bytes, transformer_kwargs) -> str:
+        return f"{file_digest(file_bytes)}-{profile_key(transformer_kwargs)}"
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def get(self, key):
+        """(rows, digests, messages) for key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        try:
+            with open(self.path(key), 'rb') as f:
+                entry = pickle.load(f)
+            # Keeps recently used files from being pruned first
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable upload cache file {self.path(key)}: {e}")
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.remember(key, entry)
+        return entry
+
+    def put(self, key, rows, digests, messages):
+        entry = (rows, digests, list(messages))
+        with self.lock:
+            self.remember(key, entry)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Two uploads of the same file can be put at once; each writes its own temp file
+        temp_file = f"{self.path(key)}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self.path(key))
+        self.prune()
+
+    def remember(self, key, entry):
+        if key in self.entries:
+            self.rows -= len(self.entries.pop(key)[0])
+        self.entries[key] = entry
+        self.rows += len(entry[0])
+        while self.rows > self.max_rows and len(self.entries) > 1:
+            _, (rows, _, _) = self.entries.popitem(last=False)
+            self.rows -= len(rows)
+
+    def prune(self):
+        """Deletes the least recently used cache files beyond max_files."""
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.pkl')]
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def prepare(self, transformer, file_bytes, transformer_kwargs):
+        """transformer.prepare(file_bytes), from the cache when possible. Returns (rows, digests, messages, cached)."""
+        key = self.key(file_bytes, transformer_kwargs)
+        entry = self.get(key)
+        if entry is not None:
+            rows, digests, messages = entry
+            return rows, digests, messages + [REUSED_MESSAGE], True
+        rows, digests, messages = transformer.prepare(io.BytesIO(file_bytes))
+        self.put(key, rows, digests, messages)
+        return rows, digests, messages, False
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "rows": self.rows, "hits": self.hits, "misses": self.misses}
+
+class ResumableUploads:
+    """Statements sent in chunks, written to upload_dir as they arrive.
+
+    An upload is started with its size (and optionally its SHA-256), then chunks
+    are written at the offset the server reports, so after a dropped connection
+    the client asks for the offset and carries on from there. Starting the same
+    file again (same name, size, SHA-256 and card) returns the unfinished upload.
+    Sessions are kept on disk, so they survive a restart.
+    """
+    def __init__(self, upload_dir=UPLOAD_DIR, expire_seconds=UPLOAD_SESSION_SECONDS):
+        self.upload_dir = upload_dir
+        self.expire_seconds = expire_seconds
+        self.lock = threading.Lock()
+
+    def data_path(self, upload_id):
+        return os.path.join(self.upload_dir, f"{upload_id}.part")
+
+    def session_path(self, upload_id):
+        return os.path.join(self.upload_dir, f"{upload_id}.json")
+
+    def load(self, upload_id):
+        """The session for upload_id with its current offset. Raises KeyError if there is none."""
+        # Ids are generated hex strings; anything else can't name a session file
+        if not UPLOAD_ID.match(upload_id):
+            raise KeyError(upload_id)
+        try:
+            with open(self.session_path(upload_id), 'r') as f:
+                session = json.load(f)
+            session["offset"] = os.path.getsize(self.data_path(upload_id))
+        except (FileNotFoundError, json.JSONDecodeError):
+            raise KeyError(upload_id)
+        return session
+
+    def start(self, file_name, size, sha256=None, card=None):
+        """Starts an upload, or returns the unfinished one for the same file if sha256 is given."""
+        sha256 = sha256.lower() if sha256 else None
+        with self.lock:
+            os.makedirs(self.upload_dir, exist_ok=True)
+            self.expire()
+            for name in os.listdir(self.upload_dir) if sha256 else ():
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    session = self.load(name[:-len('.json')])
+                except KeyError:
+                    continue
+                if (session["file_name"], session["size"], session["sha256"]) == (file_name, size, sha256) and session["card"] == card:
+                    return session
+            session = {"upload_id": uuid.uuid4().hex, "file_name": file_name, "size": size, "sha256": sha256, "card": card,
+                       "chunk_bytes": UPLOAD_CHUNK_BYTES}
+            open(self.data_path(session["upload_id"]), 'wb').close()
+            with open(self.session_path(session["upload_id"]), 'w') as f:
+                json.dump(session, f)
+            session["offset"] = 0
+            return session
+
+    def write(self, upload_id, offset, data):
+        """Appends a chunk that starts at offset. Returns the new offset.
+
+        Raises KeyError for an unknown upload and ValueError (with the current offset
+        in the message) if offset isn't where the upload stopped or the chunk runs past its size.
+        """
+        with self.lock:
+            session = self.load(upload_id)
+            if offset != session["offset"]:
+                raise ValueError(f"Upload is at offset {session['offset']}, not {offset}.")
+            if offset + len(data) > session["size"]:
+                raise ValueError(f"Chunk ends at {offset + len(data)}, past the upload size {session['size']}.")
+            with open(self.data_path(upload_id), 'ab') as f:
+                f.write(data)
+            return offset + len(data)
+
+    def finish(self, upload_id):
+        """Checks the upload is complete (and matches its SHA-256). Returns (session, path of the uploaded file)."""
+        session = self.load(upload_id)
+        if session["offset"] != session["size"]:
+            raise ValueError(f"Upload has {session['offset']} of {session['size']} bytes.")
+        path = self.data_path(upload_id)
+        if session["sha256"]:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b''):
+                    digest.update(block)
+            if digest.hexdigest() != session["sha256"]:
+                raise ValueError("Uploaded file does not match its SHA-256; start the upload again.")
+        return session, path
+
+    def discard(self, upload_id):
+        for path in (self.data_path(upload_id), self.session_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self):
+        """Deletes uploads that haven't received a chunk within expire_seconds."""
+        cutoff = time.time() - self.expire_seconds
+        for name in os.listdir(self.upload_dir):
+            upload_id, extension = os.path.splitext(name)
+            if extension == '.json':
+                data_path = self.data_path(upload_id)
+                last_write = os.path.getmtime(data_path) if os.path.exists(data_path) else 0
+                if last_write < cutoff:
+                    self.discard(upload_id)
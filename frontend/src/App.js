@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import { FileInput, Select, Group, Button, Alert, List, Text, Title, Table, ScrollArea } from '@mantine/core'; 
 import MasterTable from "./components/masterTable";
 import { IconAlertCircle, IconCircleCheck, IconInfoCircle } from '@tabler/icons-react'; 
@@ -18,22 +18,58 @@ const App = () => {
       duplicates: [],
   });
   const [isSubmitting, setIsSubmitting] = useState(false);
+  const versionRef = useRef(null);
 
   const API_BASE_URL = "http://127.0.0.1:8000";
 
-  const fetchTableData = () => {
+  const fetchTableData = async () => {
     setError(null);
-    fetch(`${API_BASE_URL}/getMaster`)
-      .then(res => {
-          if (!res.ok) { throw new Error(`HTTP error! status: ${res.status}`); }
-          return res.json();
-       })
-      .then(data => setTableData(data))
-      .catch(error => {
-          console.error("Error fetching master data:", error);
-          setError("Failed to load master data. Is the backend running?");
-          setTableData([]); // Clear table on error
+    try {
+      // Load every page of pending rows, then remember the version for incremental refreshes
+      let rows = [];
+      let cursor = null;
+      let version = null;
+      do {
+        const params = new URLSearchParams({ limit: "1000" });
+        if (cursor) params.set("cursor", cursor);
+        const res = await fetch(`${API_BASE_URL}/getMaster?${params}`);
+        if (!res.ok) { throw new Error(`HTTP error! status: ${res.status}`); }
+        const page = await res.json();
+        rows = rows.concat(page.rows);
+        cursor = page.next_cursor;
+        version = version ?? page.version;
+      } while (cursor);
+      versionRef.current = version;
+      setTableData(rows);
+    } catch (error) {
+      console.error("Error fetching master data:", error);
+      setError("Failed to load master data. Is the backend running?");
+      setTableData([]); // Clear table on error
+    }
+  };
+
+  const fetchTableChanges = async () => {
+    if (!versionRef.current) return fetchTableData();
+    try {
+      const res = await fetch(`${API_BASE_URL}/getMaster?since=${encodeURIComponent(versionRef.current)}`);
+      if (!res.ok) { throw new Error(`HTTP error! status: ${res.status}`); }
+      const changes = await res.json();
+      if (changes.reset) return fetchTableData();
+
+      // Changed rows that are still pending are upserted; anything else leaves the table
+      setTableData(prev => {
+        const byHash = new Map(prev.map(row => [row.Hash, row]));
+        changes.rows.forEach(row => {
+          if (row.Completion === 0) byHash.set(row.Hash, row);
+          else byHash.delete(row.Hash);
+        });
+        return Array.from(byHash.values()).sort((a, b) => a.index - b.index);
       });
+      versionRef.current = changes.version;
+    } catch (error) {
+      console.error("Error fetching master changes:", error);
+      fetchTableData();
+    }
   };
 
   const fetchCardOptions = () => {
@@ -69,7 +105,7 @@ const App = () => {
 
   const handleDataUpdate = () => {
     console.log("MasterTable requested data update");
-    fetchTableData();
+    fetchTableChanges();
   };
 
   const handleFileChange = (inputFile) => {
@@ -83,14 +119,14 @@ const App = () => {
   }
 
   const handleAddMaster = async () => {
-    if (!file || !card) return;
+    if (!file) return;
 
     setSubmitStatus({ success: null, message: '', details: [], duplicates: [] });
     setIsSubmitting(true);
 
     const formData = new FormData();
     formData.append("file", file);
-    formData.append("card", card);
+    if (card) formData.append("card", card); // Without a card the backend detects it from the file
 
     try {
       const response = await fetch(`${API_BASE_URL}/addMaster`, {
@@ -144,6 +180,27 @@ const App = () => {
     }
   };
 
+  const handleApplyRules = async () => {
+    setSubmitStatus({ success: null, message: '', details: [], duplicates: [] });
+    setIsSubmitting(true);
+    try {
+      const response = await fetch(`${API_BASE_URL}/rules/apply`, { method: "POST" });
+      const result = await response.json();
+      setSubmitStatus({
+          success: response.ok,
+          message: result.message || result.detail || "Failed to apply rules.",
+          details: (result.rows || []).map(row => `${row.description} → ${row.target} (${row.rule})`),
+          duplicates: []
+      });
+      if (response.ok) handleDataUpdate();
+    } catch (error) {
+        console.error("Network error applying rules:", error);
+        setSubmitStatus({ success: false, message: "Network error or backend unavailable.", details: [`Details: ${error.message}`], duplicates: [] });
+    } finally {
+        setIsSubmitting(false);
+    }
+  };
+
     return (
         <div>
             <h1>SheetSync</h1>
@@ -166,8 +223,8 @@ const App = () => {
               />
               <Select
                  label="Card Company"
-                 placeholder="Select card type"
-                 description = "Choose which company the csv is from"
+                 placeholder="Auto-detect"
+                 description = "Choose which company the csv is from, or leave blank to detect it"
                  data={cardOptions} 
                  value={card}
                  onChange={handleCardChange} 
@@ -178,11 +235,14 @@ const App = () => {
               />
               <Button
                 onClick={handleAddMaster}
-                disabled={!file || !card || isSubmitting || isLoadingOptions}
+                disabled={!file || isSubmitting || isLoadingOptions}
                 loading={isSubmitting}
               >
                 Add to master
               </Button>
+              <Button variant="light" onClick={handleApplyRules} disabled={isSubmitting}>
+                Apply rules to pending
+              </Button>
             </Group>
 
              {submitStatus.message && (
@@ -41,6 +41,10 @@ const MasterTable = ({ tableData, onDataUpdate }) => {
                 const errorData = await response.json().catch(() => ({ detail: "Unknown error" }));
                 alert(`Error adding row (Hash: ${rowData.Hash}) to sheet ${sheetName}: ${response.status} ${response.statusText}. ${errorData.detail || ''}`);
                 console.error("Backend error:", errorData);
+                // 409: the row was completed or ignored elsewhere; show its current status
+                if (response.status === 409) {
+                    onDataUpdate();
+                }
             }
         } catch (error) {
             alert(`Network or other error adding row (Hash: ${rowData.Hash}) to sheet ${sheetName}: ${error}`);